@@ -0,0 +1,174 @@
+"""
+Robust detection of bad channels and bad epochs
+
+Bad channels are flagged on the unfiltered eeg of a run, by three robust z-scores across channels that are computed in
+a single streaming pass over 1 s windows (as in the PREP pipeline):
+    deviation: median amplitude (standard deviation within a window) of the channel, flagged if too high or too low
+    correlation: median absolute correlation with the other channels, flagged if too low
+    noise: ratio of the high-frequency (above 50 Hz) to the low-frequency amplitude, flagged if too high, with the line
+        frequency and its harmonics notched out first, such that mains pickup alone does not count as noise
+The flagged channels are interpolated from their neighbours (spherical splines on the biosemi64 montage) once the
+trials are sliced.
+
+Bad epochs are flagged by robust z-scores across the epochs of a run of their peak-to-peak amplitude and variance (both
+as the mean over channels of the log values, as in FASTER). They are dropped together with their labels.
+
+All z-scores are robust, i.e., relative to the median and scaled by the median absolute deviation (times 1.4826, such
+that they match ordinary z-scores for normally distributed values).
+"""
+import numpy as np
+from scipy import signal
+import mne
+from filter_bank import design_notch
+
+
+def robust_z(x: np.ndarray, axis: int = 0):
+    """
+    Computes robust z-scores
+
+    Args:
+        x (np.ndarray): values
+        axis (int, optional): axis along which the values are compared. Defaults to 0.
+
+    Returns:
+        np.ndarray: (x - median) / (1.4826 * median absolute deviation), 0 where the deviation is 0
+    """
+    median = np.median(x, axis=axis, keepdims=True)
+    scale = 1.4826 * np.median(np.abs(x - median), axis=axis, keepdims=True)
+    return np.divide(x - median, scale, out=np.zeros(np.broadcast(x, scale).shape), where=scale > 0)
+
+
+def get_channel_scores(data: np.ndarray, sfreq: float, picks: np.ndarray = None, window: float = 1.0,
+                       noise_freq: float = 50.0, line_freq: float = None, block_windows: int = 60):
+    """
+    Computes the deviation, correlation and noise of the channels in 1 s windows
+
+    The data is high-passed at 1 Hz (drifts and offsets), the line frequency and its harmonics are notched out, and the
+    data is split at noise_freq into a low- and a high-frequency part with causal filters, block by block, such that
+    only one block of the picked channels is copied at a time.
+
+    Args:
+        data (np.ndarray): unfiltered data (channels x samples)
+        sfreq (float): sampling frequency in Hz
+        picks (np.ndarray, optional): indices of the channels to score. Defaults to None (all channels).
+        window (float, optional): window length in seconds. Defaults to 1.
+        noise_freq (float, optional): frequency in Hz above which the data counts as noise. Defaults to 50.
+        line_freq (float, optional): line frequency in Hz, notched out with its harmonics. Defaults to None (no notch).
+        block_windows (int, optional): number of windows filtered and scored at once. Defaults to 60.
+
+    Returns:
+        dict: deviation, correlation and noise per channel (median over the windows)
+    """
+    picks = np.arange(data.shape[0]) if picks is None else np.asarray(picks)
+    n_window = int(round(window * sfreq))
+    n_windows = data.shape[1] // n_window
+    sos_hp = signal.butter(4, 1.0, btype="highpass", output="sos", fs=sfreq)
+    sos_lp = signal.butter(4, min(noise_freq, 0.45 * sfreq), btype="lowpass", output="sos", fs=sfreq)
+    sos_notch = None if line_freq is None else design_notch(sfreq, line_freq)
+
+    # the filters start in the steady state of the first sample, such that the offsets do not ring into the data
+    state_hp = signal.sosfilt_zi(sos_hp)[:, None, :] * data[picks, :1]
+    state_lp = np.zeros((sos_lp.shape[0], len(picks), 2))
+    if sos_notch is not None:
+        state_notch = np.zeros((sos_notch.shape[0], len(picks), 2))
+
+    deviation, correlation, noise = [], [], []
+    for start in range(0, n_windows, block_windows):
+        stop = min(start + block_windows, n_windows)
+        block, state_hp = signal.sosfilt(sos_hp, data[picks, start * n_window:stop * n_window], zi=state_hp)
+        if sos_notch is not None:
+            block, state_notch = signal.sosfilt(sos_notch, block, zi=state_notch)
+        low, state_lp = signal.sosfilt(sos_lp, block, zi=state_lp)
+        high = (block - low).reshape(len(picks), stop - start, n_window)
+        low = low.reshape(len(picks), stop - start, n_window)
+
+        amplitude = low.std(axis=2)  # channels x windows
+        deviation.append(amplitude)
+        noise.append(np.divide(high.std(axis=2), amplitude, out=np.zeros_like(amplitude), where=amplitude > 0))
+
+        # correlation matrices of all windows at once (windows x channels x channels)
+        low = low - low.mean(axis=2, keepdims=True)
+        low /= np.maximum(np.linalg.norm(low, axis=2, keepdims=True), np.finfo(float).tiny)
+        corr = np.abs(np.einsum("iwt,jwt->wij", low, low))
+        corr[:, np.arange(len(picks)), np.arange(len(picks))] = np.nan
+        correlation.append(np.nanmedian(corr, axis=2).T)
+
+    return {"deviation": np.median(np.concatenate(deviation, axis=1), axis=1),
+            "correlation": np.median(np.concatenate(correlation, axis=1), axis=1),
+            "noise": np.median(np.concatenate(noise, axis=1), axis=1)}
+
+
+def find_bad_channels(raw: mne.io.BaseRaw, z_threshold: float, line_freq: float = None):
+    """
+    Flags the bad eeg channels of a run by robust z-scores of their deviation, correlation and noise
+
+    Args:
+        raw (mne.io.BaseRaw): unfiltered data of the run
+        z_threshold (float): robust z-score beyond which a channel is flagged
+        line_freq (float, optional): line frequency in Hz, notched out (with its harmonics) before the noise is
+            computed. Defaults to None (no notch).
+
+    Returns:
+        dict: names of the bad channels (channels) and the z-scores of all eeg channels (scores)
+    """
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    scores = get_channel_scores(raw._data, raw.info["sfreq"], picks, line_freq=line_freq)
+    z = {name: robust_z(score) for name, score in scores.items()}
+    bad = (np.abs(z["deviation"]) > z_threshold) | (scores["deviation"] == 0) | \
+          (z["correlation"] < -z_threshold) | (z["noise"] > z_threshold)
+
+    channels = [raw.ch_names[pick] for pick in picks[bad]]
+    for pick, i_channel in zip(picks[bad], np.flatnonzero(bad)):
+        print(f"bad channel {raw.ch_names[pick]}: z = " +
+              ", ".join(f"{z[name][i_channel]:.1f} ({name})" for name in z))
+    print(f"bad channels: {channels}")
+    return {"channels": channels, "scores": {name: np.round(score, 2).tolist() for name, score in z.items()}}
+
+
+def find_bad_epochs(data: np.ndarray, z_threshold: float):
+    """
+    Flags the bad epochs of a run by robust z-scores of their amplitude and variance
+
+    Args:
+        data (np.ndarray): eeg data of the epochs (epochs x channels x samples)
+        z_threshold (float): robust z-score above which an epoch is flagged
+
+    Returns:
+        dict: indices of the bad epochs (epochs) and the z-scores of all epochs (scores)
+    """
+    tiny = np.finfo(float).tiny
+    z = {"amplitude": robust_z(np.log(np.maximum(np.ptp(data, axis=2), tiny)).mean(axis=1)),
+         "variance": robust_z(np.log(np.maximum(data.var(axis=2), tiny)).mean(axis=1))}
+    epochs = np.flatnonzero((z["amplitude"] > z_threshold) | (z["variance"] > z_threshold)).tolist()
+    for epoch in epochs:
+        print(f"bad epoch {epoch}: z = " + ", ".join(f"{z[name][epoch]:.1f} ({name})" for name in z))
+    print(f"bad epochs: {epochs}")
+    return {"epochs": epochs, "scores": {name: np.round(score, 2).tolist() for name, score in z.items()}}
+
+
+def clean_epochs(epo: mne.Epochs, labels: list, z_threshold: float):
+    """
+    Interpolates the bad channels of the epochs and drops the bad epochs, together with their labels
+
+    Args:
+        epo (mne.Epochs): the trials of the run, with the bad channels in epo.info['bads'], modified in place
+        labels (list): trial labels
+        z_threshold (float): robust z-score above which an epoch is dropped, None to keep all epochs
+
+    Returns:
+        tuple: the cleaned epochs, the labels of the remaining epochs, and what was removed (dict with the
+            interpolated channels, and the indices and z-scores of the epochs) together with the indices of the trials
+            of the run that remain (epo.selection)
+    """
+    channels = list(epo.info["bads"])
+    if channels:
+        epo.interpolate_bads(reset_bads=True)
+
+    bad_epochs = {"epochs": [], "scores": {}}
+    if z_threshold is not None:
+        bad_epochs = find_bad_epochs(epo.get_data(), z_threshold)
+        epo.drop(bad_epochs["epochs"], reason="robust z")
+        labels = [label for i_epoch, label in enumerate(labels) if i_epoch not in bad_epochs["epochs"]]
+
+    return epo, labels, {"channels": channels, "epochs": bad_epochs["epochs"], "epoch_scores": bad_epochs["scores"],
+                         "trials": [int(i_trial) for i_trial in epo.selection]}
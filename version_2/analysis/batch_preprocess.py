@@ -0,0 +1,290 @@
+"""
+Batch preprocessing of all subjects, conditions and runs on a process pool
+
+Runs the same stages as read_and_preprocess_data.py (and takes its paths and parameters from there), but schedules the
+runs as independent jobs on a pool of worker processes. The derivatives of a subject and condition are written as soon
+as all of its runs are done, and are identical to those of the serial script.
+
+ICA components to exclude are taken from the ica_exclusions_{subject}.json files if they exist there for a subject and
+condition. Otherwise, they are selected automatically per run (ica_selection 'auto', which needs no display), or the
+first run is processed (and its components selected) first, after which the remaining runs of that condition are
+scheduled with the same exclusions (ica_selection 'manual'). With ica_fit_mode 'condition', the ICA of a subject and
+condition is fitted (on all of its runs) as a separate job before its runs are scheduled. The report of the excluded
+components of a subject is rendered as a separate job once all of its derivatives are saved (or skipped, see
+ica_report, and rendered later with ica_report.py).
+
+All preprocessing variants of a run (see variants in read_and_preprocess_data.py) are processed in the same job, such
+that the stages they have in common are run once.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import psutil
+from threadpoolctl import threadpool_limits
+from preprocessing import get_run_path, get_ica_path, fit_condition_ica, preprocess_run_variants, combine_runs, \
+    load_ica_exclusions, save_ica_exclusions, get_variant_label
+from dataset import get_derivative_path, save_derivative
+from ica_report import save_subject_report
+from stage_profile import get_profile_path, profile_stage
+from catalog import build_catalog, select_runs
+from trial_store import build_trial_store
+from read_and_preprocess_data import data_path, codes_path, ica_path, cache_path, profile_path, subjects, ses, \
+    conditions, overt_runs, covert_runs, variant_params, trial_stores, compress_derivatives
+
+# batch params
+n_workers = os.cpu_count()  # maximum number of worker processes
+max_memory_per_worker = 8  # memory ceiling per worker process in GB
+address_space_margin = 4  # GB of address space a worker may reserve beyond its memory ceiling (see _init_worker)
+ica_report = True  # render the report of the excluded ICA components per subject, False to skip it
+use_catalog = True  # skip the conditions of which a run is missing or incomplete in the catalog of data_path
+
+
+def _init_worker(max_memory: int, n_threads: int):
+    """
+    Limits the threads and the address space of a worker process
+
+    The BLAS/OpenMP thread pools (e.g., of the ICA fit) are limited to the CPUs of the worker, such that the workers
+    together do not start more threads than there are CPUs. The limit on the address space makes a run that exceeds
+    it fail with a MemoryError instead of swapping the whole machine. N.B. this limits the virtual memory, not the
+    resident memory: the libraries, thread stacks and memory-mapped mirrors reserve more address space than they use,
+    so the limit is max_memory plus address_space_margin.
+
+    Args:
+        max_memory (int): address space limit in bytes
+        n_threads (int): number of threads per thread pool
+    """
+    for name in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:  # for libraries loaded from now on
+        os.environ[name] = str(n_threads)
+    threadpool_limits(n_threads)  # for the ones loaded already
+    try:
+        import resource
+    except ImportError:  # not available on Windows, there only the number of workers is limited
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+def get_worker_init(n_workers: int, max_memory_per_worker: float):
+    """
+    Returns the arguments of _init_worker and the number of threads filtering the channels of a run per worker
+
+    Args:
+        n_workers (int): number of worker processes
+        max_memory_per_worker (float): memory ceiling per worker in GB
+
+    Returns:
+        tuple: arguments of _init_worker (address space limit in bytes, number of threads) and the number of filter
+            threads
+    """
+    n_threads = max(1, os.cpu_count() // n_workers)
+    return (int((max_memory_per_worker + address_space_margin) * 1024 ** 3), n_threads), n_threads
+
+
+def get_n_workers(n_workers: int, max_memory_per_worker: float):
+    """
+    Limits the number of workers to the number that fits in the available memory
+
+    Args:
+        n_workers (int): requested number of workers
+        max_memory_per_worker (float): memory ceiling per worker in GB
+
+    Returns:
+        int: number of workers to use (at least 1)
+    """
+    n_fit = int(psutil.virtual_memory().available // (max_memory_per_worker * 1024 ** 3))
+    return max(1, min(n_workers, n_fit))
+
+
+def get_worker_memory(max_memory_per_worker: float):
+    """
+    Returns the memory to reserve per worker process: with a memory budget per run in all variants (low-memory mode),
+    the largest budget, otherwise the memory ceiling
+
+    Args:
+        max_memory_per_worker (float): memory ceiling per worker in GB
+
+    Returns:
+        float: memory per worker in GB
+    """
+    budgets = [v_params["memory_budget"] for v_params in variant_params.values()]
+    if None not in budgets:
+        return min(max_memory_per_worker, max(budgets))
+    return max_memory_per_worker
+
+
+def save_condition(subject: str, condition: str, fns: list, results: list):
+    """
+    Combines the preprocessed runs of a subject and condition and saves a derivative (and its trial store) per variant
+
+    Args:
+        subject (str): subject name
+        condition (str): condition, e.g., 'covert'
+        fns (list): paths of the xdf files of the runs
+        results (list): eeg data, labels, exclusions and bad data per variant, per run (see
+            preprocessing.preprocess_run_variants)
+
+    Returns:
+        dict: variant -> path of the derivative and the xdf file and excluded ICA components per run (see
+            ica_report.get_report_pages)
+    """
+    saved = {}
+    for variant, v_params in variant_params.items():
+        label = get_variant_label(condition, variant)
+        with profile_stage(get_profile_path(profile_path, subject, f'{label}_save'), "save"):
+            X, y, V = combine_runs([result[variant][0] for result in results],
+                                   [result[variant][1] for result in results], v_params, codes_path)
+            fn = get_derivative_path(data_path, subject, label, v_params["code"])
+            settings = dict(v_params, exclude=[result[variant][2] for result in results],
+                            bads=[result[variant][3] for result in results])
+            save_derivative(fn, X, y, V, v_params["fs"], settings=settings, compress=compress_derivatives)
+        if trial_stores:
+            with profile_stage(get_profile_path(profile_path, subject, f'{label}_trials'), "trial_store"):
+                build_trial_store(fn, fns)
+        saved[variant] = (fn, [(fn_run, result[variant][2]) for fn_run, result in zip(fns, results)])
+        print(f"data saved for subject {subject}, {label}")
+    return saved
+
+
+def run_batch(subjects: list, conditions: list, n_workers: int = n_workers,
+              max_memory_per_worker: float = max_memory_per_worker, ica_report: bool = ica_report,
+              use_catalog: bool = use_catalog):
+    """
+    Preprocesses all runs of the given subjects and conditions on a process pool
+
+    Args:
+        subjects (list): subject names
+        conditions (list): conditions, e.g., ['overt', 'covert']
+        n_workers (int, optional): maximum number of worker processes. Defaults to the number of CPUs.
+        max_memory_per_worker (float, optional): memory ceiling per worker process in GB, enforced on its address space
+            (see _init_worker). Defaults to 8. The number of workers is sized by the memory budget of the runs instead
+            if all variants have one.
+        ica_report (bool, optional): render the report of the excluded ICA components of each subject. Defaults to
+            True.
+        use_catalog (bool, optional): update the catalog of data_path and skip the conditions of which a run is
+            missing or incomplete (see catalog.py). Defaults to True.
+
+    Returns:
+        list: paths of the saved derivatives
+    """
+    n_workers = get_n_workers(n_workers, get_worker_memory(max_memory_per_worker))
+    init_args, filter_jobs = get_worker_init(n_workers, max_memory_per_worker)
+    print(f"preprocessing on {n_workers} worker(s), {filter_jobs} thread(s) each")
+
+    # the runs that can be preprocessed, from the catalog
+    ready = None
+    if use_catalog:
+        ready = {row["path"] for row in select_runs(build_catalog(data_path), status="ok")}
+
+    runs = {}  # (subject, condition) -> number of runs
+    results = {}  # (subject, condition) -> eeg data, labels, exclusions and bad data per variant, per run
+    exclusions = {}  # (subject, condition) -> variant -> excluded ICA components
+    report_runs = {}  # (subject, variant) -> condition -> xdf file and exclusions per run
+    for subject in subjects:
+        saved = load_ica_exclusions(ica_path, subject)
+        for condition in conditions:
+            n_runs = overt_runs if condition == 'overt' else covert_runs
+            if ready is not None:
+                fns = [get_run_path(data_path, subject, ses, condition, i_run) for i_run in range(n_runs)]
+                missing = [os.path.basename(fn) for fn in fns if fn not in ready]
+                if missing:
+                    print(f"skipped {subject} {condition}, missing or incomplete: {', '.join(missing)}")
+                    continue
+            runs[(subject, condition)] = n_runs
+            results[(subject, condition)] = [None] * runs[(subject, condition)]
+            exclusions[(subject, condition)] = {variant: saved.get(get_variant_label(condition, variant))
+                                                for variant in variant_params}
+        for variant in variant_params:
+            report_runs[(subject, variant)] = {}
+
+    def is_manual(key):
+        # the components of a variant are still to be selected manually (in the first run of the condition)
+        return any(exclusions[key][variant] is None and v_params["use_ica"] and v_params["ica_selection"] == "manual"
+                   for variant, v_params in variant_params.items())
+
+    saved_derivatives = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=init_args) as pool:
+
+        def submit(key, i_run):
+            subject, condition = key
+            fn = get_run_path(data_path, subject, ses, condition, i_run)
+            fn_log = {variant: os.path.join(ica_path, f'ica_selection_{subject}_{get_variant_label(condition, variant)}'
+                                                      f'_run-{1 + i_run:03d}.json') for variant in variant_params}
+            fn_profile = {variant: get_profile_path(profile_path, subject,
+                                                    f'{get_variant_label(condition, variant)}_run-{1 + i_run:03d}')
+                          for variant in variant_params}
+            return pool.submit(preprocess_run_variants, fn, variant_params, exclusions[key], cache_path, fn_log,
+                               fn_icas[key], fn_profile, filter_jobs)
+
+        def submit_runs(key):
+            # schedule all runs whose exclusions are known or selected automatically, otherwise only the first run
+            for i_run in range(1 if is_manual(key) else runs[key]):
+                pending[submit(key, i_run)] = (key, i_run)
+
+        pending = {}
+        fn_icas = {}  # (subject, condition) -> variant -> ICA fitted on all runs of the condition
+        n_icas = {}  # (subject, condition) -> number of condition ICAs still being fitted
+        for key in runs:
+            subject, condition = key
+            fns = [get_run_path(data_path, subject, ses, condition, i_run) for i_run in range(runs[key])]
+            fn_icas[key] = {variant: get_ica_path(ica_path, subject, get_variant_label(condition, variant))
+                            for variant, v_params in variant_params.items()
+                            if v_params["use_ica"] and v_params["ica_fit_mode"] == "condition"}
+            n_icas[key] = len(fn_icas[key])
+            for variant, fn_ica in fn_icas[key].items():
+                fn_profile = get_profile_path(profile_path, subject, f'{get_variant_label(condition, variant)}_ica')
+                pending[pool.submit(fit_condition_ica, fns, variant_params[variant], fn_ica, cache_path,
+                                    fn_profile, filter_jobs)] = (key, None)
+            if n_icas[key] == 0:
+                submit_runs(key)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, i_run = pending.pop(future)
+                subject, condition = key
+
+                # an ICA of the condition is fitted, schedule its runs once all of them are
+                if i_run is None:
+                    future.result()
+                    n_icas[key] -= 1
+                    if n_icas[key] == 0:
+                        print(f"finished {subject} {condition} ICA")
+                        submit_runs(key)
+                    continue
+                if i_run == "report":
+                    future.result()
+                    print(f"finished {subject} ICA report")
+                    continue
+
+                results[key][i_run] = future.result()
+                print(f"finished {subject} {condition} run {1 + i_run}")
+
+                # the exclusions were selected manually in this run, schedule the remaining runs of the condition
+                if is_manual(key):
+                    for variant, (_, _, exclude, _) in results[key][i_run].items():
+                        if exclusions[key][variant] is None and variant_params[variant]["use_ica"]:
+                            exclusions[key][variant] = exclude
+                            save_ica_exclusions(ica_path, subject, get_variant_label(condition, variant), exclude)
+                    for i_next in range(1, runs[key]):
+                        pending[submit(key, i_next)] = (key, i_next)
+
+                # all runs of the condition are done, save the derivatives
+                if all(result is not None for result in results[key]):
+                    fns = [get_run_path(data_path, subject, ses, condition, i) for i in range(runs[key])]
+                    for variant, (fn, report) in save_condition(subject, condition, fns, results[key]).items():
+                        saved_derivatives.append(fn)
+                        report_runs[(subject, variant)][get_variant_label(condition, variant)] = report
+                    results[key] = []  # release the run data
+
+                    # all conditions of the subject are done, render its reports (pages in this worker)
+                    for variant, v_params in variant_params.items():
+                        if ica_report and v_params["use_ica"] and \
+                                len(report_runs[(subject, variant)]) == sum(other == subject for other, _ in runs):
+                            fn_profile = get_profile_path(profile_path, subject, get_variant_label("report", variant))
+                            future = pool.submit(save_subject_report, subject, report_runs[(subject, variant)],
+                                                 v_params, ica_path, cache_path, 1, variant, fn_profile)
+                            pending[future] = ((subject, None), "report")
+
+    return saved_derivatives
+
+
+if __name__ == "__main__":
+    run_batch(subjects, conditions)
@@ -0,0 +1,314 @@
+"""
+Catalog of the raw runs and the derivatives of a data root, stored in a local SQLite file
+
+The raw data is scanned once for .xdf files named as in BIDS (raw/sub-{subject}/{session}/eeg/sub-{subject}_{session}_
+task-{task}_run-{run}_eeg.xdf), and every run is indexed with its streams (name, type, rates, channels, samples and
+duration), the counts of its markers and the number of trials. The streams are read from the mirror of the run if it
+exists, and otherwise from its chunk index (see xdf_index.py), which is built from one pass over the file without
+decoding the samples. The mirror itself is written by the first preprocessing job that loads the run. The derivatives
+(derivatives/{subject}/*.npz, see dataset.py) are indexed with their shape and settings. A run or derivative is only
+indexed again when its size or modification time changed, such that a rescan takes milliseconds.
+
+Tables:
+    runs: path, subject, session, task, run, size, mtime_ns, status ('ok', 'incomplete' or 'error'), error, duration,
+        n_markers, markers (json, count per marker), n_trials
+    streams: path (of the run), name, type, channel_count, nominal_srate, effective_srate, n_samples, duration
+    derivatives: path, subject, condition, code, size, mtime_ns, status ('ok' or 'incomplete'), n_trials, n_channels,
+        n_samples, fs
+
+A run is 'incomplete' if it lacks the BioSemi or marker stream, has no trials or has trials that were started but not
+finished. The derivatives of a run are the ones of its subject whose condition is its task (with any variant appended,
+see preprocessing.get_variant_label).
+
+Run as a script, it (re)builds the catalog of data_path and prints the runs per subject and task.
+"""
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import zipfile
+from collections import Counter
+import numpy as np
+from xdf_reader import read_mirror, get_labels
+from xdf_index import load_index, get_time_range
+from dataset import open_x
+
+# streams a run needs to be preprocessed
+REQUIRED_STREAMS = ["BioSemi", "KeyboardMarkerStream"]
+
+# file name of a raw run, see preprocessing.get_run_path
+RUN_PATTERN = re.compile(r"sub-(?P<subject>[^_]+)_(?P<session>ses-[^_]+)_task-(?P<task>[^_]+)_run-(?P<run>\d+)"
+                         r"_eeg\.xdf$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY, subject TEXT, session TEXT, task TEXT, run INTEGER, size INTEGER, mtime_ns INTEGER,
+    status TEXT, error TEXT, duration REAL, n_markers INTEGER, markers TEXT, n_trials INTEGER);
+CREATE TABLE IF NOT EXISTS streams (
+    path TEXT, name TEXT, type TEXT, channel_count INTEGER, nominal_srate REAL, effective_srate REAL,
+    n_samples INTEGER, duration REAL, PRIMARY KEY (path, name));
+CREATE TABLE IF NOT EXISTS derivatives (
+    path TEXT PRIMARY KEY, subject TEXT, condition TEXT, code TEXT, size INTEGER, mtime_ns INTEGER, status TEXT,
+    n_trials INTEGER, n_channels INTEGER, n_samples INTEGER, fs REAL);
+CREATE INDEX IF NOT EXISTS runs_subject_task ON runs (subject, task);
+CREATE INDEX IF NOT EXISTS derivatives_subject ON derivatives (subject);
+"""
+
+
+def get_catalog_path(data_path: str):
+    """
+    Returns the path of the catalog of a data root
+
+    Args:
+        data_path (str): path for raw data
+
+    Returns:
+        str: path of the SQLite file
+    """
+    return os.path.join(data_path, "catalog.sqlite")
+
+
+def connect(fn_catalog: str):
+    """
+    Opens a catalog, creating its tables if needed
+
+    Args:
+        fn_catalog (str): path of the SQLite file
+
+    Returns:
+        sqlite3.Connection: the connection, with rows that can be indexed by column name
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(fn_catalog)), exist_ok=True)
+    con = sqlite3.connect(fn_catalog)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+
+def describe_run(fn: str):
+    """
+    Reads the streams and markers of a run
+
+    Args:
+        fn (str): path of the xdf file
+
+    Returns:
+        tuple: the run (dict with the columns of the runs table that follow from its content) and its streams (list of
+            dicts with the columns of the streams table)
+    """
+    run = {"status": "ok", "error": None, "duration": None, "n_markers": None, "markers": None, "n_trials": None}
+    streams = read_mirror(fn, mmap=True)
+    rows = []
+    if streams is not None:
+        for name, stream in streams.items():
+            info = stream["info"]
+            time_stamps = stream["time_stamps"]
+            rows.append({"name": name, "type": info["type"][0], "channel_count": int(info["channel_count"][0]),
+                         "nominal_srate": float(info["nominal_srate"][0]),
+                         "effective_srate": float(np.array(info["effective_srate"]).item()),
+                         "n_samples": len(time_stamps),
+                         "duration": float(time_stamps[-1] - time_stamps[0]) if len(time_stamps) > 1 else 0.0})
+    else:
+        try:
+            streams = load_index(fn)  # the marker stream keeps its samples in the index
+        except Exception as error:  # e.g., a file that is still being written or was cut off
+            return dict(run, status="error", error=f"{type(error).__name__}: {error}"), []
+        for name, entry in streams.items():
+            time_range = get_time_range(entry)
+            rows.append({"name": name, "type": entry["type"], "channel_count": entry["channel_count"],
+                         "nominal_srate": entry["nominal_srate"],
+                         "effective_srate": entry.get("effective_srate", 0.0),
+                         "n_samples": entry["n_samples"],
+                         "duration": time_range[1] - time_range[0] if time_range is not None else 0.0})
+
+    if "BioSemi" in streams:
+        run["duration"] = next(row["duration"] for row in rows if row["name"] == "BioSemi")
+    if "KeyboardMarkerStream" in streams:
+        markers = Counter(marker[2] for marker in streams["KeyboardMarkerStream"]["time_series"])
+        run.update(n_markers=sum(markers.values()), markers=json.dumps(dict(markers)),
+                   n_trials=len(get_labels(streams["KeyboardMarkerStream"])))
+
+    missing = [name for name in REQUIRED_STREAMS if name not in streams]
+    if missing:
+        run.update(status="incomplete", error=f"missing streams: {', '.join(missing)}")
+    elif not run["n_trials"]:
+        run.update(status="incomplete", error="no trials")
+    elif markers.get("start_stimulus", 0) != markers.get("stop_stimulus", 0):  # e.g., a recording that was cut off
+        run.update(status="incomplete", error=f"{markers.get('start_stimulus', 0)} stimuli started, "
+                                              f"{markers.get('stop_stimulus', 0)} finished")
+    return run, rows
+
+
+def describe_derivative(fn: str):
+    """
+    Reads the shape and settings of a derivative, without reading its eeg data
+
+    Args:
+        fn (str): path of the npz file of the derivative
+
+    Returns:
+        dict: the columns of the derivatives table that follow from its content
+    """
+    derivative = {"status": "ok", "code": None, "n_trials": None, "n_channels": None, "n_samples": None, "fs": None}
+    with np.load(fn) as npz:
+        settings = json.loads(str(npz["settings"])) if "settings" in npz else None
+        derivative.update(code=(settings or {}).get("code"), n_trials=len(npz["y"]), fs=float(npz["fs"]))
+        legacy = "X" in npz
+    if legacy:  # the older layout, with X inside the npz file: only the header of X is read
+        with zipfile.ZipFile(fn) as archive, archive.open("X.npy") as fid:
+            version = np.lib.format.read_magic(fid)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape = read_header(fid)[0]
+    else:
+        X = open_x(fn)
+        if X is None:
+            return dict(derivative, status="incomplete")
+        shape = X.shape
+
+    derivative.update(n_channels=shape[1], n_samples=shape[2])
+    if shape[0] != derivative["n_trials"]:
+        derivative["status"] = "incomplete"
+    return derivative
+
+
+def _is_current(con: sqlite3.Connection, table: str, fn: str):
+    # whether the file was indexed with its current size and modification time
+    stat = os.stat(fn)
+    row = con.execute(f"SELECT size, mtime_ns FROM {table} WHERE path = ?", (fn,)).fetchone()
+    return row is not None and (row["size"], row["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+
+
+def build_catalog(data_path: str, fn_catalog: str = None, min_age: float = 0, verbose: bool = True):
+    """
+    Indexes the new and changed runs and derivatives of a data root, and removes the ones that no longer exist
+
+    Args:
+        data_path (str): path for raw data
+        fn_catalog (str, optional): path of the SQLite file. Defaults to None (catalog.sqlite in data_path).
+        min_age (float, optional): only index the runs that were last modified at least this many seconds ago, i.e.,
+            not the ones that are still being recorded. Defaults to 0.
+        verbose (bool, optional): print the number of files and of (re)indexed files. Defaults to True.
+
+    Returns:
+        str: path of the SQLite file
+    """
+    fn_catalog = fn_catalog or get_catalog_path(data_path)
+    fns_run = sorted(fn for fn in glob.glob(os.path.join(data_path, "raw", "sub-*", "*", "eeg", "*.xdf"))
+                     if RUN_PATTERN.search(os.path.basename(fn)))
+    fns_derivative = sorted(glob.glob(os.path.join(data_path, "derivatives", "*", "*.npz")))
+
+    n_indexed = 0
+    with connect(fn_catalog) as con:
+        for fn in fns_run:
+            if _is_current(con, "runs", fn):
+                continue
+            stat = os.stat(fn)
+            if time.time() - stat.st_mtime < min_age:
+                continue
+            name = RUN_PATTERN.search(os.path.basename(fn)).groupdict()
+            run, streams = describe_run(fn)
+            con.execute("DELETE FROM streams WHERE path = ?", (fn,))
+            con.execute("INSERT OR REPLACE INTO runs VALUES (:path, :subject, :session, :task, :run, :size, :mtime_ns, "
+                        ":status, :error, :duration, :n_markers, :markers, :n_trials)",
+                        dict(run, **dict(name, run=int(name["run"])), path=fn, size=stat.st_size,
+                             mtime_ns=stat.st_mtime_ns))
+            con.executemany("INSERT INTO streams VALUES (:path, :name, :type, :channel_count, :nominal_srate, "
+                            ":effective_srate, :n_samples, :duration)", [dict(row, path=fn) for row in streams])
+            n_indexed += 1
+
+        for fn in fns_derivative:
+            if _is_current(con, "derivatives", fn):
+                continue
+            stat = os.stat(fn)
+            subject = os.path.basename(os.path.dirname(fn))
+            derivative = describe_derivative(fn)
+            stem = os.path.basename(fn)[:-len(".npz")]
+            condition = stem[len(f"{subject}_cvep_"):]
+            if derivative["code"] is None and "_" in condition:
+                # saved without settings (the older layout): {subject}_cvep_{condition}_{code}, without variants
+                condition, derivative["code"] = condition.split("_", 1)
+            elif derivative["code"] is not None and condition.endswith(f"_{derivative['code']}"):
+                condition = condition[:-len(f"_{derivative['code']}")]
+            con.execute("INSERT OR REPLACE INTO derivatives VALUES (:path, :subject, :condition, :code, :size, "
+                        ":mtime_ns, :status, :n_trials, :n_channels, :n_samples, :fs)",
+                        dict(derivative, path=fn, subject=subject, condition=condition, size=stat.st_size,
+                             mtime_ns=stat.st_mtime_ns))
+            n_indexed += 1
+
+        # files that were removed
+        for table, fns in (("runs", fns_run), ("derivatives", fns_derivative)):
+            for row in con.execute(f"SELECT path FROM {table}").fetchall():
+                if row["path"] not in fns:
+                    con.execute(f"DELETE FROM {table} WHERE path = ?", (row["path"],))
+                    if table == "runs":
+                        con.execute("DELETE FROM streams WHERE path = ?", (row["path"],))
+    con.close()
+
+    if verbose:
+        print(f"catalog: {len(fns_run)} run(s) and {len(fns_derivative)} derivative(s), {n_indexed} (re)indexed")
+    return fn_catalog
+
+
+def select_runs(fn_catalog: str, subject: str = None, task: str = None, status: str = "ok",
+                without_derivative: bool = False):
+    """
+    Selects runs from the catalog
+
+    Args:
+        fn_catalog (str): path of the SQLite file
+        subject (str, optional): subject name. Defaults to None (all subjects).
+        task (str, optional): task (condition), e.g., 'covert'. Defaults to None (all tasks).
+        status (str, optional): status of the runs, None for any status. Defaults to 'ok'.
+        without_derivative (bool, optional): only the runs of which no derivative of the task exists. Defaults to
+            False.
+
+    Returns:
+        list: one dict per run (the columns of the runs table and the conditions of its derivatives), ordered by
+            subject, session, task and run
+    """
+    query = "SELECT runs.*, group_concat(derivatives.condition) AS derivatives FROM runs LEFT JOIN derivatives " \
+            "ON derivatives.subject = runs.subject AND derivatives.status = 'ok' AND " \
+            "(derivatives.condition = runs.task OR derivatives.condition LIKE runs.task || '\\_%' ESCAPE '\\') " \
+            "WHERE (:subject IS NULL OR runs.subject = :subject) AND (:task IS NULL OR runs.task = :task) " \
+            "AND (:status IS NULL OR runs.status = :status) GROUP BY runs.path"
+    if without_derivative:
+        query += " HAVING derivatives IS NULL"
+    query += " ORDER BY runs.subject, runs.session, runs.task, runs.run"
+    with connect(fn_catalog) as con:
+        rows = [dict(row) for row in con.execute(query, {"subject": subject, "task": task, "status": status})]
+    con.close()
+    for row in rows:
+        row["markers"] = json.loads(row["markers"]) if row["markers"] else {}
+        row["derivatives"] = sorted(set(row["derivatives"].split(","))) if row["derivatives"] else []
+    return rows
+
+
+def select_streams(fn_catalog: str, path: str):
+    """
+    Returns the streams of a run from the catalog
+
+    Args:
+        fn_catalog (str): path of the SQLite file
+        path (str): path of the xdf file
+
+    Returns:
+        dict: stream name -> the columns of the streams table
+    """
+    with connect(fn_catalog) as con:
+        streams = {row["name"]: dict(row) for row in con.execute("SELECT * FROM streams WHERE path = ?", (path,))}
+    con.close()
+    return streams
+
+
+if __name__ == "__main__":
+    from read_and_preprocess_data import data_path
+
+    fn_catalog = build_catalog(data_path)
+    print(f"{'subject':<12}{'session':<12}{'task':<12}{'run':>4}{'status':>12}{'trials':>8}{'duration (s)':>14}"
+          "  derivatives")
+    for row in select_runs(fn_catalog, status=None):
+        print(f"{row['subject']:<12}{row['session']:<12}{row['task']:<12}{row['run']:>4}{row['status']:>12}"
+              f"{row['n_trials'] or 0:>8}{row['duration'] or 0:>14.1f}  {', '.join(row['derivatives'])}")
@@ -0,0 +1,243 @@
+"""
+Compressed, chunked storage of numeric arrays (derivatives and stream mirrors)
+
+An array is split into chunks (e.g., one trial and 8 channels of the eeg data of a derivative, or 4096 samples and 8
+channels of a mirrored stream), and every chunk is compressed on its own:
+    delta: the bit patterns of consecutive samples along the time axis are subtracted (as unsigned integers, which
+        wraps around and is therefore lossless), such that slowly varying signals leave mostly small numbers
+    byte shuffle: the first bytes of all values are stored together, then the second bytes, and so on, such that the
+        (mostly constant) sign and exponent bytes form long runs
+    codec: zlib at level 1 (the standard library), or zstd if the zstandard package is installed
+Decompression reverses the steps and returns the exact values.
+
+The file (.npc) holds the compressed chunks followed by an index (json: shape, dtype, chunk shape, codec, filters and
+the byte offset of every chunk) and the offset of the index in its last 8 bytes. It is opened as a ChunkedArray, which
+is indexed like the memory-mapped .npy files: only the chunks that hold the selected trials (or samples) and channels
+are read from disk and decompressed.
+
+Run as a script, it compresses the eeg data of all derivatives and the mirrors of all runs of data_path.
+"""
+import os
+import io
+import json
+import zlib
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # optional, the archives are then written with zlib
+    zstandard = None
+
+MAGIC = b"NPCHUNK1"
+
+# number of decompressed chunks kept in memory per array (e.g., for reading a run block by block)
+CACHED_CHUNKS = 64
+
+
+def _compress(data: bytes, codec: str):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    return zlib.compress(data, 1)
+
+
+def _decompress(data: bytes, codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("the archive is compressed with zstd, install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_chunk(chunk: np.ndarray, delta_axis: int = None, codec: str = "zlib"):
+    """
+    Compresses a chunk with the delta and byte shuffle filters
+
+    Args:
+        chunk (np.ndarray): values of the chunk
+        delta_axis (int, optional): axis along which consecutive values are subtracted. Defaults to None (no delta).
+        codec (str, optional): 'zlib' or 'zstd'. Defaults to 'zlib'.
+
+    Returns:
+        bytes: the compressed chunk
+    """
+    values = np.ascontiguousarray(chunk).view(f"u{chunk.dtype.itemsize}")
+    if delta_axis is not None:
+        values = np.diff(values, axis=delta_axis, prepend=np.zeros_like(values.take([0], axis=delta_axis)))
+    shuffled = values.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T
+    return _compress(np.ascontiguousarray(shuffled).tobytes(), codec)
+
+
+def decode_chunk(data: bytes, shape: tuple, dtype: np.dtype, delta_axis: int = None, codec: str = "zlib"):
+    """
+    Decompresses a chunk written by encode_chunk
+
+    Args:
+        data (bytes): the compressed chunk
+        shape (tuple): shape of the chunk
+        dtype (np.dtype): data type of the values
+        delta_axis (int, optional): axis along which consecutive values were subtracted. Defaults to None (no delta).
+        codec (str, optional): 'zlib' or 'zstd'. Defaults to 'zlib'.
+
+    Returns:
+        np.ndarray: values of the chunk
+    """
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(_decompress(data, codec), dtype=np.uint8).reshape(dtype.itemsize, -1)
+    values = np.ascontiguousarray(shuffled.T).view(f"u{dtype.itemsize}").reshape(shape)
+    if delta_axis is not None:
+        values = np.cumsum(values, axis=delta_axis, dtype=values.dtype)
+    return values.view(dtype)
+
+
+def save_chunked(fn: str, array: np.ndarray, chunks: tuple, delta_axis: int = None, codec: str = None):
+    """
+    Writes an array as compressed chunks
+
+    The array is read chunk by chunk, such that a memory-mapped array is never loaded as a whole. The file is written
+    under a temporary name and renamed when it is complete.
+
+    Args:
+        fn (str): path of the .npc file
+        array (np.ndarray): numeric array (e.g., a memory map)
+        chunks (tuple): shape of a chunk, per axis (None for the full axis)
+        delta_axis (int, optional): axis along which consecutive values are subtracted, e.g., the time axis. Defaults
+            to None (no delta).
+        codec (str, optional): 'zlib' or 'zstd'. Defaults to None (zstd if the zstandard package is installed).
+
+    Returns:
+        str: path of the .npc file
+    """
+    codec = codec or ("zstd" if zstandard is not None else "zlib")
+    chunks = tuple(min(chunk or size, size) or 1 for chunk, size in zip(chunks, array.shape))
+    grid = [range(0, size, chunk) for size, chunk in zip(array.shape, chunks)]
+    if delta_axis is not None:
+        delta_axis %= array.ndim
+
+    offsets = [len(MAGIC)]
+    with open(fn + ".tmp", "wb") as fid:
+        fid.write(MAGIC)
+        for start in itertools.product(*grid):
+            block = array[tuple(slice(begin, begin + chunk) for begin, chunk in zip(start, chunks))]
+            fid.write(encode_chunk(np.asarray(block), delta_axis, codec))
+            offsets.append(fid.tell())
+
+        index = {"shape": list(array.shape), "dtype": np.dtype(array.dtype).str, "chunks": list(chunks),
+                 "delta_axis": delta_axis, "codec": codec, "offsets": offsets}
+        fid.write(json.dumps(index).encode())
+        fid.write(np.uint64(offsets[-1]).tobytes())
+    os.replace(fn + ".tmp", fn)
+    return fn
+
+
+class ChunkedArray:
+    """
+    Read-only array backed by an .npc file, decompressing only the chunks that are indexed
+
+    Supports the shape, dtype, ndim, size and nbytes attributes, len(), indexing with integers, slices, lists or
+    boolean masks per axis (e.g., X[trials], X[:, channels] or X[0, :, :120]), and np.asarray (the whole array).
+
+    Args:
+        fn (str): path of the .npc file
+    """
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        with open(fn, "rb") as fid:
+            if fid.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{os.path.basename(fn)} is not a chunked archive")
+            fid.seek(-8, io.SEEK_END)
+            end = fid.tell()
+            start = int(np.frombuffer(fid.read(8), dtype=np.uint64)[0])
+            fid.seek(start)
+            index = json.loads(fid.read(end - start))
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.chunks = tuple(index["chunks"])
+        self.delta_axis = index["delta_axis"]
+        self.codec = index["codec"]
+        self._offsets = index["offsets"]
+        self._grid = tuple(-(-size // chunk) for size, chunk in zip(self.shape, self.chunks))
+        self._cache = OrderedDict()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"ChunkedArray({os.path.basename(self.fn)}, shape={self.shape}, dtype={self.dtype})"
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def _read_chunk(self, position: tuple):
+        i_chunk = int(np.ravel_multi_index(position, self._grid))
+        if i_chunk in self._cache:
+            self._cache.move_to_end(i_chunk)
+            return self._cache[i_chunk]
+
+        with open(self.fn, "rb") as fid:
+            fid.seek(self._offsets[i_chunk])
+            data = fid.read(self._offsets[i_chunk + 1] - self._offsets[i_chunk])
+        shape = tuple(min(chunk, size - index * chunk)
+                      for chunk, size, index in zip(self.chunks, self.shape, position))
+        block = decode_chunk(data, shape, self.dtype, self.delta_axis, self.codec)
+        self._cache[i_chunk] = block
+        if len(self._cache) > CACHED_CHUNKS:
+            self._cache.popitem(last=False)
+        return block
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            i_ellipsis = next(i for i, item in enumerate(key) if item is Ellipsis)
+            key = key[:i_ellipsis] + (slice(None),) * (self.ndim - len(key) + 1) + key[i_ellipsis + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # the selected indices per axis, integers drop their axis
+        indices, drop = [], []
+        for axis, (item, size) in enumerate(zip(key, self.shape)):
+            index = np.arange(size)[item]
+            if index.ndim == 0:
+                drop.append(axis)
+            indices.append(np.atleast_1d(index))
+
+        out = np.empty([len(index) for index in indices], dtype=self.dtype)
+        positions = [index // chunk for index, chunk in zip(indices, self.chunks)]
+        for position in itertools.product(*[np.unique(position) for position in positions]):
+            block = self._read_chunk(position)
+            sel_out = [np.flatnonzero(axis_positions == p) for axis_positions, p in zip(positions, position)]
+            sel_block = [index[sel] - p * chunk
+                         for index, sel, p, chunk in zip(indices, sel_out, position, self.chunks)]
+            out[np.ix_(*sel_out)] = block[np.ix_(*sel_block)]
+        return out.squeeze(axis=tuple(drop)) if drop else out
+
+
+if __name__ == "__main__":
+    import glob
+    from dataset import archive_derivative, get_x_path
+    from xdf_reader import compress_mirror
+    from read_and_preprocess_data import data_path
+
+    for fn in sorted(glob.glob(os.path.join(data_path, "derivatives", "*", "*.npz"))):
+        if os.path.isfile(get_x_path(fn)):
+            size = os.path.getsize(get_x_path(fn))
+            fn_x = archive_derivative(fn)
+            print(f"compressed {os.path.basename(fn_x)}: {size / os.path.getsize(fn_x):.2f}x")
+    for fn in sorted(glob.glob(os.path.join(data_path, "raw", "sub-*", "*", "eeg", "*.xdf"))):
+        if compress_mirror(fn):
+            print(f"compressed the mirror of {os.path.basename(fn)}")
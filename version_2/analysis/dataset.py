@@ -0,0 +1,241 @@
+"""
+Derivative layout of the preprocessed data and a lazy dataset on top of it
+
+The preprocessed data of a subject and condition is stored as two files in derivatives/{subject}:
+    {subject}_cvep_{condition}_{code}_X.npy: the eeg data (trials x channels x samples) as a raw float32 .npy file, or
+        {subject}_cvep_{condition}_{code}_X.npc when it is compressed (see chunked_archive.py), in chunks of one trial
+        and 8 channels
+    {subject}_cvep_{condition}_{code}.npz: the small arrays (y, V, fs) and the settings the data was preprocessed with
+
+The eeg data is opened as a read-only memory map (or a ChunkedArray, which is indexed the same way), such that only the
+trials (and channels) that are used are read from disk.
+"""
+import os
+import json
+import numpy as np
+from chunked_archive import save_chunked, ChunkedArray
+
+# chunk of the compressed eeg data: one trial and 8 channels, all samples
+X_CHUNKS = (1, 8, None)
+
+
+def get_derivative_path(data_path: str, subject: str, condition: str, code: str):
+    """
+    Returns the path of the preprocessed data (sidecar) of a subject and condition
+
+    Args:
+        data_path (str): path for raw data
+        subject (str): subject name
+        condition (str): condition, e.g., 'overt' or 'covert', with the name of the preprocessing variant appended
+            for other than the default variant, e.g., 'covert_lp20'
+        code (str): name of the code used
+
+    Returns:
+        str: path of the npz file
+    """
+    return os.path.join(data_path, "derivatives", subject, f"{subject}_cvep_{condition}_{code}.npz")
+
+
+def get_x_path(fn: str, compressed: bool = False):
+    """
+    Returns the path of the eeg data belonging to a derivative
+
+    Args:
+        fn (str): path of the npz file of the derivative
+        compressed (bool, optional): the path of the compressed eeg data. Defaults to False.
+
+    Returns:
+        str: path of the npy file with the eeg data (..._mgold_61_6521.npz -> ..._mgold_61_6521_X.npy), or of the npc
+            file if compressed
+    """
+    return os.path.splitext(fn)[0] + ("_X.npc" if compressed else "_X.npy")
+
+
+def save_x(fn: str, X: np.ndarray, compress: bool = False):
+    """
+    Writes the eeg data of a derivative, and removes it in the other format
+
+    Args:
+        fn (str): path of the npz file of the derivative
+        X (np.ndarray): eeg data (trials x channels x samples)
+        compress (bool, optional): write it compressed, in chunks of X_CHUNKS. Defaults to False.
+    """
+    if compress:
+        save_chunked(get_x_path(fn, compressed=True), X.astype("float32", copy=False), X_CHUNKS, delta_axis=-1)
+    else:
+        np.save(get_x_path(fn), X.astype("float32", copy=False))
+    if os.path.isfile(get_x_path(fn, compressed=not compress)):
+        os.remove(get_x_path(fn, compressed=not compress))
+
+
+def open_x(fn: str, mmap: bool = True):
+    """
+    Opens the eeg data of a derivative, in whichever format it is stored
+
+    Args:
+        fn (str): path of the npz file of the derivative
+        mmap (bool, optional): open the npy file as a read-only memory map. Defaults to True.
+
+    Returns:
+        np.ndarray | ChunkedArray: eeg data (trials x channels x samples), None if it does not exist
+    """
+    if os.path.isfile(get_x_path(fn)):
+        return np.load(get_x_path(fn), mmap_mode="r" if mmap else None)
+    if os.path.isfile(get_x_path(fn, compressed=True)):
+        X = ChunkedArray(get_x_path(fn, compressed=True))
+        return X if mmap else np.asarray(X)
+    return None
+
+
+def archive_derivative(fn: str):
+    """
+    Compresses the eeg data of a saved derivative (see chunked_archive.py), leaving its sidecar as it is
+
+    Args:
+        fn (str): path of the npz file of the derivative
+
+    Returns:
+        str: path of the npc file with the eeg data
+    """
+    fn_x = get_x_path(fn, compressed=True)
+    if os.path.isfile(get_x_path(fn)):
+        save_chunked(fn_x, np.load(get_x_path(fn), mmap_mode="r"), X_CHUNKS, delta_axis=-1)
+        os.remove(get_x_path(fn))
+    return fn_x
+
+
+def save_derivative(fn: str, X: np.ndarray, y: np.ndarray, V: np.ndarray, fs: int, settings: dict = None,
+                    compress: bool = False):
+    """
+    Saves the preprocessed data of a subject and condition, together with the settings it was preprocessed with
+
+    Args:
+        fn (str): path of the npz file
+        X (np.ndarray): eeg data (trials x channels x samples)
+        y (np.ndarray): trial labels
+        V (np.ndarray): codes (codes x samples)
+        fs (int): sampling frequency of X and V
+        settings (dict, optional): preprocessing parameters and excluded ICA components. Defaults to None.
+        compress (bool, optional): compress the eeg data (see chunked_archive.py). Defaults to False.
+    """
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    save_x(fn, X, compress)
+
+    # the sidecar is written last, as it marks the derivative as complete
+    np.savez(fn, y=y, V=V, fs=fs, settings=json.dumps(settings))
+
+
+def load_derivative(fn: str, mmap: bool = True):
+    """
+    Loads the preprocessed data of a subject and condition
+
+    Derivatives in the older layout, with X inside the npz file, are read into memory instead.
+
+    Args:
+        fn (str): path of the npz file
+        mmap (bool, optional): open X as a read-only memory map (a ChunkedArray if it is compressed). Defaults to True.
+
+    Returns:
+        dict: X (trials x channels x samples), y (trials), V (codes x samples), fs and settings (dict or None)
+    """
+    with np.load(fn) as tmp:
+        derivative = {name: tmp[name] for name in tmp.files}
+    derivative["fs"] = derivative["fs"].item()
+    derivative["settings"] = json.loads(derivative["settings"].item()) if "settings" in derivative else None
+    if "X" not in derivative:
+        derivative["X"] = open_x(fn, mmap)
+    return derivative
+
+
+class _Field:
+    """
+    Indexes one field of the derivatives of a dataset by [subject, condition]
+    """
+
+    def __init__(self, dataset, name: str):
+        self._dataset = dataset
+        self._name = name
+
+    def __getitem__(self, key):
+        subject, condition = key
+        return self._dataset.load(subject, condition)[self._name]
+
+
+class CvepDataset:
+    """
+    Lazy access to the preprocessed data of all subjects and conditions
+
+    The fields are indexed by subject (name or index) and condition, e.g., dataset.X["VPpdia", "covert"] or
+    dataset.y[0, "overt"]. A derivative is opened the first time one of its fields is accessed, with X as a read-only
+    memory map. The derivatives are either the files listed per condition (fns, e.g., the file names in the analysis
+    parameters) or named after code (see get_derivative_path).
+
+    Args:
+        derivatives_path (str): path of the derivatives folder (holding one folder per subject)
+        subjects (list): subject names
+        code (str, optional): name of the code used, as in the preprocessing parameters. Defaults to None (fns).
+        conditions (list, optional): conditions. Defaults to ['overt', 'covert'].
+        mmap (bool, optional): open X as a read-only memory map. Defaults to True.
+        fns (dict, optional): condition -> file names of the derivatives (sidecars) in the folders of the subjects, in
+            the order of subjects. Defaults to None (named after code).
+    """
+
+    def __init__(self, derivatives_path: str, subjects: list, code: str = None, conditions: list = ('overt', 'covert'),
+                 mmap: bool = True, fns: dict = None):
+        if code is None and fns is None:
+            raise ValueError("either the code or the file names of the derivatives are needed")
+        self.derivatives_path = derivatives_path
+        self.subjects = list(subjects)
+        self.code = code
+        self.conditions = list(conditions)
+        self.mmap = mmap
+        self.fns = None if fns is None else {condition: list(names) for condition, names in fns.items()}
+        self._derivatives = {}
+
+        self.X = _Field(self, "X")
+        self.y = _Field(self, "y")
+        self.V = _Field(self, "V")
+        self.fs = _Field(self, "fs")
+        self.settings = _Field(self, "settings")
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def get_path(self, subject, condition: str):
+        """
+        Returns the path of the derivative (sidecar) of a subject and condition
+
+        Args:
+            subject (str | int): subject name or index
+            condition (str): condition, e.g., 'overt' or 'covert'
+
+        Returns:
+            str: path of the npz file
+        """
+        i_subject = subject if isinstance(subject, (int, np.integer)) else self.subjects.index(subject)
+        subject = self.subjects[i_subject]
+        if self.fns is not None:
+            return os.path.join(self.derivatives_path, subject, self.fns[condition][i_subject])
+        return os.path.join(self.derivatives_path, subject, f"{subject}_cvep_{condition}_{self.code}.npz")
+
+    def load(self, subject, condition: str):
+        """
+        Returns the derivative of a subject and condition, opening it on first access
+
+        Args:
+            subject (str | int): subject name or index
+            condition (str): condition, e.g., 'overt' or 'covert'
+
+        Returns:
+            dict: X, y, V, fs and settings (see load_derivative)
+        """
+        fn = self.get_path(subject, condition)
+        if fn not in self._derivatives:
+            self._derivatives[fn] = load_derivative(fn, self.mmap)
+        return self._derivatives[fn]
+
+    def release(self):
+        """
+        Closes all opened derivatives (and their memory maps)
+        """
+        self._derivatives = {}
@@ -0,0 +1,703 @@
+"""
+Decoding of the preprocessed data with the reconvolution CCA (rCCA) of pyntbci
+
+accuracy_across_folds fits a pyntbci.classifiers.rCCA on the trials of all but one fold of a chronological
+cross-validation and tests it on the remaining fold, for every fold. Every fit and test passes over the eeg data again.
+
+The functions below compute the sufficient statistics of the rCCA per trial instead, in a single pass over the data
+(get_trial_statistics): the sums and products of the channels, and their products with the structure matrix (the
+lagged events of the codes, see pyntbci.utilities.structure_matrix) and with the templates' structure matrix of every
+class. The covariances of any set of training trials are sums of those of its trials, from which the rCCA is solved as
+in pyntbci.transformers.CCA (version 0.2.3, see requirements.txt): the features are standardized, and the spatial filter
+and the transient responses are the first pair of canonical vectors. A test trial is scored by the correlation of its
+spatially filtered data with the (zero-mean) templates of the classes, as in rCCA.decision_function, which is computed
+from its statistics as well. The correlation does not depend on the offset or the scale of either, such that the
+predictions equal those of accuracy_across_folds, while the cost of a cross-validation (k-fold, leave-one-run-out or
+repeated) depends on the number of folds rather than on the size of the data.
+
+The structure matrix of a shorter transient size holds the first lags of every event of a longer one, such that the
+statistics of the longest transient size serve all shorter ones (see sweep_transient_sizes).
+
+A decoding curve (decoding_curve) scores the test trials on their first samples for a range of segment lengths. rCCA
+removes the mean of the data and the templates over the segment, which only leaves sums over the segment in the
+correlation: these are cumulative sums over time (get_cumulative_scores), such that every segment length is scored
+from one projection of the test trials. mean_decoding_curve does the same for an LDA on the channel means over the
+segment (e.g., of the eye-tracking data), from cumulative sums over time.
+
+The permutation test (permutation_test) cross-validates the rCCA with shuffled labels. Of the covariances of a fold,
+only the one of the channels with the structure matrix depends on the labels, and that of the structure matrix only on
+the number of trials per class. These are cached per fold, and a batch of permutations is fitted and scored at once
+(cross_validate_batch). The batches are spread over worker processes, each with its own random stream, and the test
+stops as soon as the p-value is clearly below or above alpha. The batches are checked in the order of their random
+streams, such that the result does not depend on the number of workers.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.linalg import inv, sqrtm, svd
+from scipy import stats as sp_stats
+from matplotlib import pyplot as plt
+import pyntbci
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+
+# statistics of the trials in a worker process of the permutation test, see _init_permutation_worker
+_worker_stats = None
+
+
+def get_folds(n_trials: int, n_folds: int):
+    """
+    Returns the fold of every trial of a chronological cross-validation
+
+    Args:
+        n_trials (int): number of trials
+        n_folds (int): number of folds
+
+    Returns:
+        np.ndarray: fold per trial, the trials that do not fill a fold are left out
+    """
+    return np.repeat(np.arange(n_folds), int(n_trials / n_folds))
+
+
+def accuracy_across_folds(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size: float,
+                          trial_time: int, n_folds: int = 4, plot: bool = False):
+    """
+    Computes classification accuracy for n = n_folds
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples)
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        n_folds (int, optional): number of folds for cross-validation. Defaults to 4.
+        plot (bool, optional): plot the accuracy per fold. Defaults to False.
+
+    Returns:
+        np.array: row vector containing accuracies of n_folds
+    """
+    n_samples = int(trial_time * fs)
+    n_classes = codes.shape[0]
+
+    # Chronological cross-validation
+    folds = get_folds(X.shape[0], n_folds)
+
+    # Loop folds over different transient sizes
+    accuracy = np.zeros(n_folds)
+
+    for i_fold in range(n_folds):
+
+        # Split data to train and test set
+        X_trn, y_trn = X[folds != i_fold, :, :n_samples], y[folds != i_fold]
+        X_tst, y_tst = X[folds == i_fold, :, :n_samples], y[folds == i_fold]
+
+        # Train template-matching classifier
+        rcca = pyntbci.classifiers.rCCA(codes=codes, fs=fs, event="duration", transient_size=transient_size,
+                                        onset_event=True)
+        rcca.fit(X_trn, y_trn)
+
+        # Apply template-matching classifier
+        yh_tst = rcca.predict(X_tst)
+
+        # Compute accuracy
+        accuracy[i_fold] = np.mean(yh_tst == y_tst)
+
+    if plot:
+        plt.figure(figsize=(15, 3))
+        plt.bar(np.arange(n_folds), accuracy)
+        plt.axhline(accuracy.mean(), linestyle='--', alpha=0.5, label="average")
+        plt.axhline(1 / n_classes, color="k", linestyle="--", alpha=0.5, label="chance")
+        plt.xlabel("(test) fold")
+        plt.ylabel("accuracy")
+        plt.legend()
+        plt.title("Chronological cross-validation")
+        plt.tight_layout()
+
+    return accuracy
+
+
+def get_structure_matrix(codes: np.ndarray, fs: int, transient_size: float, n_samples: int, event: str = "duration",
+                         onset_event: bool = True):
+    """
+    Returns the structure matrix of the codes for trials of n_samples, as rCCA builds it
+
+    Args:
+        codes (np.ndarray): codes (classes x samples), one cycle
+        fs (int): sampling frequency
+        transient_size (float): duration of the transient response in seconds
+        n_samples (int): number of samples of the trials
+        event (str, optional): event definition, see pyntbci.utilities.event_matrix. Defaults to 'duration'.
+        onset_event (bool, optional): add an event for the onset of the trial. Defaults to True.
+
+    Returns:
+        np.ndarray: structure matrix (classes x events * transient samples x samples), the lags of an event in a row
+            each, event by event
+    """
+    codes = np.tile(codes, (1, int(np.ceil(n_samples / codes.shape[1]))))
+    E = pyntbci.utilities.event_matrix(codes, event, onset_event)[0]
+    return pyntbci.utilities.structure_matrix(E, int(transient_size * fs))[:, :, :n_samples]
+
+
+def get_lag_rows(n_events: int, n_lags: int, max_lags: int):
+    """
+    Returns the rows of a structure matrix with max_lags lags per event that make up the one with n_lags
+
+    Args:
+        n_events (int): number of events
+        n_lags (int): number of lags (transient samples) per event
+        max_lags (int): number of lags per event of the structure matrix
+
+    Returns:
+        np.ndarray: indices of the rows
+    """
+    return (np.arange(n_events)[:, None] * max_lags + np.arange(n_lags)[None, :]).flatten()
+
+
+def solve_rcca(C: np.ndarray, n_channels: int):
+    """
+    Solves the rCCA from the covariance of the channels and the rows of the structure matrix
+
+    The covariances are standardized and the first pair of canonical vectors is found as in pyntbci.transformers.CCA,
+    they are returned on the scale of the channels and rows themselves.
+
+    Args:
+        C (np.ndarray): covariance of the channels followed by the rows of the structure matrix
+        n_channels (int): number of channels
+
+    Returns:
+        tuple: spatial filter (channels) and transient responses (rows of the structure matrix)
+    """
+    sigma = np.sqrt(np.diag(C))
+    R = C / np.outer(sigma, sigma)
+    iCxx = np.real(inv(sqrtm(R[:n_channels, :n_channels])))
+    iCmm = np.real(inv(sqrtm(R[n_channels:, n_channels:])))
+    U, _, Vh = svd(iCxx @ R[:n_channels, n_channels:] @ iCmm)
+    return iCxx @ U[:, 0] / sigma[:n_channels], iCmm @ Vh[0] / sigma[n_channels:]
+
+
+def get_template_matrix(codes: np.ndarray, fs: int, transient_size: float, n_samples: int, event: str = "duration",
+                        onset_event: bool = True, zero_mean: bool = True):
+    """
+    Returns the structure matrix of the templates for trials of n_samples, as rCCA predicts them
+
+    The templates are predicted from two code cycles, the first one followed by the second one repeated.
+
+    Args:
+        codes (np.ndarray): codes (classes x samples), one cycle
+        fs (int): sampling frequency
+        transient_size (float): duration of the transient response in seconds
+        n_samples (int): number of samples of the trials
+        event (str, optional): event definition, see pyntbci.utilities.event_matrix. Defaults to 'duration'.
+        onset_event (bool, optional): add an event for the onset of the trial. Defaults to True.
+        zero_mean (bool, optional): subtract the mean over time, as rCCA does for the templates of n_samples. Defaults
+            to True.
+
+    Returns:
+        np.ndarray: structure matrix (classes x events * transient samples x samples), the templates are its rows
+            weighted by the transient responses
+    """
+    n_cycle = codes.shape[1]
+    M = get_structure_matrix(codes, fs, transient_size, 2 * n_cycle, event, onset_event).astype("float64")
+    M_start, M_wrap = M[:, :, :n_cycle], M[:, :, n_cycle:]
+    if n_samples != n_cycle:
+        n = int(np.ceil(n_samples / n_cycle))
+        M_start = np.concatenate((M_start, np.tile(M_wrap, (1, 1, max(n - 1, 1)))), axis=2)[:, :, :n_samples]
+    return M_start - M_start.mean(axis=2, keepdims=True) if zero_mean else M_start
+
+
+def get_trial_statistics(X: np.ndarray, codes: np.ndarray, fs: int, transient_size: float, trial_time: int,
+                         event: str = "duration", onset_event: bool = True):
+    """
+    Computes the sufficient statistics of the rCCA per trial, in a single pass over the data
+
+    The products with the structure matrices are computed for every class, such that the trials can be fitted and
+    scored with any labels.
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds, the longest one to be fitted
+        trial_time (int): duration for which codes were flashing on the screen
+        event (str, optional): event definition, see pyntbci.utilities.event_matrix. Defaults to 'duration'.
+        onset_event (bool, optional): add an event for the onset of the trial. Defaults to True.
+
+    Returns:
+        dict: the statistics
+            n_samples, n_events, n_lags (int): samples per trial, events and lags per event of the structure matrix
+            sum_x: sums of the channels (trials x channels)
+            sum_xx: products of the channels (trials x channels x channels)
+            sum_xm: products of the channels with the structure matrix of every class (trials x classes x channels x
+                rows)
+            sum_xt: products of the channels with the template matrix of every class (trials x classes x channels x
+                rows), see get_template_matrix
+            sum_m, sum_mm: sums and products of the structure matrix per class (classes x rows, classes x rows x rows)
+            sum_tt: products of the template matrix per class (classes x rows x rows)
+    """
+    n_samples = int(trial_time * fs)
+    n_lags = int(transient_size * fs)
+    M = get_structure_matrix(codes, fs, transient_size, n_samples, event, onset_event).astype("float64")
+    T = get_template_matrix(codes, fs, transient_size, n_samples, event, onset_event)
+    n_classes, n_rows = M.shape[:2]
+    n_trials, n_channels = X.shape[:2]
+
+    # the structure matrices of all classes side by side, such that a trial takes a single product
+    MT = np.concatenate((M, T)).transpose(2, 0, 1).reshape(n_samples, 2 * n_classes * n_rows)
+    stats = {"n_samples": n_samples, "n_events": n_rows // n_lags, "n_lags": n_lags,
+             "sum_x": np.zeros((n_trials, n_channels)), "sum_xx": np.zeros((n_trials, n_channels, n_channels)),
+             "sum_xm": np.zeros((n_trials, n_classes, n_channels, n_rows)),
+             "sum_xt": np.zeros((n_trials, n_classes, n_channels, n_rows)),
+             "sum_m": M.sum(axis=2), "sum_mm": np.einsum("crs,cqs->crq", M, M),
+             "sum_tt": np.einsum("crs,cqs->crq", T, T)}
+    for i_trial in range(n_trials):
+        x = np.asarray(X[i_trial, :, :n_samples], dtype="float64")
+        stats["sum_x"][i_trial] = x.sum(axis=1)
+        stats["sum_xx"][i_trial] = x @ x.T
+        xm = (x @ MT).reshape(n_channels, 2, n_classes, n_rows).transpose(1, 2, 0, 3)
+        stats["sum_xm"][i_trial], stats["sum_xt"][i_trial] = xm
+    return stats
+
+
+def fit_rcca(stats: dict, y: np.ndarray, trials: np.ndarray, n_lags: int = None):
+    """
+    Fits the rCCA on a set of trials from their statistics
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+        y (np.ndarray): labels of all trials
+        trials (np.ndarray): indices of the training trials
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        tuple: spatial filter (channels) and transient responses (events * n_lags)
+    """
+    rows = get_lag_rows(stats["n_events"], n_lags or stats["n_lags"], stats["n_lags"])
+    n_channels = stats["sum_x"].shape[1]
+    n_class = np.bincount(y[trials], minlength=stats["sum_m"].shape[0])
+    n_total = len(trials) * stats["n_samples"]
+
+    # covariance of the channels and the rows of the structure matrix
+    sum_xm = stats["sum_xm"][trials, y[trials]].sum(axis=0)[:, rows]
+    mu = np.concatenate((stats["sum_x"][trials].sum(axis=0), n_class @ stats["sum_m"][:, rows])) / n_total
+    C = np.block([[stats["sum_xx"][trials].sum(axis=0), sum_xm],
+                  [sum_xm.T, np.einsum("c,crq->rq", n_class, stats["sum_mm"][:, rows][:, :, rows])]])
+    C = (C - n_total * np.outer(mu, mu)) / (n_total - 1)
+    return solve_rcca(C, n_channels)
+
+
+def score_rcca(stats: dict, w: np.ndarray, r: np.ndarray, trials: np.ndarray, n_lags: int = None):
+    """
+    Scores a set of trials from their statistics, as rCCA.decision_function
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+        w (np.ndarray): spatial filter (channels)
+        r (np.ndarray): transient responses (events * n_lags)
+        trials (np.ndarray): indices of the test trials
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        np.ndarray: correlation of the spatially filtered trials with the templates (trials x classes)
+    """
+    rows = get_lag_rows(stats["n_events"], n_lags or stats["n_lags"], stats["n_lags"])
+    sum_x = stats["sum_x"][trials] @ w
+    var_x = np.einsum("c,tcd,d->t", w, stats["sum_xx"][trials], w) - sum_x ** 2 / stats["n_samples"]
+    var_t = np.einsum("r,crq,q->c", r, stats["sum_tt"][:, rows][:, :, rows], r)
+    cov = np.einsum("c,tkcr->tkr", w, stats["sum_xt"][trials][:, :, :, rows]) @ r
+    return cov / np.sqrt(var_x[:, None] * var_t[None, :])
+
+
+def get_run_folds(settings: dict):
+    """
+    Returns the fold of every trial of a leave-one-run-out cross-validation
+
+    Args:
+        settings (dict): settings of the derivative, listing the trials per run (see bad_data.clean_epochs)
+
+    Returns:
+        np.ndarray: run per trial
+    """
+    return np.repeat(np.arange(len(settings["bads"])), [len(bads["trials"]) for bads in settings["bads"]])
+
+
+def get_repeated_folds(n_trials: int, n_folds: int, n_repeats: int, seed: int = None):
+    """
+    Returns the folds of a repeated cross-validation, the trials are shuffled anew for every repeat
+
+    Args:
+        n_trials (int): number of trials
+        n_folds (int): number of folds
+        n_repeats (int): number of repeats
+        seed (int, optional): seed of the random number generator. Defaults to None.
+
+    Returns:
+        np.ndarray: fold per repeat and trial (repeats x trials), -1 for the trials that do not fill a fold
+    """
+    rng = np.random.default_rng(seed)
+    folds = np.full((n_repeats, n_trials), -1)
+    for i_repeat in range(n_repeats):
+        folds[i_repeat, rng.permutation(n_trials)[:n_folds * (n_trials // n_folds)]] = \
+            np.repeat(np.arange(n_folds), n_trials // n_folds)
+    return folds
+
+
+def cross_validate(stats: dict, y: np.ndarray, folds: np.ndarray, n_lags: int = None):
+    """
+    Computes the classification accuracy per fold from the statistics of the trials
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+        y (np.ndarray): labels of the trials
+        folds (np.ndarray): fold per trial (e.g., get_folds or get_run_folds), or per repeat and trial (see
+            get_repeated_folds). Trials with a negative fold, or beyond the end of folds, are left out.
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        np.ndarray: accuracy per fold (folds), or per repeat and fold (repeats x folds)
+    """
+    repeats = np.atleast_2d(folds)
+    accuracy = np.zeros((repeats.shape[0], repeats.max() + 1))
+    for i_repeat, repeat in enumerate(repeats):
+        for i_fold in range(accuracy.shape[1]):
+            trn, tst = np.flatnonzero((repeat != i_fold) & (repeat >= 0)), np.flatnonzero(repeat == i_fold)
+            w, r = fit_rcca(stats, y, trn, n_lags)
+            accuracy[i_repeat, i_fold] = np.mean(np.argmax(score_rcca(stats, w, r, tst, n_lags), axis=1) == y[tst])
+    return accuracy if np.ndim(folds) == 2 else accuracy[0]
+
+
+def sweep_transient_sizes(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size_vec: np.ndarray,
+                          trial_time: int, n_folds: int = 4):
+    """
+    Computes the classification accuracy per fold for every transient size, as accuracy_across_folds
+
+    The statistics of the trials are computed once, for the longest transient size, and the rCCA of every transient
+    size is fitted from their subset.
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size_vec (np.ndarray): durations of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        n_folds (int, optional): number of folds for cross-validation. Defaults to 4.
+
+    Returns:
+        np.ndarray: accuracy per transient size and fold (transient sizes x folds)
+    """
+    stats = get_trial_statistics(X, codes, fs, max(transient_size_vec), trial_time)
+    folds = get_folds(X.shape[0], n_folds)
+    return np.stack([cross_validate(stats, y, folds, int(transient_size * fs))
+                     for transient_size in transient_size_vec])
+
+
+def cross_validate_batch(stats: dict, Y: np.ndarray, folds: np.ndarray, n_lags: int = None):
+    """
+    Computes the classification accuracy per fold for a batch of label sets at once, as cross_validate
+
+    Per fold, the covariance of the channels is computed once, and that of the structure matrix once per number of
+    training trials per class. The cross-covariances of all label sets are summed from the statistics in one product,
+    and their canonical vectors are found with a batched SVD.
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+        Y (np.ndarray): label sets, e.g., permutations of the labels (sets x trials)
+        folds (np.ndarray): fold per trial (e.g., get_folds), trials with a negative fold, or beyond the end of folds,
+            are left out
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        np.ndarray: accuracy per label set and fold (sets x folds)
+    """
+    rows = get_lag_rows(stats["n_events"], n_lags or stats["n_lags"], stats["n_lags"])
+    n_samples = stats["n_samples"]
+    n_classes = stats["sum_m"].shape[0]
+    sum_m, sum_mm = stats["sum_m"][:, rows], stats["sum_mm"][:, rows][:, :, rows]
+    sum_tt = stats["sum_tt"][:, rows][:, :, rows]
+
+    accuracy = np.zeros((Y.shape[0], folds.max() + 1))
+    for i_fold in range(accuracy.shape[1]):
+        trn, tst = np.flatnonzero((folds != i_fold) & (folds >= 0)), np.flatnonzero(folds == i_fold)
+        n_total = len(trn) * n_samples
+
+        # covariance of the channels, the same for all label sets
+        mu_x = stats["sum_x"][trn].sum(axis=0) / n_total
+        Cxx = (stats["sum_xx"][trn].sum(axis=0) - n_total * np.outer(mu_x, mu_x)) / (n_total - 1)
+        sigma_x = np.sqrt(np.diag(Cxx))
+        iCxx = np.real(inv(sqrtm(Cxx / np.outer(sigma_x, sigma_x))))
+
+        # covariance of the structure matrix, per number of training trials per class
+        onehot = (Y[:, trn, None] == np.arange(n_classes)).astype("float64")
+        counts, i_counts = np.unique(onehot.sum(axis=1), axis=0, return_inverse=True)
+        i_counts = i_counts.flatten()
+        mu_m = counts @ sum_m / n_total
+        Cmm = (np.einsum("uc,crq->urq", counts, sum_mm) - n_total * mu_m[:, :, None] * mu_m[:, None, :]) / \
+            (n_total - 1)
+        sigma_m = np.sqrt(np.einsum("urr->ur", Cmm))
+        iCmm = np.stack([np.real(inv(sqrtm(C / np.outer(sigma, sigma)))) for C, sigma in zip(Cmm, sigma_m)])
+
+        # cross-covariances and canonical vectors of all label sets
+        sum_xm = np.einsum("pic,icxr->pxr", onehot, stats["sum_xm"][trn][:, :, :, rows], optimize=True)
+        Cxm = (sum_xm - n_total * mu_x[None, :, None] * mu_m[i_counts][:, None, :]) / (n_total - 1)
+        Rxm = Cxm / sigma_x[None, :, None] / sigma_m[i_counts][:, None, :]
+        U, _, Vh = np.linalg.svd(iCxx @ Rxm @ iCmm[i_counts])
+        W = U[:, :, 0] @ iCxx.T / sigma_x
+        R = np.einsum("prq,pq->pr", iCmm[i_counts], Vh[:, 0, :]) / sigma_m[i_counts]
+
+        # correlations of the test trials with the templates, as score_rcca
+        sum_x = W @ stats["sum_x"][tst].T
+        var_x = np.einsum("pc,tcd,pd->pt", W, stats["sum_xx"][tst], W, optimize=True) - sum_x ** 2 / n_samples
+        var_t = np.einsum("pr,crq,pq->pc", R, sum_tt, R, optimize=True)
+        cov = np.einsum("pc,tkcr,pr->ptk", W, stats["sum_xt"][tst][:, :, :, rows], R, optimize=True)
+        scores = cov / np.sqrt(var_x[:, :, None] * var_t[:, None, :])
+        accuracy[:, i_fold] = np.mean(np.argmax(scores, axis=2) == Y[:, tst], axis=1)
+    return accuracy
+
+
+def _init_permutation_worker(stats: dict):
+    """
+    Keeps the statistics of the trials in a worker process, such that they are sent once per worker
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+    """
+    global _worker_stats
+    _worker_stats = stats
+
+
+def _permutation_batch(y: np.ndarray, folds: np.ndarray, n_permutations: int, seed: np.random.SeedSequence,
+                       n_lags: int = None):
+    """
+    Computes the accuracy (averaged over the folds) of a batch of permutations of the labels
+
+    Args:
+        y (np.ndarray): labels of the trials
+        folds (np.ndarray): fold per trial
+        n_permutations (int): number of permutations
+        seed (np.random.SeedSequence): seed of the random stream of the batch
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        np.ndarray: accuracy per permutation
+    """
+    Y = np.random.default_rng(seed).permuted(np.tile(y, (n_permutations, 1)), axis=1)
+    return cross_validate_batch(_worker_stats, Y, folds, n_lags).mean(axis=1)
+
+
+def _is_decided(permuted: np.ndarray, observed: float, alpha: float, confidence: float):
+    """
+    Checks whether the Clopper-Pearson interval of the p-value lies entirely below or above alpha
+
+    Args:
+        permuted (np.ndarray): averaged accuracy per permutation computed so far
+        observed (float): the accuracy with the true labels
+        alpha (float): significance level
+        confidence (float): confidence of the interval
+
+    Returns:
+        bool: True if the p-value is clearly below or above alpha
+    """
+    n_done = len(permuted)
+    n_above = int(np.sum(permuted >= observed))
+    lower = sp_stats.beta.ppf((1 - confidence) / 2, n_above, n_done - n_above + 1) if n_above else 0.0
+    upper = sp_stats.beta.ppf(1 - (1 - confidence) / 2, n_above + 1, n_done - n_above) if n_above < n_done else 1.0
+    return upper < alpha or lower > alpha
+
+
+def permutation_test(stats: dict, y: np.ndarray, folds: np.ndarray, n_permutations: int = 1000, alpha: float = 0.05,
+                     confidence: float = 0.99, batch_size: int = 100, n_workers: int = 1, seed: int = None,
+                     n_lags: int = None):
+    """
+    Tests whether the cross-validated accuracy is above chance by permuting the labels
+
+    The permutations are computed in batches of batch_size, each with its own random stream (spawned from seed), on
+    n_workers processes. The batches are taken in the order of their streams, and after every batch the test stops if
+    the Clopper-Pearson interval (at confidence) of the p-value lies entirely below or above alpha, such that the
+    result does not depend on n_workers.
+
+    Args:
+        stats (dict): statistics of the trials, see get_trial_statistics
+        y (np.ndarray): labels of the trials
+        folds (np.ndarray): fold per trial, e.g., get_folds(len(y), n_folds)
+        n_permutations (int, optional): maximum number of permutations. Defaults to 1000.
+        alpha (float, optional): significance level. Defaults to 0.05.
+        confidence (float, optional): confidence of the interval of the p-value for stopping early, 1 to compute all
+            permutations. Defaults to 0.99.
+        batch_size (int, optional): number of permutations per batch. Defaults to 100.
+        n_workers (int, optional): number of worker processes, 1 to compute the batches in this process. Defaults to 1.
+        seed (int, optional): seed of the random number generator. Defaults to None.
+        n_lags (int, optional): transient size in samples. Defaults to None (that of the statistics).
+
+    Returns:
+        dict: observed (the accuracy averaged over the folds), permuted (the averaged accuracy per permutation),
+            pvalue ((1 + permutations at least as accurate) / (1 + permutations)) and n_permutations (computed)
+    """
+    observed = cross_validate(stats, y, folds, n_lags).mean()
+    sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    pool = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_permutation_worker, initargs=(stats,)) \
+        if n_workers > 1 else None
+    if pool is None:
+        _init_permutation_worker(stats)
+    permuted, finished, running = [], {}, {}
+    i_submit, decided = 0, False
+    try:
+        while not decided and len(permuted) < len(sizes):
+            if pool is None:
+                i_batch = len(permuted)
+                finished[i_batch] = _permutation_batch(y, folds, sizes[i_batch], seeds[i_batch], n_lags)
+            else:
+                # keep every worker busy, the batches finish in any order
+                while len(running) < n_workers and i_submit < len(sizes):
+                    future = pool.submit(_permutation_batch, y, folds, sizes[i_submit], seeds[i_submit], n_lags)
+                    running[future] = i_submit
+                    i_submit += 1
+                future = next(as_completed(running))
+                finished[running.pop(future)] = future.result()
+
+            # stop once the p-value is clearly decided, checked batch by batch in the order of the seeds
+            while not decided and len(permuted) in finished:
+                permuted.append(finished.pop(len(permuted)))
+                decided = _is_decided(np.concatenate(permuted), observed, alpha, confidence)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    permuted = np.concatenate(permuted)
+    pvalue = (1 + np.sum(permuted >= observed)) / (1 + len(permuted))
+    return {"observed": observed, "permuted": permuted, "pvalue": pvalue, "n_permutations": len(permuted)}
+
+
+def get_cumulative_scores(x: np.ndarray, T: np.ndarray, lengths: np.ndarray):
+    """
+    Correlates the spatially filtered trials with the templates over their first samples, for every length at once
+
+    The correlation over the first n samples, with the mean over those samples removed from both (as rCCA does for a
+    trial of n samples), is computed from the cumulative sums of x, x^2, T, T^2 and x * T.
+
+    Args:
+        x (np.ndarray): spatially filtered trials (trials x samples)
+        T (np.ndarray): templates, without removing their mean (classes x samples)
+        lengths (np.ndarray): numbers of samples from the start of the trial
+
+    Returns:
+        np.ndarray: correlation per trial, class and length (trials x classes x lengths)
+    """
+    # a constant offset does not change the correlations, removing the overall mean keeps the sums well-conditioned
+    x = x - x.mean(axis=1, keepdims=True)
+    T = T - T.mean(axis=1, keepdims=True)
+    i_last = np.asarray(lengths) - 1
+    sum_x, sum_xx = np.cumsum(x, axis=1)[:, i_last], np.cumsum(x ** 2, axis=1)[:, i_last]
+    sum_t, sum_tt = np.cumsum(T, axis=1)[:, i_last], np.cumsum(T ** 2, axis=1)[:, i_last]
+    sum_xt = np.cumsum(x[:, None, :] * T[None, :, :], axis=2)[:, :, i_last]
+
+    cov = sum_xt - sum_x[:, None, :] * sum_t[None, :, :] / lengths
+    var_x = sum_xx - sum_x ** 2 / lengths
+    var_t = sum_tt - sum_t ** 2 / lengths
+    return cov / np.sqrt(var_x[:, None, :] * var_t[None, :, :])
+
+
+def cross_validated_scores(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size: float,
+                           trial_time: int, folds: np.ndarray, lengths: np.ndarray, stats: dict = None):
+    """
+    Scores every trial over its first samples, for every length, with the rCCA fitted on the other folds
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        folds (np.ndarray): fold per trial, e.g., get_folds(len(y), n_folds), negative for trials that are left out
+        lengths (np.ndarray): numbers of samples from the start of the trial
+        stats (dict, optional): statistics of the trials for transient_size (or a longer one), see
+            get_trial_statistics. Defaults to None (computed here).
+
+    Returns:
+        np.ndarray: correlation per trial, class and length (trials x classes x lengths), NaN for the trials that are
+            left out
+    """
+    n_samples = int(trial_time * fs)
+    if stats is None:
+        stats = get_trial_statistics(X, codes, fs, transient_size, trial_time)
+    n_lags = int(transient_size * fs)
+    M = get_template_matrix(codes, fs, transient_size, n_samples, zero_mean=False)
+
+    scores = np.full((X.shape[0], codes.shape[0], len(lengths)), np.nan)
+    for i_fold in range(folds.max() + 1):
+        trn, tst = np.flatnonzero((folds != i_fold) & (folds >= 0)), np.flatnonzero(folds == i_fold)
+        if tst.size == 0:
+            continue
+        w, r = fit_rcca(stats, y, trn, n_lags)
+        x = np.stack([w @ np.asarray(X[i_trial, :, :n_samples], dtype="float64") for i_trial in tst])
+        scores[tst] = get_cumulative_scores(x, np.einsum("r,crs->cs", r, M), lengths)
+    return scores
+
+
+def decoding_curve(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size: float, trial_time: int,
+                   segment_time: float = 0.1, n_folds: int = 4, stats: dict = None):
+    """
+    Computes the classification accuracy per fold as a function of the length of the trials
+
+    Equals predicting the test trials of every fold cut to each segment length, X_tst[:, :, :int(fs * segment)], with
+    the rCCA of accuracy_across_folds. Note that pyntbci (0.2.3) removes the mean of its start template in place when
+    predicting a segment of exactly one code cycle, which changes its predictions of longer segments afterwards; the
+    scores here equal those of a fresh rCCA per segment.
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        segment_time (float, optional): step size of the decoding curve in seconds. Defaults to 0.1.
+        n_folds (int, optional): number of folds for cross-validation. Defaults to 4.
+        stats (dict, optional): statistics of the trials, see get_trial_statistics. Defaults to None (computed here).
+
+    Returns:
+        tuple: segment lengths in seconds (segments) and accuracy per fold and segment (folds x segments)
+    """
+    segments = np.arange(segment_time, trial_time, segment_time)
+    lengths = np.array([int(fs * segment) for segment in segments])
+    folds = get_folds(X.shape[0], n_folds)
+    scores = cross_validated_scores(X, y, codes, fs, transient_size, trial_time, folds, lengths, stats)
+    correct = np.argmax(scores[:len(folds)], axis=1) == y[:len(folds), None]
+    return segments, np.stack([correct[folds == i_fold].mean(axis=0) for i_fold in range(n_folds)])
+
+
+def mean_decoding_curve(X: np.ndarray, y: np.ndarray, fs: int, trial_time: int, segment_time: float = 0.1,
+                        n_folds: int = 4):
+    """
+    Computes the accuracy per fold of an LDA on the channel means as a function of the length of the trials
+
+    The LDA is fitted on the means over the whole training trials, and the test trials are classified by their means
+    over their first samples. These are cumulative sums over time, such that every segment length is scored from one
+    pass over the test trials (e.g., for the eye-tracking data, which carry no code-locked responses for an rCCA).
+
+    Args:
+        X (np.ndarray): data (trials x channels x samples), e.g., the gaze and pupil channels
+        y (np.ndarray): labels of trials
+        fs (int): sampling frequency
+        trial_time (int): duration of the trials in seconds
+        segment_time (float, optional): step size of the decoding curve in seconds. Defaults to 0.1.
+        n_folds (int, optional): number of folds for cross-validation. Defaults to 4.
+
+    Returns:
+        tuple: segment lengths in seconds (segments) and accuracy per fold and segment (folds x segments)
+    """
+    segments = np.arange(segment_time, trial_time + segment_time / 2, segment_time)
+    lengths = np.array([int(fs * segment) for segment in segments])
+    folds = get_folds(X.shape[0], n_folds)
+    means = np.cumsum(X[:, :, :lengths[-1]], axis=2)[:, :, lengths - 1] / lengths
+
+    accuracy = np.zeros((n_folds, len(segments)))
+    for i_fold in range(n_folds):
+        trn, tst = folds != i_fold, np.flatnonzero(folds == i_fold)
+        clf = LinearDiscriminantAnalysis()
+        clf.fit(X[:len(folds)][trn].mean(axis=2), y[:len(folds)][trn])
+        yh = clf.predict(means[tst].transpose(0, 2, 1).reshape(-1, X.shape[1])).reshape(tst.size, len(segments))
+        accuracy[i_fold] = np.mean(yh == y[tst, None], axis=0)
+    return segments, accuracy
+
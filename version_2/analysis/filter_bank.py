@@ -0,0 +1,234 @@
+"""
+Block-streaming IIR filter bank for the raw eeg data
+
+The band-pass and the notch filters at all line noise harmonics are combined into a single cascade of second-order
+sections (SOS). The cascade is run over the recording in fixed-size blocks, carrying the filter state from block to
+block, and the result is written back into the data array. Besides the data itself, only a few blocks are held in
+memory at once (one per thread).
+
+Two modes are available:
+    causal: a single forward pass, which only uses past samples (as an online filter would)
+    zero: a forward and a backward pass (zero-phase, same as mne with method='iir'), for offline use. The signal is
+        padded with its odd reflection at both ends, as done by mne, and the backward pass runs over the blocks in
+        reverse order.
+
+The trials are downsampled to the target rate with a polyphase filter (resample_epochs in preprocessing.py), of which
+the rational factors and the anti-alias filter are designed once per pair of rates (see get_resample_filter).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+from scipy import signal
+import mne
+
+
+def design_notch(sfreq: float, notch: float, notch_q: float = 30.0):
+    """
+    Designs the notch filters at the line noise frequency and all its harmonics below Nyquist
+
+    Args:
+        sfreq (float): sampling frequency in Hz
+        notch (float): line noise frequency in Hz
+        notch_q (float, optional): quality factor of the notch filters. Defaults to 30.
+
+    Returns:
+        np.ndarray: second-order sections (sections x 6), None if there is no harmonic below Nyquist
+    """
+    sos = [signal.tf2sos(*signal.iirnotch(freq, notch_q, fs=sfreq)) for freq in np.arange(notch, sfreq / 2, notch)]
+    return np.concatenate(sos, axis=0) if sos else None
+
+
+def design_filter_bank(sfreq: float, l_freq: float, h_freq: float, notch: float = None, order: int = 6,
+                       notch_q: float = 30.0):
+    """
+    Designs the cascade of the Butterworth band-pass and the notch filters
+
+    Args:
+        sfreq (float): sampling frequency in Hz
+        l_freq (float): lower edge of the pass band in Hz
+        h_freq (float): upper edge of the pass band in Hz
+        notch (float, optional): line noise frequency in Hz, all harmonics below Nyquist are notched. Defaults to None
+            (no notch filters).
+        order (int, optional): order of the Butterworth band-pass. Defaults to 6.
+        notch_q (float, optional): quality factor of the notch filters. Defaults to 30.
+
+    Returns:
+        tuple: second-order sections (sections x 6) and the number of samples to pad at each end in zero-phase mode
+    """
+    sos = [signal.butter(order, [l_freq, h_freq], btype="bandpass", output="sos", fs=sfreq)]
+    if notch is not None and design_notch(sfreq, notch, notch_q) is not None:
+        sos.append(design_notch(sfreq, notch, notch_q))
+    sos = np.concatenate(sos, axis=0)
+
+    # pad as long as the cascade rings (same estimate as mne)
+    padlen = mne.filter.estimate_ringing_samples(sos)
+    return sos, padlen
+
+
+def _filter_rows(data: np.ndarray, rows: np.ndarray, sos: np.ndarray, padlen: int, phase: str, block_size: int):
+    """
+    Filters rows of the data in place, block by block
+
+    Args:
+        data (np.ndarray): data (channels x samples), modified in place
+        rows (np.ndarray): indices of the rows (channels) to filter
+        sos (np.ndarray): second-order sections (sections x 6)
+        padlen (int): number of samples to pad at each end (zero-phase mode)
+        phase (str): 'zero' or 'causal'
+        block_size (int): number of samples per block
+    """
+    n_samples = data.shape[1]
+    zi = signal.sosfilt_zi(sos)[:, None, :]  # sections x rows x 2, steady state for a unit step
+    starts = np.arange(0, n_samples, block_size)
+
+    if phase == "causal":
+        state = zi * data[rows, :1]
+        for start in starts:
+            data[rows, start:start + block_size], state = signal.sosfilt(
+                sos, data[rows, start:start + block_size], zi=state)
+        return
+
+    # odd reflections at both ends (taken before the data is overwritten)
+    padlen = min(padlen, n_samples - 1)
+    pad_left = 2 * data[rows, :1] - data[rows, padlen:0:-1]
+    pad_right = 2 * data[rows, -1:] - data[rows, -2:-padlen - 2:-1]
+
+    # forward pass
+    _, state = signal.sosfilt(sos, pad_left, zi=zi * pad_left[:, :1])
+    for start in starts:
+        data[rows, start:start + block_size], state = signal.sosfilt(
+            sos, data[rows, start:start + block_size], zi=state)
+    pad_right, state = signal.sosfilt(sos, pad_right, zi=state)
+
+    # backward pass, over the (reversed) blocks in reverse order
+    _, state = signal.sosfilt(sos, pad_right[:, ::-1], zi=zi * pad_right[:, -1:])
+    for start in starts[::-1]:
+        block, state = signal.sosfilt(sos, data[rows, start:start + block_size][:, ::-1], zi=state)
+        data[rows, start:start + block_size] = block[:, ::-1]
+
+
+def filter_blocks(data: np.ndarray, sos: np.ndarray, padlen: int, picks: np.ndarray = None, phase: str = "zero",
+                  block_size: int = 2 ** 16, n_jobs: int = 1):
+    """
+    Filters the data in place with a cascade of second-order sections, in blocks and with the channels in parallel
+
+    Args:
+        data (np.ndarray): data (channels x samples), modified in place
+        sos (np.ndarray): second-order sections (sections x 6), see design_filter_bank
+        padlen (int): number of samples to pad at each end in zero-phase mode
+        picks (np.ndarray, optional): indices of the channels to filter. Defaults to None (all channels).
+        phase (str, optional): 'zero' (forward-backward) or 'causal' (forward only). Defaults to 'zero'.
+        block_size (int, optional): number of samples per block. Defaults to 65536.
+        n_jobs (int, optional): number of threads, each filtering a group of channels (at most one per channel).
+            Defaults to 1, as the runs are usually filtered in parallel processes (see batch_preprocess.py).
+
+    Returns:
+        np.ndarray: the filtered data (the same array)
+    """
+    if phase not in ("zero", "causal"):
+        raise ValueError(f"phase must be 'zero' or 'causal', got '{phase}'")
+    picks = np.arange(data.shape[0]) if picks is None else np.asarray(picks)
+    n_jobs = max(1, min(n_jobs, len(picks)))
+
+    groups = np.array_split(picks, n_jobs)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_filter_rows, data, rows, sos, padlen, phase, block_size) for rows in groups]
+        for future in futures:
+            future.result()
+    return data
+
+
+def filter_raw_blocks(raw: mne.io.BaseRaw, l_freq: float, h_freq: float, notch: float = None, picks: np.ndarray = None,
+                      phase: str = "zero", block_size: int = 2 ** 16, n_jobs: int = 1):
+    """
+    Band-pass and notch filters raw data in place with the block-streaming filter bank
+
+    Args:
+        raw (mne.io.BaseRaw): preloaded raw data, modified in place
+        l_freq (float): lower edge of the pass band in Hz
+        h_freq (float): upper edge of the pass band in Hz
+        notch (float, optional): line noise frequency in Hz (all harmonics below Nyquist are notched). Defaults to
+            None (no notch filters).
+        picks (np.ndarray, optional): indices of the channels to filter. Defaults to None (all data channels).
+        phase (str, optional): 'zero' (offline, forward-backward) or 'causal' (online, forward only). Defaults to
+            'zero'.
+        block_size (int, optional): number of samples per block. Defaults to 65536.
+        n_jobs (int, optional): number of threads. Defaults to 1.
+
+    Returns:
+        mne.io.BaseRaw: the filtered data (the same object)
+    """
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, exclude=[])
+    sos, padlen = design_filter_bank(raw.info["sfreq"], l_freq, h_freq, notch)
+    filter_blocks(raw._data, sos, padlen, picks, phase, block_size, n_jobs)
+
+    with raw.info._unlock():
+        raw.info["highpass"] = float(l_freq)
+        raw.info["lowpass"] = float(h_freq)
+    return raw
+
+
+def get_resample_factors(sfreq: float, fs: float, tol: float = 1e-5):
+    """
+    Returns the smallest integer factors by which the data is up- and downsampled from sfreq to fs
+
+    The measured sampling frequency of a recording (e.g., 511.9995 Hz) is not exactly the nominal one, so the ratio is
+    approximated by the fraction with the smallest denominator within a relative tolerance.
+
+    Args:
+        sfreq (float): sampling frequency of the data in Hz
+        fs (float): target sampling frequency in Hz
+        tol (float, optional): relative tolerance on the resulting sampling frequency. Defaults to 1e-5.
+
+    Returns:
+        tuple: up and down factors (int)
+    """
+    ratio = fs / sfreq
+    for down in range(1, int(1 / tol) + 1):
+        up = max(1, round(ratio * down))
+        if abs(up / down - ratio) <= tol * ratio:
+            break
+    else:
+        fraction = Fraction(ratio).limit_denominator(int(1 / tol))
+        up, down = fraction.numerator, fraction.denominator
+    return up, down
+
+
+@lru_cache(maxsize=None)
+def get_resample_filter(up: int, down: int):
+    """
+    Designs the anti-alias filter for polyphase resampling, once per pair of factors
+
+    Same linear-phase low-pass FIR filter as the default of scipy.signal.resample_poly (Kaiser window with beta 5,
+    cutoff at the lower of the two Nyquist frequencies, 10 zero-crossings at either side).
+
+    Args:
+        up (int): upsampling factor
+        down (int): downsampling factor
+
+    Returns:
+        np.ndarray: filter coefficients (read-only)
+    """
+    max_rate = max(up, down)
+    taps = signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+    taps.flags.writeable = False
+    return taps
+
+
+def resample_poly_batch(data: np.ndarray, up: int, down: int):
+    """
+    Resamples a batch of signals along the last axis with a polyphase filter, in one call
+
+    Args:
+        data (np.ndarray): data (..., samples), e.g., trials x channels x samples
+        up (int): upsampling factor
+        down (int): downsampling factor
+
+    Returns:
+        np.ndarray: the resampled data (..., ceil(samples * up / down)), where sample k lines up with sample
+            k * down / up of the input
+    """
+    # the signals are extended linearly at both ends, which rings less than padding with zeros
+    return signal.resample_poly(data, up, down, axis=-1, window=get_resample_filter(up, down), padtype="line")
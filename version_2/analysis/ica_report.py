@@ -0,0 +1,180 @@
+"""
+Report of the excluded ICA components of a subject
+
+The report is rendered once per subject, after its runs are preprocessed, from the persisted ICA objects: the ICA saved
+per condition (ica_fit_mode 'condition') or the ICA of each run in the stage cache (ica_fit_mode 'run'). The pages are
+rendered on worker processes with the non-interactive Agg backend and collected in
+excluded_ica_components_{subject}.pdf.
+
+Run as a script, it (re)renders the reports of all subjects from the excluded components saved in the settings of the
+derivatives, e.g., after batch preprocessing with the report switched off.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_pdf import PdfPages
+import mne
+from preprocessing import get_run_path, get_ica_path, get_stage_keys, get_variant_label
+from stage_cache import get_stage_path
+from stage_profile import profile_stage
+
+COMPONENTS_PER_PAGE = 5
+
+
+def get_report_path(ica_path: str, subject: str, variant: str = ""):
+    """
+    Returns the path of the report of a subject
+
+    Args:
+        ica_path (str): path of the ICA results
+        subject (str): subject name
+        variant (str, optional): name of the preprocessing variant. Defaults to '' (default variant).
+
+    Returns:
+        str: path of the pdf file
+    """
+    return os.path.join(ica_path, f"excluded_ica_components_{get_variant_label(subject, variant)}.pdf")
+
+
+def get_report_pages(subject: str, runs: dict, params: dict, ica_path: str, cache_path: str):
+    """
+    Lists the pages of the report of a subject
+
+    With ica_fit_mode 'condition', the runs of a condition share one ICA, of which the components excluded in any run
+    are shown. With ica_fit_mode 'run', the excluded components of every run are shown on its own ICA, which is read
+    from the stage cache.
+
+    Args:
+        subject (str): subject name
+        runs (dict): condition (with the name of the variant appended, see get_variant_label) -> list of (path of the
+            xdf file, excluded ICA components) per run
+        params (dict): preprocessing parameters the runs were preprocessed with
+        ica_path (str): path of the ICA results
+        cache_path (str): root of the stage cache (only used with ica_fit_mode 'run'), None if the runs were not cached,
+            in which case their ICAs are skipped
+
+    Returns:
+        list: (path of the ICA fif file, components, title) per page
+    """
+    icas = []  # (path of the ICA fif file, excluded components, title)
+    for condition, condition_runs in runs.items():
+        if params["ica_fit_mode"] == "condition":
+            exclude = []
+            for _, run_exclude in condition_runs:
+                exclude += [component for component in run_exclude if component not in exclude]
+            icas.append((get_ica_path(ica_path, subject, condition), exclude, condition))
+            continue
+
+        for i_run, (fn, run_exclude) in enumerate(condition_runs):
+            fn_ica = None  # without a stage cache, the ICA of a run is not kept
+            if cache_path is not None:
+                fn_ica = os.path.join(get_stage_path(cache_path, "ica_fit", get_stage_keys(fn, params)["ica_fit"]),
+                                      "fit-ica.fif")
+            icas.append((fn_ica, run_exclude, f"{condition} run {1 + i_run}"))
+
+    pages = []
+    for fn_ica, exclude, title in icas:
+        if fn_ica is None or not os.path.isfile(fn_ica):
+            print(f"no ICA found for {subject} {title}, skipped in the report")
+            continue
+        for start in range(0, len(exclude), COMPONENTS_PER_PAGE):
+            pages.append((fn_ica, exclude[start:start + COMPONENTS_PER_PAGE], title))
+    return pages
+
+
+def _init_renderer():
+    """
+    Switches a worker process to the non-interactive backend
+    """
+    matplotlib.use("Agg")
+
+
+def _render_page(fn_ica: str, components: list, title: str):
+    """
+    Renders the topographies of ICA components on one A4 page
+
+    Args:
+        fn_ica (str): path of the ICA fif file
+        components (list): indices of the components on the page
+        title (str): condition (and run) shown in the titles
+
+    Returns:
+        matplotlib.figure.Figure: the page, not attached to any (interactive) figure manager
+    """
+    ica_obj = mne.preprocessing.read_ica(fn_ica, verbose=False)
+    fig = Figure(figsize=(8.27, 11.69))  # A4 size in inches
+    axes = fig.subplots(nrows=len(components), ncols=1, squeeze=False)[:, 0]
+    for component, ax in zip(components, axes):
+        ica_obj.plot_components(picks=[component], axes=ax, show=False)
+        ax.set_title(f"{title}: excluded ICA component {component}")
+    return fig
+
+
+def save_ica_report(pages: list, fn: str, n_jobs: int = None):
+    """
+    Renders the pages of a report and saves them to a pdf
+
+    Args:
+        pages (list): (path of the ICA fif file, components, title) per page, see get_report_pages
+        fn (str): path of the pdf file
+        n_jobs (int, optional): number of worker processes rendering the pages. Defaults to None (number of CPUs, at
+            most one per page). With 1, the pages are rendered in this process.
+    """
+    n_jobs = min(n_jobs or os.cpu_count(), max(1, len(pages)))
+    if n_jobs == 1:
+        figs = [_render_page(*page) for page in pages]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_renderer) as pool:
+            figs = list(pool.map(_render_page, *zip(*pages)))
+
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with PdfPages(fn) as pdf:
+        for fig in figs:
+            pdf.savefig(fig)
+    print(f"Excluded ICA component plots saved to {os.path.basename(fn)}")
+
+
+def save_subject_report(subject: str, runs: dict, params: dict, ica_path: str, cache_path: str, n_jobs: int = None,
+                        variant: str = "", fn_profile: str = None):
+    """
+    Renders the report of the excluded ICA components of a subject
+
+    Args:
+        subject (str): subject name
+        runs (dict): condition -> list of (path of the xdf file, excluded ICA components) per run, see
+            get_report_pages
+        params (dict): preprocessing parameters the runs were preprocessed with
+        ica_path (str): path of the ICA results
+        cache_path (str): root of the stage cache (only used with ica_fit_mode 'run'), None if the runs were not cached,
+            in which case their ICAs are skipped
+        n_jobs (int, optional): number of worker processes rendering the pages. Defaults to None (number of CPUs).
+        variant (str, optional): name of the preprocessing variant. Defaults to '' (default variant).
+        fn_profile (str, optional): path of the log the time and memory of the rendering are appended to (see
+            stage_profile.get_profile_path). Defaults to None (no log).
+
+    Returns:
+        str: path of the pdf file
+    """
+    fn = get_report_path(ica_path, subject, variant)
+    with profile_stage(fn_profile, "report", variant=variant):
+        save_ica_report(get_report_pages(subject, runs, params, ica_path, cache_path), fn, n_jobs)
+    return fn
+
+
+if __name__ == "__main__":
+    from dataset import get_derivative_path, load_derivative
+    from read_and_preprocess_data import data_path, ica_path, cache_path, subjects, ses, conditions, code, \
+        variant_params
+
+    for subject in subjects:
+        for variant, params in variant_params.items():
+            if not params["use_ica"]:
+                continue
+            runs = {}
+            for condition in conditions:
+                label = get_variant_label(condition, variant)
+                settings = load_derivative(get_derivative_path(data_path, subject, label, code))["settings"]
+                runs[label] = [(get_run_path(data_path, subject, ses, condition, i_run), exclude)
+                               for i_run, exclude in enumerate(settings["exclude"])]
+            save_subject_report(subject, runs, settings, ica_path, cache_path, variant=variant)
@@ -0,0 +1,262 @@
+"""
+Watch-folder ingest: preprocesses the runs of a session while it is still being recorded
+
+The raw data tree of data_path (raw/sub-*/*/eeg/*.xdf) is scanned every poll_interval seconds. A run whose file was not
+modified for settle_time seconds is considered closed and is indexed in the catalog (see catalog.py), which also writes
+its mirror. The complete runs of the conditions (see conditions in read_and_preprocess_data.py, the rstate and practice
+runs are left out) are queued for the stages of batch_preprocess.py on a pool of worker processes, and the derivatives
+of their subject and condition are rewritten from all of its runs done so far, such that they are up to date minutes
+after the last run of a session ends.
+
+The runs of a subject and condition are processed in waves, and a run that closes while its condition is being
+processed waits for the next wave. With ica_fit_mode 'condition', the runs are held back until all runs of the
+condition are in, after which the ICA of the condition is fitted once and all of its runs are processed, such that the
+derivatives equal those of batch_preprocess.py. Otherwise, a wave only processes its new runs. A run that changes after
+it was queued (e.g., a recording that was paused for longer than settle_time) is queued again, which refits the ICA of
+its condition.
+
+ICA components to exclude are taken from the ica_exclusions_{subject}.json files, or selected automatically
+(ica_selection 'auto'). A condition of which the components are to be selected manually and were not saved yet is
+skipped, as there is no display to select them. The report of the excluded components of a subject is rendered once
+all of its conditions have their full number of runs.
+
+Run as a script, it watches data_path until it is interrupted (Ctrl+C).
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from preprocessing import get_ica_path, fit_condition_ica, preprocess_run_variants, load_ica_exclusions, \
+    get_variant_label
+from ica_report import save_subject_report
+from stage_profile import get_profile_path
+from catalog import build_catalog, select_runs
+from batch_preprocess import n_workers, max_memory_per_worker, ica_report, _init_worker, get_n_workers, \
+    get_worker_memory, get_worker_init, save_condition
+from read_and_preprocess_data import data_path, ica_path, cache_path, profile_path, conditions, overt_runs, \
+    covert_runs, variant_params
+
+# ingest params
+poll_interval = 10  # seconds between two scans of the raw data
+settle_time = 30  # seconds a run is not modified before its file is considered closed
+
+
+def get_closed_runs(data_path: str, settle_time: float):
+    """
+    Indexes the closed runs of a data root in its catalog and returns them
+
+    Args:
+        data_path (str): path for raw data
+        settle_time (float): seconds a run is not modified before its file is considered closed
+
+    Returns:
+        list: one dict per indexed run, see catalog.select_runs
+    """
+    return select_runs(build_catalog(data_path, min_age=settle_time, verbose=False), status=None)
+
+
+def watch(data_path: str = data_path, conditions: list = conditions, poll_interval: float = poll_interval,
+          settle_time: float = settle_time, n_workers: int = n_workers,
+          max_memory_per_worker: float = max_memory_per_worker, ica_report: bool = ica_report, max_idle: float = None):
+    """
+    Preprocesses the runs of a data root as soon as they are recorded and keeps the derivatives up to date
+
+    Args:
+        data_path (str, optional): path for raw data. Defaults to data_path of read_and_preprocess_data.py.
+        conditions (list, optional): conditions to preprocess, e.g., ['overt', 'covert']. Defaults to conditions of
+            read_and_preprocess_data.py.
+        poll_interval (float, optional): seconds between two scans of the raw data. Defaults to 10.
+        settle_time (float, optional): seconds a run is not modified before its file is considered closed. Defaults
+            to 30.
+        n_workers (int, optional): maximum number of worker processes. Defaults to the number of CPUs.
+        max_memory_per_worker (float, optional): memory ceiling per worker process in GB, enforced on its address space
+            (see _init_worker). Defaults to 8.
+        ica_report (bool, optional): render the report of the excluded ICA components of each subject once all of its
+            runs are in. Defaults to True.
+        max_idle (float, optional): stop after this many seconds without new runs or running jobs. Defaults to None
+            (watch until interrupted).
+
+    Returns:
+        list: paths of the saved derivatives, in the order they were (re)written
+    """
+    n_workers = get_n_workers(n_workers, get_worker_memory(max_memory_per_worker))
+    init_args, filter_jobs = get_worker_init(n_workers, max_memory_per_worker)
+    print(f"watching {os.path.join(data_path, 'raw')} with {n_workers} worker(s), {filter_jobs} thread(s) each")
+
+    seen = {}  # path of a run -> size and modification time when it was last queued or skipped
+    queued = {}  # (subject, condition) -> path -> run (row of the catalog) waiting for the next wave (or held back)
+    runs = {}  # (subject, condition) -> path -> run in the derivatives
+    results = {}  # (subject, condition) -> path -> eeg data, labels, exclusions and bad data per variant
+    waves = {}  # (subject, condition) -> runs of the running wave, its new runs and its condition ICAs to be fitted
+    report_runs = {}  # (subject, variant) -> condition -> xdf file and exclusions per run
+    reported = set()  # subjects of which the report is rendered
+    saved_derivatives = []
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=init_args) as pool:
+        pending = {}  # future -> (subject, condition) and the path of the run (None for a condition ICA)
+
+        def submit_runs(key, fns):
+            subject, condition = key
+            for fn in fns:
+                name = f"run-{runs[key][fn]['run']:03d}"
+                fn_log = {variant: os.path.join(ica_path, f'ica_selection_{subject}_'
+                                                          f'{get_variant_label(condition, variant)}_{name}.json')
+                          for variant in variant_params}
+                fn_profile = {variant: get_profile_path(profile_path, subject,
+                                                        f'{get_variant_label(condition, variant)}_{name}')
+                              for variant in variant_params}
+                pending[pool.submit(preprocess_run_variants, fn, variant_params, waves[key]["exclusions"], cache_path,
+                                    fn_log, waves[key]["fn_icas"], fn_profile, filter_jobs)] = (key, fn)
+
+        def get_condition_icas(key):
+            # variant -> path of the ICA fitted on all runs of the condition
+            subject, condition = key
+            return {variant: get_ica_path(ica_path, subject, get_variant_label(condition, variant))
+                    for variant, v_params in variant_params.items()
+                    if v_params["use_ica"] and v_params["ica_fit_mode"] == "condition"}
+
+        def is_held(key):
+            # with a condition ICA, the runs wait until all runs of the condition are in, such that it is fitted once
+            n_runs = overt_runs if key[1] == 'overt' else covert_runs
+            return bool(get_condition_icas(key)) and len(set(runs.get(key, {})) | set(queued[key])) < n_runs
+
+        def start_wave(key):
+            subject, condition = key
+            saved = load_ica_exclusions(ica_path, subject)
+            exclusions = {variant: saved.get(get_variant_label(condition, variant)) for variant in variant_params}
+            manual = [variant or "default" for variant, v_params in variant_params.items()
+                      if v_params["use_ica"] and v_params["ica_selection"] == "manual" and exclusions[variant] is None]
+            new = queued.pop(key)
+            if manual:
+                print(f"skipped {subject} {condition}, its ICA components are to be selected manually (variant "
+                      f"{', '.join(manual)}): select them with read_and_preprocess_data.py or use ica_selection 'auto'")
+                return
+
+            runs.setdefault(key, {}).update(new)
+            runs[key] = dict(sorted(runs[key].items(), key=lambda item: (item[1]["session"], item[1]["run"])))
+            fn_icas = get_condition_icas(key)
+            # with a condition ICA, all runs are processed with the ICA fitted on them
+            fns = list(runs[key]) if fn_icas else list(new)
+            waves[key] = {"fns": set(fns), "new": set(new), "n_icas": len(fn_icas), "ica_failed": False,
+                          "exclusions": exclusions, "fn_icas": fn_icas}
+            print(f"preprocessing {subject} {condition}: {', '.join(os.path.basename(fn) for fn in fns)}")
+            for variant, fn_ica in fn_icas.items():
+                fn_profile = get_profile_path(profile_path, subject, f'{get_variant_label(condition, variant)}_ica')
+                pending[pool.submit(fit_condition_ica, list(runs[key]), variant_params[variant], fn_ica, cache_path,
+                                    fn_profile, filter_jobs)] = (key, None)
+            if not fn_icas:
+                submit_runs(key, fns)
+
+        def finish_wave(key):
+            subject, condition = key
+            del waves[key]
+            fns = [fn for fn in runs[key] if fn in results.get(key, {})]
+            if fns:
+                n_runs = overt_runs if condition == 'overt' else covert_runs
+                print(f"{subject} {condition}: {len(fns)} of {n_runs} run(s) done")
+                for variant, (fn, report) in save_condition(subject, condition, fns,
+                                                            [results[key][fn] for fn in fns]).items():
+                    saved_derivatives.append(fn)
+                    report_runs.setdefault((subject, variant), {})[get_variant_label(condition, variant)] = report
+
+            # all conditions of the subject have their full number of runs, render its reports (pages in a worker)
+            n_done = {condition: len(results.get((subject, condition), {})) for condition in conditions}
+            if ica_report and subject not in reported and \
+                    all(n_done[condition] >= (overt_runs if condition == 'overt' else covert_runs)
+                        for condition in conditions):
+                reported.add(subject)
+                for variant, v_params in variant_params.items():
+                    if v_params["use_ica"]:
+                        fn_profile = get_profile_path(profile_path, subject, get_variant_label("report", variant))
+                        pending[pool.submit(save_subject_report, subject, report_runs[(subject, variant)], v_params,
+                                            ica_path, cache_path, 1, variant, fn_profile)] = ((subject, None), "report")
+            if key in queued and not is_held(key):
+                start_wave(key)
+
+        last_activity = time.time()
+        try:
+            while True:
+                # queue the runs that closed (or changed) since the last scan
+                for run in get_closed_runs(data_path, settle_time):
+                    signature = (run["size"], run["mtime_ns"])
+                    if run["task"] not in conditions or seen.get(run["path"]) == signature:
+                        continue
+                    seen[run["path"]] = signature
+                    last_activity = time.time()
+                    if run["status"] != "ok":
+                        print(f"skipped {os.path.basename(run['path'])}, {run['status']}"
+                              f"{': ' + run['error'] if run['error'] else ''}")
+                        continue
+                    key = (run["subject"], run["task"])
+                    queued.setdefault(key, {})[run["path"]] = run
+                    results.get(key, {}).pop(run["path"], None)
+                    if is_held(key):
+                        n_runs = overt_runs if run["task"] == 'overt' else covert_runs
+                        print(f"{run['subject']} {run['task']}: {len(set(runs.get(key, {})) | set(queued[key]))} of "
+                              f"{n_runs} run(s) in, held back until the ICA of the condition can be fitted on all")
+                for key in list(queued):
+                    if key not in waves and not is_held(key):
+                        start_wave(key)
+
+                # collect the finished jobs until the next scan
+                deadline = time.time() + poll_interval
+                while pending and time.time() < deadline:
+                    done, _ = wait(pending, timeout=deadline - time.time(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        last_activity = time.time()
+                        key, fn = pending.pop(future)
+                        subject, condition = key
+                        if fn == "report":
+                            try:
+                                future.result()
+                                print(f"finished {subject} ICA report")
+                            except Exception as error:
+                                print(f"failed {subject} ICA report: {error!r}")
+                            continue
+
+                        wave = waves[key]
+                        try:
+                            result = future.result()
+                        except Exception as error:
+                            # the run is left out until it changes, a failed ICA leaves out the new runs of its wave
+                            failed = [fn] if fn is not None else list(wave["new"])
+                            print(f"failed {subject} {condition} {'ICA' if fn is None else os.path.basename(fn)}: "
+                                  f"{error!r}")
+                            for fn_failed in failed:
+                                runs[key].pop(fn_failed, None)
+                                results.get(key, {}).pop(fn_failed, None)
+                                wave["fns"].discard(fn_failed)
+                            if fn is None:
+                                wave["ica_failed"] = True  # the runs of the wave are not scheduled
+                        else:
+                            if fn is None:
+                                wave["n_icas"] -= 1
+                                if wave["n_icas"] == 0 and not wave["ica_failed"]:
+                                    print(f"finished {subject} {condition} ICA")
+                                    submit_runs(key, sorted(wave["fns"], key=list(runs[key]).index))
+                                continue
+                            results.setdefault(key, {})[fn] = result
+                            wave["fns"].discard(fn)
+                            print(f"finished {subject} {condition} {os.path.basename(fn)}")
+
+                        if not any(other == key for other, _ in pending.values()):
+                            finish_wave(key)
+                if not pending:
+                    time.sleep(max(0.0, deadline - time.time()))
+
+                # without pending jobs, the queued runs are the ones held back
+                if max_idle is not None and not pending and time.time() - last_activity > max_idle:
+                    print(f"no new runs for {max_idle} s, stopped watching")
+                    for (subject, condition), held in queued.items():
+                        print(f"{subject} {condition}: {len(held)} run(s) held back, not all runs of the condition "
+                              f"are in")
+                    break
+        except KeyboardInterrupt:
+            print("stopped watching, waiting for the running jobs")
+            for future in pending:
+                future.cancel()
+
+    return saved_derivatives
+
+
+if __name__ == "__main__":
+    watch()
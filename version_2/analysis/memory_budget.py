@@ -0,0 +1,124 @@
+"""
+Low-memory preprocessing: early decimation and a memory estimate per run
+
+With a memory budget set (memory_budget in read_and_preprocess_data.py), a run is loaded with only its eeg channels and
+Trig1 over the span of its trials (see get_trial_span), read from its chunk index (see xdf_index.load_stream) as stored
+in the file (float32), and decimated a few channels at a time with an anti-alias filter (see
+xdf_reader.raw_from_stream_low_memory). The decimation factor is the largest one for which the trial onsets shift by at
+most ONSET_TOLERANCE and the pass band stays well below the new Nyquist frequency.
+
+Before a run is loaded, the memory it needs is estimated from the shape of its BioSemi stream in the index, and the run
+fails with a MemoryError if the estimate exceeds the budget. After the run, the peak memory of every stage is printed
+(see stage_profile.StageProfiler).
+"""
+import os
+import numpy as np
+from xdf_reader import get_channel_info
+from xdf_index import load_index, get_marker_times, get_time_range, CHANNEL_FORMATS
+
+# number of copies of the (decimated) continuous data held at once by the stages (filter, ICA, epochs)
+N_COPIES = 4
+
+# largest shift of the trial onsets (s) caused by rounding them to the decimated samples
+ONSET_TOLERANCE = 0.001
+
+# data (s) loaded before the first and after the last trial, which keeps the edge effects of the filters out of them
+TRIAL_MARGIN = 5
+
+
+def get_early_decim(sfreq: float, fs: float, h_freq: float):
+    """
+    Returns the factor by which the raw data can be decimated right after loading
+
+    The trial onsets are rounded to the decimated samples, which shifts them by up to half a decimated sample. The
+    factor is therefore limited to 2 * sfreq * ONSET_TOLERANCE (4 at 2048 Hz, a shift of at most 0.98 ms, and 1 at 512
+    Hz). It is also limited to sfreq / fs and to keeping the decimated rate at three times the upper edge of the pass
+    band, such that the anti-alias filter leaves the pass band untouched.
+
+    Args:
+        sfreq (float): sampling frequency of the recording in Hz
+        fs (float): target sampling frequency in Hz
+        h_freq (float): upper edge of the pass band in Hz
+
+    Returns:
+        int: decimation factor (1 for no decimation)
+    """
+    return max(1, min(int(2 * sfreq * ONSET_TOLERANCE), int(sfreq // fs), int(sfreq // (3 * h_freq))))
+
+
+def get_trial_span(onsets: np.ndarray, sfreq: float, n_samples: int, trial_time: float):
+    """
+    Returns the samples of a run that hold its trials, from 0.5 s before the first onset to the trial time after the
+    last one, with TRIAL_MARGIN on both sides
+
+    Args:
+        onsets (np.ndarray): trial onsets in samples
+        sfreq (float): sampling frequency of the recording in Hz
+        n_samples (int): number of samples of the run
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        tuple: first sample and last sample (exclusive) of the span, the whole run if there are no onsets
+    """
+    if len(onsets) == 0:
+        return 0, n_samples
+    start = int(np.min(onsets)) - int(np.ceil((0.5 + TRIAL_MARGIN) * sfreq))
+    stop = int(np.max(onsets)) + int(np.ceil((trial_time + TRIAL_MARGIN) * sfreq)) + 1
+    return max(start, 0), min(stop, n_samples)
+
+
+def estimate_run_memory(fn: str, fs: float, h_freq: float, trial_time: float):
+    """
+    Estimates the memory needed to preprocess a run in low-memory mode
+
+    The estimate follows from the shape of the BioSemi stream in the chunk index of the run (which is built if needed,
+    without decoding the file): Trig1 over the whole run (as stored and as float64), the loaded channels over the span
+    of the trials (see get_trial_span, with the trial onsets taken from the start_stimulus markers) as stored in the
+    file, and the copies of the decimated data (float64, as MNE holds it).
+
+    Args:
+        fn (str): path of the xdf file
+        fs (float): target sampling frequency in Hz
+        h_freq (float): upper edge of the pass band in Hz
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        tuple: estimated number of bytes and a description of the estimate
+    """
+    index = load_index(fn)
+    entry = index["BioSemi"]
+    labels, types, _ = get_channel_info(entry)
+    n_channels = sum(label == "Trig1" or ch_type == "eeg" for label, ch_type in zip(labels, types))
+    sfreq = entry["effective_srate"]
+    itemsize = np.dtype(CHANNEL_FORMATS[entry["channel_format"]]).itemsize
+    decim = get_early_decim(sfreq, fs, h_freq)
+
+    n_run = entry["n_samples"]
+    start, stop = 0, n_run
+    if n_run > 0 and "KeyboardMarkerStream" in index:
+        onsets = (get_marker_times(index) - get_time_range(entry)[0]) * sfreq
+        start, stop = get_trial_span(np.round(onsets), sfreq, n_run, trial_time)
+    n_samples = stop - start
+
+    n_bytes = n_run * (itemsize + 8) + n_channels * n_samples * itemsize \
+        + N_COPIES * n_channels * -(-n_samples // decim) * 8
+    return n_bytes, f"{n_channels} channels x {n_samples} of {n_run} samples ({entry['channel_format']}), " \
+                    f"decimated by {decim}, {N_COPIES} copies"
+
+
+def check_memory_budget(fn: str, params: dict):
+    """
+    Fails before a run is loaded if it is not expected to fit in the memory budget
+
+    Args:
+        fn (str): path of the xdf file
+        params (dict): preprocessing parameters (memory_budget in GB, fs, cvep_h_freq, trial_time)
+
+    Raises:
+        MemoryError: if the estimated memory exceeds the budget
+    """
+    n_bytes, description = estimate_run_memory(fn, params["fs"], params["cvep_h_freq"], params["trial_time"])
+    if n_bytes > params["memory_budget"] * 1024 ** 3:
+        raise MemoryError(f"{os.path.basename(fn)} needs an estimated {n_bytes / 1024 ** 3:.2f} GB ({description}), "
+                          f"above the memory budget of {params['memory_budget']} GB")
+    print(f"estimated memory: {n_bytes / 1024 ** 3:.2f} GB ({description})")
@@ -0,0 +1,839 @@
+"""
+Preprocessing stages for the raw eeg data of a run
+
+The stages (load, marker cleanup, bad channel detection, filtering, ICA, epoching, bad epoch removal and resampling)
+are used by read_and_preprocess_data.py,
+which runs them serially over all subjects, conditions and runs, and by batch_preprocess.py, which runs them on a
+process pool.
+
+Several preprocessing variants (e.g., another low-pass, sampling frequency or no ICA) can be run on a run at once with
+preprocess_run_variants. The stages the variants have in common (same input, parameters and code) are then run only
+once, after which the variants branch off.
+"""
+import os
+import json
+from contextlib import nullcontext
+import numpy as np
+import mne
+import pyntbci
+from xdf_reader import load_streams, get_channel_info, raw_from_stream, raw_from_stream_low_memory, add_gaze_channels, \
+    interpolate_gaze, get_labels
+from filter_bank import design_filter_bank, design_notch, filter_blocks, filter_raw_blocks, get_resample_factors, \
+    get_resample_filter, resample_poly_batch
+from bad_data import robust_z, get_channel_scores, find_bad_channels, find_bad_epochs, clean_epochs
+from stage_cache import get_file_hash, get_code_version, get_stage_key, get_stage_path, run_stage
+from memory_budget import get_early_decim, get_trial_span, check_memory_budget
+from xdf_index import load_index, load_stream
+from stage_profile import StageProfiler, profile_stage
+
+# frontal channels (biosemi64 names) and EyeLink channels used as eye artefact proxies for the automatic ICA selection
+EOG_PROXIES = ["Fp1", "Fpz", "Fp2", "AF7", "AF8"]
+GAZE_PROXIES = ["leftEyeX", "leftEyeY", "rightEyeX", "rightEyeY", "leftPupilArea", "rightPupilArea"]
+
+
+def get_run_path(data_path: str, subject: str, ses: str, condition: str, i_run: int):
+    """
+    Returns the path of the raw xdf file of a run
+
+    Args:
+        data_path (str): path for raw data
+        subject (str): subject name
+        ses (str): session name
+        condition (str): condition (task) of the run, e.g., 'overt' or 'covert'
+        i_run (int): index of the run (starting at 0)
+
+    Returns:
+        str: path of the xdf file
+    """
+    return os.path.join(data_path, "raw", f"sub-{subject}", ses, "eeg",
+                        f"sub-{subject}_{ses}_task-{condition}_run-{1 + i_run:03d}_eeg.xdf")
+
+
+def load_run(fn: str):
+    """
+    Loads the BioSemi data and trial labels of a run
+
+    Args:
+        fn (str): path of the xdf file
+
+    Returns:
+        tuple: raw BioSemi data (mne.io.RawArray), with the EyeLink channels added as misc channels if they were
+            recorded, and the trial labels (list)
+    """
+    # read the BioSemi, marker and EyeLink streams in one pass (mirrored next to the xdf file for later reads)
+    streams = load_streams(fn)
+    raw = raw_from_stream(streams["BioSemi"])
+
+    # synchronized gaze and pupil channels, used as eye artefact proxies for the ICA
+    if "EyeLink" in streams:
+        add_gaze_channels(raw, streams["BioSemi"], streams["EyeLink"])
+
+    # Extract labels from marker stream
+    labels = get_labels(streams["KeyboardMarkerStream"])
+    print("labels", len(labels))
+
+    return raw, labels
+
+
+def load_run_low_memory(fn: str, fs: float, h_freq: float, trial_time: float):
+    """
+    Loads the eeg channels and Trig1 of the trials of a run, decimated while they are read, and finds the trial onsets
+
+    The marker channel is read first, over the whole run, and cleaned up, and the onsets are found at the full rate
+    (see find_trial_events). Only the span of the trials (see memory_budget.get_trial_span) of the eeg channels is then
+    decoded from the chunk index of the run (see xdf_index.load_stream), and the onsets are rounded to the decimated
+    samples of that span. The bad channels and the ICA are therefore based on the trials (and the margin around them)
+    only. The EyeLink channels are not loaded, such that only the frontal channels serve as eye artefact proxies for
+    the automatic ICA selection.
+
+    Args:
+        fn (str): path of the xdf file
+        fs (float): target sampling frequency in Hz
+        h_freq (float): upper edge of the pass band in Hz
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        tuple: raw BioSemi data (mne.io.RawArray, Trig1 and the eeg channels over the span of the trials, decimated,
+            see get_early_decim), the trial labels (list) and the events (trials x 3, at the decimated rate)
+    """
+    index = load_index(fn)
+    entry = index["BioSemi"]
+    labels, types, _ = get_channel_info(entry)
+    sfreq = entry["effective_srate"]
+    decim = get_early_decim(sfreq, fs, h_freq)
+
+    # trial onsets at the full rate, from the marker channel only
+    stream = load_stream(fn, "BioSemi", [labels.index("Trig1")], index=index)
+    trig = mne.io.RawArray(np.asarray(stream["time_series"], dtype="float64").T,
+                           mne.create_info(["Trig1"], sfreq, "misc"), verbose=False)
+    events = find_trial_events(trig)
+    del stream, trig
+
+    # only the eeg channels and Trig1 of the trials are decoded
+    start, stop = get_trial_span(events[:, 0], sfreq, entry["n_samples"], trial_time)
+    picks = [i for i, (label, ch_type) in enumerate(zip(labels, types)) if label == "Trig1" or ch_type == "eeg"]
+    stream = load_stream(fn, "BioSemi", picks, start, stop, index=index)
+    print(f"loaded samples {start} to {stop} of {entry['n_samples']}")
+
+    onsets = np.round((events[:, 0] - start) / decim).astype(events.dtype)
+    if len(events) > 0:
+        shift = np.max(np.abs(onsets * decim + start - events[:, 0])) / sfreq
+        print(f"trial onsets shifted by at most {1000 * shift:.1f} ms by the decimation")
+    events[:, 0] = onsets
+
+    raw = raw_from_stream_low_memory(stream, decim)
+    print(f"loaded {len(raw.ch_names)} channels, decimated by {decim} to {raw.info['sfreq']:.1f} Hz")
+
+    labels = get_labels(index["KeyboardMarkerStream"])
+    print("labels", len(labels))
+    return raw, labels, events
+
+
+def find_trial_events(raw: mne.io.BaseRaw):
+    """
+    Cleans up the marker channel (Trig1) and finds the trial onsets
+
+    Args:
+        raw (mne.io.BaseRaw): raw BioSemi data, modified in place
+
+    Returns:
+        np.ndarray: events (trials x 3)
+    """
+    # Adjust marker channel data
+    raw._data[0, :] = (raw._data[0, :] - np.median(raw._data[0, :])) > 0
+    raw._data[0, :] = np.logical_and(raw._data[0, :], np.roll(raw._data[0, :], -1)).astype(raw._data[0, :].dtype)
+    events = mne.find_events(raw, stim_channel="Trig1")
+
+    print("events found:", len(events))
+    return events
+
+
+def filter_raw(raw: mne.io.BaseRaw, l_freq: float, h_freq: float, notch: float, phase: str = "zero", n_jobs: int = 1):
+    """
+    Band-pass filters the eeg channels and removes line noise
+
+    The 6th order Butterworth band-pass and the notch filters are run as one cascade over the data in blocks (see
+    filter_bank.py), in place, with the channels filtered in parallel.
+
+    Args:
+        raw (mne.io.BaseRaw): raw BioSemi data, modified in place
+        l_freq (float): lower edge of the pass band in Hz
+        h_freq (float): upper edge of the pass band in Hz
+        notch (float): line noise frequency in Hz (all harmonics below Nyquist are removed)
+        phase (str, optional): 'zero' (offline, forward-backward) or 'causal' (online, forward only). Defaults to
+            'zero'.
+        n_jobs (int, optional): number of threads filtering the channels. Defaults to 1.
+
+    Returns:
+        mne.io.BaseRaw: the filtered data
+    """
+    return filter_raw_blocks(raw, l_freq, h_freq, notch, picks=np.arange(1, 65), phase=phase, n_jobs=n_jobs)
+
+
+def set_biosemi_montage(raw: mne.io.BaseRaw):
+    """
+    Renames the eeg channels to the biosemi64 cap layout and sets the montage (needed for topoplots)
+
+    Args:
+        raw (mne.io.BaseRaw): raw BioSemi data, modified in place
+    """
+    # Read cap file
+    capfile = os.path.join(os.path.dirname(pyntbci.__file__), "capfiles", "biosemi64.loc")
+    with open(capfile, "r") as fid:
+        channels = []
+        for line in fid.readlines():
+            channels.append(line.split("\t")[-1].strip())
+
+    chan_names_old = raw.info.ch_names[1:65]
+    mapping = {}
+    for key, channel in zip(chan_names_old, channels):
+        mapping[key] = channel
+
+    mne.rename_channels(raw.info, mapping=mapping)
+    montage = mne.channels.read_custom_montage(fname=capfile)
+    raw.set_montage(montage)
+
+
+def get_ica_decim(sfreq: float, ica_sfreq: float = None):
+    """
+    Returns the decimation factor of the data the ICA is fitted on
+
+    The data is low-passed (cvep_h_freq) far below the Nyquist frequency of the decimated rate, so taking every n-th
+    sample does not alias.
+
+    Args:
+        sfreq (float): sampling frequency of the data
+        ica_sfreq (float, optional): approximate sampling frequency to fit the ICA at. Defaults to None (full rate).
+
+    Returns:
+        int: decimation factor (1 for no decimation)
+    """
+    if ica_sfreq is None:
+        return 1
+    return max(1, int(round(sfreq / ica_sfreq)))
+
+
+def fit_ica(raw: mne.io.BaseRaw, decim: int = 1):
+    """
+    Fits a FastICA on the eeg channels, with as many components as there are good channels
+
+    Args:
+        raw (mne.io.BaseRaw): filtered BioSemi data with the biosemi64 montage, the bad channels are left out
+        decim (int, optional): fit on every decim-th sample only (see get_ica_decim). Defaults to 1.
+
+    Returns:
+        mne.preprocessing.ICA: the fitted ICA
+    """
+    picks_eeg = mne.pick_types(raw.info, meg=False, eeg=True, eog=False, stim=False)
+    ica_obj = mne.preprocessing.ICA(n_components=len(picks_eeg),
+                                    method='fastica',
+                                    max_iter='auto',
+                                    random_state=97
+                                    # fit_params = dict(extended = True)
+                                    )
+    ica_obj.fit(raw, picks=picks_eeg, decim=decim if decim > 1 else None)  # fitting the ica
+    return ica_obj
+
+
+def select_ica_components(ica_obj: mne.preprocessing.ICA, raw: mne.io.BaseRaw):
+    """
+    Plots the ICA sources and components and asks which components to exclude
+
+    Args:
+        ica_obj (mne.preprocessing.ICA): the fitted ICA
+        raw (mne.io.BaseRaw): the data the ICA was fitted on
+
+    Returns:
+        list: indices of the components to exclude
+    """
+    # plotting ICA results
+    ica_obj.plot_sources(raw)
+    ica_obj.plot_components(picks=None, show=True, inst=raw)
+
+    import easygui  # only needed (and only working) with a display
+
+    exclude_vec_str = easygui.enterbox("Enter the component(s) you would like to exclude with a space between them. For example: 1 2 3")
+    return [int(x) for x in exclude_vec_str.split()]
+
+
+def classify_ica_components(ica_obj: mne.preprocessing.ICA, raw: mne.io.BaseRaw, threshold: float):
+    """
+    Selects the ICA components that reflect eye artefacts, without user interaction
+
+    Every source is correlated with the eye artefact proxies: the frontal channels (EOG_PROXIES) and the synchronized
+    EyeLink gaze and pupil channels (when recorded). Sources and proxies are band-passed to 1-10 Hz first. A component
+    is excluded if its absolute correlation with any proxy exceeds the threshold.
+
+    Args:
+        ica_obj (mne.preprocessing.ICA): the fitted ICA
+        raw (mne.io.BaseRaw): the data the ICA was fitted on
+        threshold (float): absolute correlation (0 to 1) above which a component is excluded
+
+    Returns:
+        dict: the excluded components (exclude, sorted by score), the threshold, and the correlations of all
+            components with each proxy (scores)
+    """
+    proxies = [ch for ch in raw.ch_names if ch in EOG_PROXIES or ch in GAZE_PROXIES]
+    exclude, scores = ica_obj.find_bads_eog(raw, ch_name=proxies, threshold=threshold, measure="correlation")
+    if len(proxies) == 1:
+        scores = [scores]
+
+    selection = {"exclude": [int(x) for x in exclude], "threshold": threshold,
+                 "scores": {proxy: np.round(score, 4).tolist() for proxy, score in zip(proxies, scores)}}
+    for component in selection["exclude"]:
+        best = max(proxies, key=lambda proxy: abs(selection["scores"][proxy][component]))
+        print(f"ICA component {component} excluded: |r| = {abs(selection['scores'][best][component]):.2f} with {best}")
+    print(f"ICA components excluded automatically: {selection['exclude']}")
+    return selection
+
+
+def apply_ica(ica_obj: mne.preprocessing.ICA, raw: mne.io.BaseRaw, exclude: list):
+    """
+    Removes the excluded ICA components from the data
+
+    Args:
+        ica_obj (mne.preprocessing.ICA): the fitted ICA
+        raw (mne.io.BaseRaw): the data the ICA was fitted on, modified in place
+        exclude (list): indices of the components to exclude
+
+    Returns:
+        mne.io.BaseRaw: the cleaned data, with the eeg channels the ICA was not fitted on (as they were bad in this or
+            another run) marked as bad, such that they are interpolated
+    """
+    ica_obj.exclude = exclude
+    raw.info["bads"] += [raw.ch_names[pick] for pick in mne.pick_types(raw.info, eeg=True, exclude="bads")
+                         if raw.ch_names[pick] not in ica_obj.ch_names]
+    return ica_obj.apply(raw)
+
+
+def epoch_run(raw: mne.io.BaseRaw, events: np.ndarray, trial_time: float):
+    """
+    Slices the trials from the continuous data
+
+    The trials are taken from a strided view of the continuous data (one window per sample), such that they are copied
+    from the data once, into one (trials x channels x samples) array. Trials that do not fit in the data are left out,
+    as mne.Epochs does.
+
+    Args:
+        raw (mne.io.BaseRaw): cleaned BioSemi data
+        events (np.ndarray): trial onsets (trials x 3)
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        mne.EpochsArray: the trials of the run, from 0.5 s before the onset to the end of the trial, with the indices of
+            the trials that fit in the data in epo.selection
+    """
+    # epoch the data with the trial duration (same samples as mne.Epochs with tmin=-0.5 and tmax=trial_time)
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    start = int(round(-0.5 * raw.info["sfreq"]))
+    n_times = int(round(trial_time * raw.info["sfreq"])) - start + 1
+    onsets = events[:, 0] - raw.first_samp + start
+    selection = np.flatnonzero((onsets >= 0) & (onsets + n_times <= raw.n_times))
+    if len(selection) < len(events):
+        print(f"trials {np.setdiff1d(np.arange(len(events)), selection).tolist()} do not fit in the data, left out")
+
+    windows = np.lib.stride_tricks.sliding_window_view(raw._data, n_times, axis=1)  # channels x onsets x samples
+    data = windows[picks[None, :], onsets[selection, None]]  # trials x channels x samples
+    epo = mne.EpochsArray(data, mne.pick_info(raw.info, picks), events=events[selection],
+                          tmin=start / raw.info["sfreq"], selection=selection, verbose=False)
+    return epo
+
+
+def resample_epochs(epo: mne.Epochs, fs: int, trial_time: float):
+    """
+    Downsamples the trials with a polyphase filter, in one call over all trials and channels
+
+    The data before the onset is trimmed such that the onset falls on a multiple of the downsampling factor, which puts
+    it exactly on an output sample. The up- and downsampling factors and the anti-alias filter are designed once per
+    pair of rates (see filter_bank.get_resample_filter).
+
+    Args:
+        epo (mne.Epochs): the trials of the run, starting before the onset
+        fs (int): target EEG (down)sampling frequency
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        np.ndarray: eeg data of the run (trials x channels x samples), from the onset to the end of the trial
+    """
+    # Resampling
+    # N.B. Downsampling is done after slicing to maintain accurate
+    # stimulus timing
+    up, down = get_resample_factors(epo.info["sfreq"], fs)
+    onset = int(epo.time_as_index(0, use_rounding=True)[0])
+    data = epo.get_data(copy=False)[:, :, onset % down:]
+    onset = (onset - onset % down) * up // down
+
+    return resample_poly_batch(data, up, down)[:, :, onset:onset + int(round(trial_time * fs))]
+
+
+def get_stage_keys(fn: str, params: dict, exclude: list = None, fn_ica: str = None):
+    """
+    Builds the cache keys of the preprocessing stages of a run
+
+    Args:
+        fn (str): path of the xdf file
+        params (dict): preprocessing parameters (memory_budget, bad_channel_z, cvep_l_freq, cvep_h_freq, notch,
+            filter_phase, fs, trial_time, bad_epoch_z, use_ica, ica_threshold, ica_sfreq)
+        exclude (list, optional): ICA components to exclude. Defaults to None, in which case the keys of the stages
+            after the ICA fit are left out (unless use_ica is False).
+        fn_ica (str, optional): path of an ICA fitted on all runs of the condition. Defaults to None (ICA per run).
+
+    Returns:
+        dict: stage name -> cache key
+    """
+    keys = {}
+    if params["memory_budget"] is None:
+        keys["load"] = get_stage_key("load", get_file_hash(fn), get_code_version(_RunStages._load, load_run,
+                                                                                 raw_from_stream, add_gaze_channels,
+                                                                                 interpolate_gaze, get_labels))
+    else:  # low-memory mode, decimated to suit fs and the pass band
+        keys["load"] = get_stage_key("load", get_file_hash(fn),
+                                     get_code_version(_RunStages._load, load_run_low_memory, raw_from_stream_low_memory,
+                                                      get_early_decim, get_trial_span, find_trial_events, get_labels,
+                                                      load_stream),
+                                     fs=params["fs"], h_freq=params["cvep_h_freq"], trial_time=params["trial_time"])
+    keys["markers"] = get_stage_key("markers", keys["load"], get_code_version(_RunStages._markers, find_trial_events))
+    keys["bad_channels"] = get_stage_key("bad_channels", keys["markers"],
+                                         get_code_version(_RunStages._bad_channels, find_bad_channels,
+                                                          get_channel_scores, design_notch, robust_z),
+                                         z=params["bad_channel_z"], notch=params["notch"])
+    keys["filter"] = get_stage_key("filter", keys["bad_channels"],
+                                   get_code_version(_RunStages._filter, filter_raw, filter_raw_blocks,
+                                                    design_filter_bank, design_notch, filter_blocks,
+                                                    set_biosemi_montage),
+                                   l_freq=params["cvep_l_freq"], h_freq=params["cvep_h_freq"], notch=params["notch"],
+                                   phase=params["filter_phase"])
+    if fn_ica is None:
+        keys["ica_fit"] = get_stage_key("ica_fit", keys["filter"],
+                                        get_code_version(_RunStages._ica_fit, fit_ica, get_ica_decim),
+                                        ica_sfreq=params["ica_sfreq"])
+    else:
+        keys["ica_fit"] = get_stage_key("ica_fit", keys["filter"], get_code_version(_RunStages._ica_fit),
+                                        ica=get_file_hash(fn_ica))
+    keys["ica_select"] = get_stage_key("ica_select", keys["ica_fit"],
+                                       get_code_version(_RunStages._ica_select, classify_ica_components),
+                                       threshold=params["ica_threshold"])
+    if not params["use_ica"]:  # the trials are sliced from the filtered data
+        keys["epoch"] = get_stage_key("epoch", keys["filter"], get_code_version(_RunStages._epoch, epoch_run),
+                                      trial_time=params["trial_time"])
+    elif exclude is not None:
+        keys["ica"] = get_stage_key("ica", keys["ica_fit"], get_code_version(_RunStages._ica, apply_ica),
+                                    exclude=[int(x) for x in exclude])
+        keys["epoch"] = get_stage_key("epoch", keys["ica"], get_code_version(_RunStages._epoch, epoch_run),
+                                      trial_time=params["trial_time"])
+    if "epoch" in keys:
+        keys["clean"] = get_stage_key("clean", keys["epoch"],
+                                      get_code_version(_RunStages._clean, clean_epochs, find_bad_epochs, robust_z),
+                                      z=params["bad_epoch_z"])
+        keys["resample"] = get_stage_key("resample", keys["clean"],
+                                         get_code_version(_RunStages._resample, resample_epochs, get_resample_factors,
+                                                          get_resample_filter, resample_poly_batch),
+                                         fs=params["fs"], trial_time=params["trial_time"])
+    return keys
+
+
+class _RunStages:
+    """
+    Runs (or loads from the cache) the preprocessing stages of a run on demand
+
+    A stage is only run when its output is requested and not in the cache, in which case the stages it depends on are
+    requested in turn. Every stage is run or loaded at most once.
+
+    The outputs are held by their stage and key, such that the stages of several variants of a run can share a store:
+    a stage with the same key is then run once for all variants. The stages that modify their input (filter, ICA and
+    clean and resample) work on a copy of it in a shared store.
+
+    The continuous data is only cached once filtered: the loaded data is read again from the xdf file (or its mirror),
+    and the markers and the ICA are applied again, when a later stage is not in the cache. These stages are cheap to
+    rerun, while every cached raw holds a full copy of the run.
+
+    Args:
+        fn (str): path of the xdf file
+        params (dict): preprocessing parameters
+        cache_path (str): root of the stage cache, None to disable caching
+        fn_ica (str, optional): path of an ICA fitted on all runs of the condition. Defaults to None (ICA per run).
+        store (dict, optional): outputs of the stages, shared between the variants of the run. Defaults to None (not
+            shared).
+        profiler (StageProfiler, optional): tracks the time and memory of the stages. Defaults to None (not tracked).
+        n_jobs (int, optional): number of threads filtering the channels. Defaults to 1.
+    """
+
+    # stages whose output is held in memory only
+    UNCACHED = ("load", "markers", "ica")
+
+    def __init__(self, fn: str, params: dict, cache_path: str, fn_ica: str = None, store: dict = None,
+                 profiler: StageProfiler = None, n_jobs: int = 1):
+        self.fn = fn
+        self.profiler = profiler
+        self.n_jobs = n_jobs
+        self.params = params
+        self.cache_path = cache_path
+        self.fn_ica = fn_ica
+        self.exclude = None
+        self.keys = get_stage_keys(fn, params, fn_ica=fn_ica)
+        self.shared = store is not None
+        self.states = store if self.shared else {}  # (stage, key) -> output of the stages run or loaded so far
+
+    def set_exclude(self, exclude: list):
+        self.exclude = exclude
+        self.keys = get_stage_keys(self.fn, self.params, exclude, self.fn_ica)
+
+    def get(self, name: str):
+        if (name, self.keys[name]) not in self.states:
+            cache_path = None if name in self.UNCACHED else self.cache_path
+            cached = cache_path is not None and os.path.isdir(get_stage_path(cache_path, name, self.keys[name]))
+            with self.profiler.stage(name, cached) if self.profiler is not None else nullcontext():
+                self.states[(name, self.keys[name])] = run_stage(cache_path, name, self.keys[name],
+                                                                 getattr(self, f"_{name}"))
+        return self.states[(name, self.keys[name])]
+
+    def get_copy(self, name: str):
+        # the output of a stage that is modified by the next one, copied if other variants may use it as well
+        state = self.get(name)
+        if not self.shared:
+            return state
+        return {field: value.copy() if isinstance(value, (mne.io.BaseRaw, mne.BaseEpochs)) else value
+                for field, value in state.items()}
+
+    def _load(self):
+        if self.params["memory_budget"] is None:
+            raw, labels = load_run(self.fn)
+            return {"raw": raw, "labels": labels}
+        check_memory_budget(self.fn, self.params)
+        raw, labels, events = load_run_low_memory(self.fn, self.params["fs"], self.params["cvep_h_freq"],
+                                                  self.params["trial_time"])
+        return {"raw": raw, "labels": labels, "events": events}
+
+    def _markers(self):
+        state = self.get("load")
+        # in low-memory mode, the events were found at the full rate while loading
+        events = state["events"] if "events" in state else find_trial_events(state["raw"])
+        return {"raw": state["raw"], "events": events, "labels": state["labels"]}
+
+    def _bad_channels(self):
+        if self.params["bad_channel_z"] is None:
+            return {"bads": {"channels": [], "scores": {}}}
+        return {"bads": find_bad_channels(self.get("markers")["raw"], self.params["bad_channel_z"],
+                                          self.params["notch"])}
+
+    def _filter(self):
+        bads = self.get("bad_channels")["bads"]
+        state = self.get_copy("markers")
+        state["raw"].info["bads"] = list(bads["channels"])
+        raw = filter_raw(state["raw"], self.params["cvep_l_freq"], self.params["cvep_h_freq"], self.params["notch"],
+                         self.params["filter_phase"], self.n_jobs)
+        set_biosemi_montage(raw)
+        return {"raw": raw, "events": state["events"], "labels": state["labels"]}
+
+    def _ica_fit(self):
+        if self.fn_ica is not None:
+            return {"ica": mne.preprocessing.read_ica(self.fn_ica, verbose=False)}
+        raw = self.get("filter")["raw"]
+        return {"ica": fit_ica(raw, get_ica_decim(raw.info["sfreq"], self.params["ica_sfreq"]))}
+
+    def _ica_select(self):
+        selection = classify_ica_components(self.get("ica_fit")["ica"], self.get("filter")["raw"],
+                                            self.params["ica_threshold"])
+        return {"selection": selection}
+
+    def _ica(self):
+        ica_obj = self.get("ica_fit")["ica"]
+        state = self.get_copy("filter")
+        raw = apply_ica(ica_obj, state["raw"], self.exclude)
+        return {"raw": raw, "events": state["events"], "labels": state["labels"]}
+
+    def _epoch(self):
+        state = self.get("ica" if self.params["use_ica"] else "filter")
+        epo = epoch_run(state["raw"], state["events"], self.params["trial_time"])
+        return {"epochs": epo, "labels": [state["labels"][i_trial] for i_trial in epo.selection]}
+
+    def _clean(self):
+        state = self.get_copy("epoch")
+        epo, labels, bads = clean_epochs(state["epochs"], state["labels"], self.params["bad_epoch_z"])
+        bads["channel_scores"] = self.get("bad_channels")["bads"]["scores"]
+        return {"epochs": epo, "labels": labels, "bads": bads}
+
+    def _resample(self):
+        state = self.get_copy("clean")
+        return {"eeg": resample_epochs(state["epochs"], self.params["fs"], self.params["trial_time"]),
+                "labels": state["labels"], "bads": state["bads"]}
+
+
+def get_ica_path(ica_path: str, subject: str, condition: str):
+    """
+    Returns the path of the ICA fitted on all runs of a subject and condition
+
+    Args:
+        ica_path (str): path of the ICA results
+        subject (str): subject name
+        condition (str): condition, e.g., 'overt' or 'covert'
+
+    Returns:
+        str: path of the fif file
+    """
+    return os.path.join(ica_path, f"ica_{subject}_{condition}-ica.fif")
+
+
+def fit_condition_ica(fns: list, params: dict, fn_ica: str, cache_path: str = None, fn_profile: str = None,
+                      n_jobs: int = 1):
+    """
+    Fits one ICA on the concatenated runs of a subject and condition and saves it
+
+    All runs then share the same components, such that the same exclusions apply to each of them. The fit is cached
+    under the keys of the filtered runs.
+
+    Args:
+        fns (list): paths of the xdf files of the runs
+        params (dict): preprocessing parameters (cvep_l_freq, cvep_h_freq, notch, filter_phase, ica_sfreq)
+        fn_ica (str): path of the fif file the ICA is saved to (see get_ica_path)
+        cache_path (str, optional): root of the stage cache. Defaults to None (no caching).
+        fn_profile (str, optional): path of the log the time and memory of the fit are appended to (see
+            stage_profile.get_profile_path). Defaults to None (no log).
+        n_jobs (int, optional): number of threads filtering the channels of a run. Defaults to 1.
+
+    Returns:
+        mne.preprocessing.ICA: the fitted ICA
+    """
+    runs = [_RunStages(fn, params, cache_path, n_jobs=n_jobs) for fn in fns]
+    key = get_stage_key("ica_condition", "".join(run.keys["filter"] for run in runs),
+                        get_code_version(fit_condition_ica, fit_ica, get_ica_decim), ica_sfreq=params["ica_sfreq"])
+
+    def ica_condition():
+        # the runs are decimated and concatenated as arrays (their effective sampling rates differ slightly), such that
+        # only the decimated data of all runs is held at once
+        data, info, bads = [], None, []
+        for run in runs:
+            raw = run.get("filter")["raw"].pick("eeg")
+            decim = get_ica_decim(raw.info["sfreq"], params["ica_sfreq"])
+            data.append(raw.get_data()[:, ::decim])
+            bads += [ch for ch in raw.info["bads"] if ch not in bads]
+            if info is None:
+                info = mne.create_info(raw.ch_names, raw.info["sfreq"] / decim, ch_types="eeg")
+                info.set_montage(raw.get_montage())
+            run.states.clear()
+        info["bads"] = bads  # channels that are bad in any run are left out of the fit
+        raw = mne.io.RawArray(np.concatenate(data, axis=1), info, verbose=False)
+        return {"ica": fit_ica(raw)}
+
+    cached = cache_path is not None and os.path.isdir(get_stage_path(cache_path, "ica_condition", key))
+    with profile_stage(fn_profile, "ica_condition", cached, runs=[os.path.basename(fn) for fn in fns]) as profiler:
+        for run in runs:  # the stages of the runs that the fit needs are logged as well
+            run.profiler = profiler
+        ica_obj = run_stage(cache_path, "ica_condition", key, ica_condition)["ica"]
+
+    # the saved ICA is only rewritten if it was fitted on other data or with other parameters, such that the stages
+    # of the runs that are keyed on its contents stay cached
+    fn_key = os.path.splitext(fn_ica)[0] + "_key.json"
+    if os.path.isfile(fn_ica) and os.path.isfile(fn_key):
+        with open(fn_key, "r") as fid:
+            if json.load(fid)["key"] == key:
+                return ica_obj
+    os.makedirs(os.path.dirname(fn_ica), exist_ok=True)
+    ica_obj.save(fn_ica, overwrite=True, verbose=False)
+    with open(fn_key, "w") as fid:
+        json.dump({"key": key, "runs": [os.path.basename(fn) for fn in fns]}, fid, indent=4)
+    print(f"ICA fitted on {len(fns)} run(s) saved to {os.path.basename(fn_ica)}")
+    return ica_obj
+
+
+def preprocess_run(fn: str, params: dict, exclude: list = None, cache_path: str = None, fn_log: str = None,
+                   fn_ica: str = None, store: dict = None, fn_profile: str = None, n_jobs: int = 1):
+    """
+    Runs all preprocessing stages on one run
+
+    With a cache, every stage is read from the cache if it was run before with the same input, parameters and code,
+    and only the stages after the first changed one are recomputed. With a memory budget, the run is loaded in
+    low-memory mode (see load_run_low_memory), fails early if it is not expected to fit the budget, and the time and
+    peak memory of every stage are printed.
+
+    Args:
+        fn (str): path of the xdf file
+        params (dict): preprocessing parameters (memory_budget, cvep_l_freq, cvep_h_freq, notch, filter_phase, fs,
+            trial_time, use_ica, ica_selection, ica_threshold, ica_fit_mode, ica_sfreq)
+        exclude (list, optional): ICA components to exclude, e.g., from a saved exclusion file. Defaults to None, in
+            which case they are selected automatically (ica_selection 'auto') or asked for (ica_selection 'manual').
+            Ignored if use_ica is False.
+        cache_path (str, optional): root of the stage cache. Defaults to None (no caching).
+        fn_log (str, optional): path of the json file logging the automatic selection. Defaults to None (no log).
+        fn_ica (str, optional): path of an ICA fitted on all runs of the condition (see fit_condition_ica). Defaults
+            to None, in which case an ICA is fitted on this run.
+        store (dict, optional): outputs of the stages shared with other variants of the run (see
+            preprocess_run_variants). Defaults to None (not shared).
+        fn_profile (str, optional): path of the log the time and memory of the stages are appended to (see
+            stage_profile.get_profile_path). Defaults to None (no log).
+        n_jobs (int, optional): number of threads filtering the channels. Defaults to 1.
+
+    Returns:
+        tuple: eeg data of the run (trials x channels x samples), labels of the remaining trials, the excluded ICA
+            components, and the interpolated channels and dropped trials (dict, see bad_data.clean_epochs)
+    """
+    profiler = StageProfiler() if params["memory_budget"] is not None or fn_profile is not None else None
+    with profiler if profiler is not None else nullcontext():
+        eeg, labels, exclude, bads = _preprocess_run(_RunStages(fn, params, cache_path, fn_ica, store, profiler,
+                                                                n_jobs), params, exclude, fn_log)
+    if params["memory_budget"] is not None:
+        profiler.report()
+    if fn_profile is not None:
+        profiler.write_log(fn_profile, run=os.path.basename(fn))
+    return eeg, labels, exclude, bads
+
+
+def _preprocess_run(run: _RunStages, params: dict, exclude: list, fn_log: str):
+    """
+    Selects the ICA components of a run and runs its stages up to the resampled trials, see preprocess_run
+    """
+    # select the components on the filtered data
+    if not params["use_ica"]:
+        exclude = []
+    elif exclude is None and params["ica_selection"] == "manual":
+        exclude = select_ica_components(run.get("ica_fit")["ica"], run.get("filter")["raw"])
+    elif exclude is None:
+        selection = run.get("ica_select")["selection"]
+        exclude = selection["exclude"]
+        if fn_log is not None:
+            os.makedirs(os.path.dirname(fn_log), exist_ok=True)
+            with open(fn_log, "w") as fid:
+                json.dump(dict(selection, run=os.path.basename(run.fn)), fid, indent=4)
+    else:
+        print(f"ICA components excluded from the exclusion file: {exclude}")
+    run.set_exclude(exclude)
+
+    state = run.get("resample")
+    return state["eeg"], state["labels"], exclude, state["bads"]
+
+
+def get_variant_label(name: str, variant: str):
+    """
+    Appends the name of a preprocessing variant to a name used in file names, e.g., covert -> covert_lp20
+
+    Args:
+        name (str): name, e.g., a condition or subject
+        variant (str): name of the variant, '' for the default variant (which is not appended)
+
+    Returns:
+        str: the name of the variant
+    """
+    return f"{name}_{variant}" if variant else name
+
+
+def get_variant_params(params: dict, variants: dict):
+    """
+    Builds the preprocessing parameters of each variant
+
+    Args:
+        params (dict): preprocessing parameters shared by the variants
+        variants (dict): variant name -> parameters that differ from params, e.g., {'lp20': {'cvep_h_freq': 20}}
+
+    Returns:
+        dict: variant name -> preprocessing parameters
+    """
+    return {variant: dict(params, **overrides) for variant, overrides in variants.items()}
+
+
+def preprocess_run_variants(fn: str, variants: dict, exclude: dict = None, cache_path: str = None, fn_log: dict = None,
+                            fn_ica: dict = None, fn_profile: dict = None, n_jobs: int = 1):
+    """
+    Runs all preprocessing stages on one run for several variants of the parameters
+
+    The stages are run variant by variant, but the output of every stage is kept (for this run), such that the stages
+    the variants have in common (e.g., loading and marker cleanup) are only run once.
+
+    Args:
+        fn (str): path of the xdf file
+        variants (dict): variant name -> preprocessing parameters (see get_variant_params)
+        exclude (dict, optional): variant name -> ICA components to exclude (see preprocess_run). Defaults to None.
+        cache_path (str, optional): root of the stage cache. Defaults to None (no caching).
+        fn_log (dict, optional): variant name -> path of the json file logging the automatic selection. Defaults to
+            None (no logs).
+        fn_ica (dict, optional): variant name -> path of an ICA fitted on all runs of the condition. Defaults to None
+            (ICA per run).
+        fn_profile (dict, optional): variant name -> path of the log of the time and memory of the stages. The stages
+            shared by the variants are logged for the first variant that runs them. Defaults to None (no logs).
+        n_jobs (int, optional): number of threads filtering the channels. Defaults to 1.
+
+    Returns:
+        dict: variant name -> eeg data of the run, trial labels, the excluded ICA components and the removed channels
+            and trials (see preprocess_run)
+    """
+    exclude, fn_log, fn_ica, fn_profile = exclude or {}, fn_log or {}, fn_ica or {}, fn_profile or {}
+    store = {} if len(variants) > 1 else None
+    results = {}
+    for variant, params in variants.items():
+        print(f"variant: {variant or 'default'}")
+        results[variant] = preprocess_run(fn, params, exclude.get(variant), cache_path, fn_log.get(variant),
+                                          fn_ica.get(variant), store, fn_profile.get(variant), n_jobs)
+    return results
+
+
+def combine_runs(eeg: list, labels_all: list, params: dict, codes_path: str):
+    """
+    Concatenates the runs of a condition and loads the codes at the target sampling frequency
+
+    The trials of all runs are written straight into one preallocated float32 array, cut to the trial time on the
+    way, such that every trial is copied once.
+
+    Args:
+        eeg (list): eeg data of each run (trials x channels x samples)
+        labels_all (list): trial labels of each run
+        params (dict): preprocessing parameters (fs, pr, trial_time, code)
+        codes_path (str): path of the codes
+
+    Returns:
+        tuple: X (trials x channels x samples), y (trials) and V (codes x samples)
+    """
+    fs = params["fs"]
+
+    # concatenate all runs of the condition, limiting the duration of data to trial time
+    n_samples = int(params["trial_time"] * fs)
+    n_trials = sum(len(X_run) for X_run in eeg)
+    X = np.empty((n_trials, eeg[0].shape[1], n_samples), dtype="float32")  # trials channels samples
+    i_trial = 0
+    for X_run in eeg:
+        X[i_trial:i_trial + len(X_run)] = X_run[:, :, :n_samples]
+        i_trial += len(X_run)
+    y = np.concatenate(labels_all, axis=0).astype("uint8")
+
+    # Load codes
+    V = np.load(os.path.join(codes_path, f'{params["code"]}.npz'))["codes"]
+    V = np.repeat(V, int(fs / params["pr"]), axis=1).astype("uint8")  # upsampling the code according to the downsampling freq and the presentation rate
+
+    print("Condition:", params["code"])
+    print("\tX:", X.shape)
+    print("\ty:", y.shape)
+    print("\tV:", V.shape)
+    return X, y, V
+
+
+def load_ica_exclusions(ica_path: str, subject: str):
+    """
+    Loads the ICA components that were excluded per condition for a subject
+
+    Args:
+        ica_path (str): path of the ICA results
+        subject (str): subject name
+
+    Returns:
+        dict: condition -> indices of the excluded components (empty if none were saved)
+    """
+    fn = os.path.join(ica_path, f"ica_exclusions_{subject}.json")
+    if not os.path.isfile(fn):
+        return {}
+    with open(fn, "r") as fid:
+        return json.load(fid)
+
+
+def save_ica_exclusions(ica_path: str, subject: str, condition: str, exclude: list):
+    """
+    Saves the ICA components excluded for a subject and condition, such that later (batch) runs reuse them
+
+    Args:
+        ica_path (str): path of the ICA results
+        subject (str): subject name
+        condition (str): condition, e.g., 'overt' or 'covert'
+        exclude (list): indices of the excluded components
+    """
+    exclusions = load_ica_exclusions(ica_path, subject)
+    exclusions[condition] = [int(x) for x in exclude]
+    os.makedirs(ica_path, exist_ok=True)
+    with open(os.path.join(ica_path, f"ica_exclusions_{subject}.json"), "w") as fid:
+        json.dump(exclusions, fid, indent=4)
@@ -5,20 +5,20 @@ author(s): Shekhar Narayanan (shekharnarayanan833@gmail.com), Jordy Thielen (jor
 Read and preprocess raw eeg data
 """
 import os
-import pyxdf
-import numpy as np
-import mne
-from mnelab.io import read_raw
-import easygui
-import pyntbci
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
+from preprocessing import get_run_path, get_ica_path, fit_condition_ica, preprocess_run_variants, combine_runs, \
+    load_ica_exclusions, save_ica_exclusions, get_variant_label, get_variant_params
+from dataset import get_derivative_path, save_derivative
+from ica_report import save_subject_report
+from stage_profile import get_profile_path, profile_stage
+from trial_store import build_trial_store
 
 # paths
 exp_path = r'C:\Users\s1081686\Desktop\RA_Project\Scripts\pynt_codes\version_2\experiment_version_2'
 data_path = os.path.join(exp_path,'data_full_experiment') # path for raw data
 codes_path = os.path.join(exp_path,'codes')
 ica_path = os.path.join(exp_path,'ica_images')
+cache_path = os.path.join(data_path, 'cache') # cached output of the preprocessing stages
+profile_path = os.path.join(data_path, 'profile') # time and memory of the stages per run (JSON lines), None to skip
 
 
 # subject and sessio
@@ -38,192 +38,148 @@ covert_runs = 4
 cvep_l_freq = 1 # low pass
 cvep_h_freq = 40# 40 high pass
 notch = 50
+filter_phase = 'zero' # 'zero': forward-backward (offline), 'causal': forward only (as an online filter)
+filter_jobs = os.cpu_count() # threads filtering the channels of a run (batch_preprocess.py shares the CPUs per worker)
 
 # trial time 
 trial_time = 20 # in seconds
 
+# bad channel and trial params
+bad_channel_z = None # robust z-score (deviation, correlation, noise) beyond which a channel is interpolated, e.g., 5
+bad_epoch_z = None # robust z-score (amplitude, variance) above which a trial is dropped, e.g., 5
+# N.B. both are off by default: dropping trials changes y and the chronological folds of analyze_data.ipynb
+
+# memory params
+memory_budget = None # memory (GB) a run may take: loads only the eeg channels and Trig1, decimated early, fails early
+# if a run is not expected to fit, and reports the peak memory per stage. None for the full-rate preprocessing
+
+# ICA params
+use_ica = True # False to skip the ICA altogether
+ica_selection = 'auto' # 'auto': exclude components correlating with frontal/EyeLink eye proxies, 'manual': ask
+ica_threshold = 0.7 # absolute correlation with a proxy above which a component is excluded (automatic selection)
+ica_fit_mode = 'condition' # 'condition': one ICA fitted on all runs of a subject/condition, 'run': one ICA per run
+ica_sfreq = 256 # the ICA is fitted on the data decimated to about this rate, None to fit on the full rate
+# N.B. components saved in ica_exclusions_{subject}.json override the selection for that subject and condition
+ica_report = True # render the excluded components once per subject, after its runs are preprocessed
+
+# store params
+trial_stores = True # save the eeg, gaze and stimulus state of the trials in one store next to every derivative
+compress_derivatives = False # save the eeg data of the derivatives compressed per trial (see chunked_archive.py)
+
 # conditions
 conditions =['overt', 'covert']
 
-for i_subject, subject in enumerate(subjects):
-    
-    print(f"starting preprocessing for subject {i_subject}") # only one subject
-          
-    for i_condition, condition in enumerate(conditions):
-        
-        print("condition:",condition)
-        
-        eeg = []  # eeg data for a subject
-        labels_all=[] # labels for a subject
-        
-        if condition == 'overt':
-            i_run_range = overt_runs  
-            
-        else:
-            i_run_range = covert_runs
-        
-        for i_run in range(i_run_range): # 
-            
-            # Load xdf data into MNE
-            fn = os.path.join(data_path, "raw", f"sub-{subject}", ses, "eeg", 
-                f"sub-{subject}_{ses}_task-{condition}_run-{1 + i_run:03d}_eeg.xdf")
-                       
-            # read data from BioSemi stream
-            streams = pyxdf.resolve_streams(fn)
-            names = [stream["name"] for stream in streams]
-
-            stream_id = streams[names.index("BioSemi")]["stream_id"]
-            raw = read_raw(fn, stream_ids=[stream_id])
-           
-            # Adjust marker channel data
-            raw._data[0, :] = (raw._data[0, :] - np.median(raw._data[0, :])) > 0
-            raw._data[0, :] = np.logical_and(raw._data[0, :], np.roll(raw._data[0, :], -1)).astype(raw._data[0, :].dtype)
-            events = mne.find_events(raw, stim_channel="Trig1")
-                           
-            print("events found:", len(events))
-
-            # Filtering
-            raw = raw.filter(l_freq=cvep_l_freq, h_freq=cvep_h_freq, 
-                picks=np.arange(1, 65), method="iir", 
-                iir_params=dict(order=6, ftype='butter'))
-                               
-            # adding a notch filter
-            raw.notch_filter(freqs=np.arange(notch,raw.info["sfreq"]/2,notch))
-                
-            # apply ICA to channels
-            picks_eeg = mne.pick_types(raw.info, meg = False, eeg = True, eog = False, stim = False)            
-            ica_obj = mne.preprocessing.ICA(n_components = 64,   
-                                            method =  'fastica',                                          
-                                            max_iter = 'auto',
-                                            random_state = 97 
-                                            # fit_params = dict(extended = True)
-                                            )
-            
-            # # Setting montage for biosemi (needed for topoplots)
-            
-            # Read cap file
-            capfile = os.path.join(os.path.dirname(pyntbci.__file__), "capfiles", "biosemi64.loc") 
-            with open(capfile, "r") as fid:
-                channels = []
-                for line in fid.readlines():
-                    channels.append(line.split("\t")[-1].strip())
-            
-            chan_names_old = raw.info.ch_names[1:65]
-            
-            mapping = {}
-            
-            for key, channel in zip(chan_names_old, channels):
-                mapping[key] = channel
-            
-  
-            mne.rename_channels(raw.info,mapping = mapping)
-            montage = mne.channels.read_custom_montage(fname = capfile)
-            # print(montage)
-            raw.set_montage(montage)
-            
-            ica_obj.fit(raw, picks = picks_eeg)    # fitting the ica
-            ica =  ica_obj.get_sources(raw).get_data()
-            print("shape of ica matrix",ica.shape)
-            
-            # plotting ICA results
-            src = ica_obj.plot_sources(raw)
-            comp = ica_obj.plot_components(picks = None, show = True, inst = raw)# what does this actually show????
-
-            # Applying ICA results to raw data and removing noisy components
-            if i_run == 0: # check only the components for the first run per condition. For the rest of the runs, these components are automatically removed
-                exclude_vec_str = easygui.enterbox("Enter the component(s) you would like to exclude with a space between them. For example: 1 2 3")
-                vector_list =  [int(x) for x in exclude_vec_str.split()]
-                
-            ica_obj.exclude = vector_list
-            
-            # save removed components as images
-            components_per_page = 5
-            with PdfPages(os.path.join(ica_path,f'excluded_ica_components_{subject}.pdf')) as pdf:
-                n_excluded_components = len(vector_list)
-                n_pages = (n_excluded_components + components_per_page - 1) // components_per_page
-                
-                for page in range(n_pages):
-                    start_idx = page * components_per_page
-                    end_idx = min(start_idx + components_per_page, n_excluded_components)
-                    actual_components_per_page = end_idx - start_idx
-                    
-                    fig, axes = plt.subplots(nrows=actual_components_per_page, ncols=1, figsize=(8.27, 11.69))  # A4 size in inches
-                    
-                    if actual_components_per_page == 1:
-                        axes = [axes]  # Ensure axes is iterable
-                    
-                    for i, ax in enumerate(axes):
-                        component_index = vector_list[start_idx + i]
-                        ica_obj.plot_components(picks=[component_index], axes=ax, show=False, inst=raw)
-                        ax.set_title(f'Excluded ICA Component {component_index}')
-                    
-                    pdf.savefig(fig)
-                    plt.close(fig)  # Close the figure after saving to the PDF
-
-            print("Excluded ICA component plots saved to excluded_ica_components.pdf")
-            
-            print("type ica obj.exclude",type(ica_obj.exclude))
-            ica_obj.apply(raw) 
-    
-            
-            # Extract labels from marker stream
-            streams = pyxdf.load_xdf(fn)[0]
-            names = [stream["info"]["name"][0] for stream in streams]
-            marker_stream = streams[names.index("KeyboardMarkerStream")]
-                             
-            labels = [marker[3].lower().strip('""') == "right" 
-            for marker in marker_stream["time_series"]
-            if marker[2] == "cued_side"]
-            
-            print("labels",len(labels))
-
-            # epoch the data with the trial duration 
-            epo = mne.Epochs(raw, events=events, tmin=-0.5, 
-                tmax=trial_time, baseline= None, picks="eeg", 
-                preload=True)           
-            
-            # Resampling
-            # N.B. Downsampling is done after slicing to maintain accurate 
-            # stimulus timing
-            epo = epo.resample(sfreq=fs)
-            
-            # appending data for the subject
-            eeg.append(epo.get_data(tmin=0, tmax=trial_time))
-            labels_all.append(labels)
-           
-
-        # Extract data 
-        if condition == 'covert':  # concatenate all four covert runs          
-            X = np.squeeze(np.concatenate(eeg, axis=0)).astype("float32")  # trials channels samples
-            y = np.concatenate(labels_all, axis=0).astype("uint8")
-            
-        else:
-            X = np.squeeze(np.array(eeg)).astype("float32") 
-            y = np.array(labels).astype("uint8")
-        
-        # name of the code used
-        code ='mgold_61_6521'
-        
-        # limiting the duration of data to trial time
-        X = X[:, :, :int(trial_time * fs)]
-        
-        # Load codes       
-        V = np.load(os.path.join(codes_path,f'{code}.npz'))["codes"]
-        
-        V = np.repeat(V, int(fs / pr), axis=1).astype("uint8") # upsampling the code according to the downsampling freq and the presentation rate
-        
-        print("Condition:", code)
-        print("\tX:", X.shape)
-        print("\ty:", y.shape)
-        print("\tV:", V.shape)
-
-        # Save data
-        cvep = f"{subject}_cvep_{condition}_{code}.npz"
-        
-        results_path = os.path.join(data_path, 'derivatives', subject)
-        if not os.path.isdir(results_path):
-            os.makedirs(results_path)
-        fn = os.path.join(results_path, cvep)
-        # np.savez(fn, X=X, y=y, V=V, fs=fs)
-        
-        print(f"data saved for subject {i_subject + 1}")
+# name of the code used
+code ='mgold_61_6521'
+
+# parameters passed to the preprocessing stages
+params = {"fs": fs, "pr": pr, "cvep_l_freq": cvep_l_freq, "cvep_h_freq": cvep_h_freq, "notch": notch,
+          "filter_phase": filter_phase, "trial_time": trial_time, "code": code, "bad_channel_z": bad_channel_z,
+          "bad_epoch_z": bad_epoch_z, "memory_budget": memory_budget, "use_ica": use_ica,
+          "ica_selection": ica_selection, "ica_threshold": ica_threshold, "ica_fit_mode": ica_fit_mode,
+          "ica_sfreq": ica_sfreq}
+
+# preprocessing variants: name -> parameters that differ from the ones above. All variants are run in one pass, where
+# the stages they have in common (loading, marker cleanup and any stage with the same parameters) are run once per run.
+# Each variant is saved as a separate derivative, with its name appended to the condition ({subject}_cvep_covert_lp20_
+# {code}.npz), except the default variant ''.
+# e.g., {'': {}, 'lp20': {'cvep_h_freq': 20}, 'fs240': {'fs': 240}, 'noica': {'use_ica': False}}
+variants = {'': {}}
+variant_params = get_variant_params(params, variants)
+
+if __name__ == "__main__":
+
+    for i_subject, subject in enumerate(subjects):
+
+        print(f"starting preprocessing for subject {i_subject}") # only one subject
+        saved_exclusions = load_ica_exclusions(ica_path, subject)
+        report_runs = {variant: {} for variant in variants} # xdf file and excluded ICA components per run and condition
+
+        for i_condition, condition in enumerate(conditions):
+
+            print("condition:",condition)
+
+            eeg = {variant: [] for variant in variants}  # eeg data for a subject
+            labels_all = {variant: [] for variant in variants} # labels for a subject
+            exclude_all = {variant: [] for variant in variants} # excluded ICA components per run
+            bads_all = {variant: [] for variant in variants} # interpolated channels and dropped trials per run
+
+            if condition == 'overt':
+                i_run_range = overt_runs
+
+            else:
+                i_run_range = covert_runs
+
+            # fit one ICA on all runs of the condition, shared by the runs (saved to ica_path for reuse)
+            fn_ica = {}
+            for variant, v_params in variant_params.items():
+                if v_params["use_ica"] and v_params["ica_fit_mode"] == 'condition':
+                    label = get_variant_label(condition, variant)
+                    fn_ica[variant] = get_ica_path(ica_path, subject, label)
+                    fns = [get_run_path(data_path, subject, ses, condition, i_run) for i_run in range(i_run_range)]
+                    fit_condition_ica(fns, v_params, fn_ica[variant], cache_path,
+                                      get_profile_path(profile_path, subject, f'{label}_ica'), filter_jobs)
+
+            vector_list = {}
+            for i_run in range(i_run_range): #
+
+                # Load xdf data into MNE
+                fn = get_run_path(data_path, subject, ses, condition, i_run)
+
+                # saved components override the selection
+                # with manual selection, check only the components for the first run per condition. For the rest of the runs, these components are automatically removed
+                exclude, fn_log, fn_profile = {}, {}, {}
+                for variant in variants:
+                    label = get_variant_label(condition, variant)
+                    exclude[variant] = saved_exclusions.get(label)
+                    if exclude[variant] is None and variant_params[variant]["ica_selection"] == 'manual' and i_run > 0:
+                        exclude[variant] = vector_list[variant]
+                    fn_log[variant] = os.path.join(ica_path,
+                                                   f'ica_selection_{subject}_{label}_run-{1 + i_run:03d}.json')
+                    fn_profile[variant] = get_profile_path(profile_path, subject, f'{label}_run-{1 + i_run:03d}')
+                results = preprocess_run_variants(fn, variant_params, exclude=exclude, cache_path=cache_path,
+                                                  fn_log=fn_log, fn_ica=fn_ica, fn_profile=fn_profile,
+                                                  n_jobs=filter_jobs)
+
+                for variant, (X_run, labels, vector_list[variant], bads) in results.items():
+                    label = get_variant_label(condition, variant)
+                    if i_run == 0 and variant_params[variant]["ica_selection"] == 'manual' and \
+                            variant_params[variant]["use_ica"] and label not in saved_exclusions:
+                        save_ica_exclusions(ica_path, subject, label, vector_list[variant])
+
+                    # appending data for the subject
+                    eeg[variant].append(X_run)
+                    labels_all[variant].append(labels)
+                    exclude_all[variant].append(vector_list[variant])
+                    bads_all[variant].append(bads)
+
+            for variant, v_params in variant_params.items():
+                label = get_variant_label(condition, variant)
+
+                with profile_stage(get_profile_path(profile_path, subject, f'{label}_save'), "save"):
+                    # Extract data
+                    X, y, V = combine_runs(eeg[variant], labels_all[variant], v_params, codes_path)
+
+                    # Save data
+                    fn = get_derivative_path(data_path, subject, label, code)
+                    save_derivative(fn, X, y, V, v_params["fs"],
+                                    settings=dict(v_params, exclude=exclude_all[variant], bads=bads_all[variant]),
+                                    compress=compress_derivatives)
+
+                # trial-locked eeg, gaze and stimulus state in one store
+                if trial_stores:
+                    with profile_stage(get_profile_path(profile_path, subject, f'{label}_trials'), "trial_store"):
+                        build_trial_store(fn, [get_run_path(data_path, subject, ses, condition, i_run)
+                                               for i_run in range(i_run_range)])
+
+                print(f"data saved for subject {i_subject + 1}, {label}")
+                report_runs[variant][label] = [(get_run_path(data_path, subject, ses, condition, i_run),
+                                                exclude_all[variant][i_run]) for i_run in range(i_run_range)]
+
+        # report of the excluded components, rendered from the saved ICA objects
+        if ica_report:
+            for variant, v_params in variant_params.items():
+                if v_params["use_ica"]:
+                    fn_profile = get_profile_path(profile_path, subject, get_variant_label('report', variant))
+                    save_subject_report(subject, report_runs[variant], v_params, ica_path, cache_path, variant=variant,
+                                        fn_profile=fn_profile)
@@ -0,0 +1,217 @@
+"""
+Content-addressed cache for the preprocessing stages
+
+The output of every stage is stored under a key that is built from the key of the stage before it, the parameters of
+the stage and the source code of the functions it runs. The key of the first stage starts from the hash of the .xdf
+file. Changing a parameter (or the code of a stage) therefore changes the keys of that stage and of all stages after
+it, while the stages before it are still read from the cache.
+
+The cache is laid out as {cache_path}/{stage}/{key}/, holding the MNE objects as .fif files (in double precision, such
+that cached and recomputed results are identical) and the remaining arrays as .npy/.json files.
+"""
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import numpy as np
+import mne
+
+
+def _file_signature(fn: str):
+    """
+    Returns the size and modification time of a file, used to detect a stale file hash
+
+    Args:
+        fn (str): path to the file
+
+    Returns:
+        dict: size (bytes) and modification time (ns) of the file
+    """
+    stat = os.stat(fn)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_file_hash(fn: str):
+    """
+    Returns the sha256 hash of the contents of a file
+
+    The hash is stored next to the file (sub-..._eeg.xdf -> sub-..._eeg_sha256.json) and only recomputed when the size
+    or modification time of the file changed.
+
+    Args:
+        fn (str): path to the file
+
+    Returns:
+        str: hex digest of the file contents
+    """
+    fn_hash = os.path.splitext(fn)[0] + "_sha256.json"
+    signature = _file_signature(fn)
+    if os.path.isfile(fn_hash):
+        with open(fn_hash, "r") as fid:
+            saved = json.load(fid)
+        if saved["source"] == signature:
+            return saved["sha256"]
+
+    sha = hashlib.sha256()
+    with open(fn, "rb") as fid:
+        for block in iter(lambda: fid.read(2 ** 20), b""):
+            sha.update(block)
+
+    # written under a temporary name and renamed, as workers may hash the same file at the same time
+    with open(f"{fn_hash}.tmp{os.getpid()}", "w") as fid:
+        json.dump({"source": signature, "sha256": sha.hexdigest()}, fid)
+    os.replace(f"{fn_hash}.tmp{os.getpid()}", fn_hash)
+    return sha.hexdigest()
+
+
+def get_code_version(*funcs):
+    """
+    Returns a version string of the code run by a stage
+
+    Args:
+        *funcs (callable): the functions run by the stage
+
+    Returns:
+        str: hash of the source code of the functions and the MNE version
+    """
+    sha = hashlib.sha256(mne.__version__.encode())
+    for func in funcs:
+        sha.update(inspect.getsource(func).encode())
+    return sha.hexdigest()[:16]
+
+
+def get_stage_key(stage: str, upstream: str, code_version: str, **params):
+    """
+    Builds the cache key of a stage
+
+    Args:
+        stage (str): name of the stage
+        upstream (str): key of the previous stage (or the hash of the input file for the first stage)
+        code_version (str): version of the code run by the stage (see get_code_version)
+        **params: parameters of the stage, must be json serializable
+
+    Returns:
+        str: the cache key
+    """
+    content = json.dumps({"stage": stage, "upstream": upstream, "code": code_version, "params": params},
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def get_stage_path(cache_path: str, stage: str, key: str):
+    """
+    Returns the directory holding the cached output of a stage
+
+    Args:
+        cache_path (str): root of the cache
+        stage (str): name of the stage
+        key (str): cache key of the stage
+
+    Returns:
+        str: path of the directory
+    """
+    return os.path.join(cache_path, stage, key)
+
+
+def save_state(path: str, state: dict):
+    """
+    Saves the output of a stage
+
+    The files are first written to a temporary directory that is renamed when complete, such that an interrupted write
+    (or two workers writing the same stage) never leaves a partial entry in the cache.
+
+    Args:
+        path (str): directory of the cache entry
+        state (dict): output of the stage with any of the keys raw (mne.io.BaseRaw), epochs (mne.Epochs), ica
+            (mne.preprocessing.ICA), eeg (np.ndarray), events (np.ndarray), labels (list), selection (dict) and bads
+            (dict)
+    """
+    path_tmp = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(path_tmp, ignore_errors=True)
+    os.makedirs(path_tmp)
+
+    if "raw" in state:
+        state["raw"].save(os.path.join(path_tmp, "raw.fif"), fmt="double", verbose=False)
+    if "epochs" in state:
+        state["epochs"].save(os.path.join(path_tmp, "epochs-epo.fif"), fmt="double", verbose=False)
+    if "ica" in state:
+        state["ica"].save(os.path.join(path_tmp, "fit-ica.fif"), verbose=False)
+        # read_ica recomputes the mixing matrix as the pseudo-inverse of the unmixing matrix, which differs in the last
+        # bits, so the original one is kept as well
+        np.save(os.path.join(path_tmp, "ica_mixing.npy"), state["ica"].mixing_matrix_)
+    for name in ["eeg", "events"]:
+        if name in state:
+            np.save(os.path.join(path_tmp, f"{name}.npy"), state[name])
+    if "labels" in state:
+        with open(os.path.join(path_tmp, "labels.json"), "w") as fid:
+            json.dump([bool(label) for label in state["labels"]], fid)
+    for name in ["selection", "bads"]:
+        if name in state:
+            with open(os.path.join(path_tmp, f"{name}.json"), "w") as fid:
+                json.dump(state[name], fid)
+
+    try:
+        os.replace(path_tmp, path)
+    except OSError:  # the entry was written by another worker in the meantime
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+
+def load_state(path: str):
+    """
+    Loads the output of a stage
+
+    Args:
+        path (str): directory of the cache entry
+
+    Returns:
+        dict: output of the stage (see save_state)
+    """
+    state = {}
+    if os.path.isfile(os.path.join(path, "raw.fif")):
+        state["raw"] = mne.io.read_raw_fif(os.path.join(path, "raw.fif"), preload=True, verbose=False)
+    if os.path.isfile(os.path.join(path, "epochs-epo.fif")):
+        state["epochs"] = mne.read_epochs(os.path.join(path, "epochs-epo.fif"), preload=True, verbose=False)
+    if os.path.isfile(os.path.join(path, "fit-ica.fif")):
+        state["ica"] = mne.preprocessing.read_ica(os.path.join(path, "fit-ica.fif"), verbose=False)
+        state["ica"].mixing_matrix_ = np.load(os.path.join(path, "ica_mixing.npy"))
+    for name in ["eeg", "events"]:
+        if os.path.isfile(os.path.join(path, f"{name}.npy")):
+            state[name] = np.load(os.path.join(path, f"{name}.npy"))
+    if os.path.isfile(os.path.join(path, "labels.json")):
+        with open(os.path.join(path, "labels.json"), "r") as fid:
+            state["labels"] = json.load(fid)
+    for name in ["selection", "bads"]:
+        if os.path.isfile(os.path.join(path, f"{name}.json")):
+            with open(os.path.join(path, f"{name}.json"), "r") as fid:
+                state[name] = json.load(fid)
+    return state
+
+
+def run_stage(cache_path: str, stage: str, key: str, compute):
+    """
+    Returns the output of a stage from the cache, or computes and caches it
+
+    The stages before this one are only run (or loaded) from within compute, so they are skipped entirely on a hit.
+
+    Args:
+        cache_path (str): root of the cache, None to disable caching
+        stage (str): name of the stage
+        key (str): cache key of the stage
+        compute (callable): computes the output of the stage (see save_state) on a cache miss
+
+    Returns:
+        dict: output of the stage
+    """
+    if cache_path is None:
+        return compute()
+
+    path = get_stage_path(cache_path, stage, key)
+    if os.path.isdir(path):
+        print(f"{stage}: loaded from cache")
+        return load_state(path)
+
+    state = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_state(path, state)
+    return state
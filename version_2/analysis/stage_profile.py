@@ -0,0 +1,245 @@
+"""
+Wall time, CPU time and peak memory of the preprocessing stages
+
+Every stage of a run (load, markers, bad_channels, filter, ica_fit, ica_select, ica, epoch, clean and resample) and the
+stages of a subject (the condition ICA fit, saving the derivatives and trial stores, and rendering the report) are timed
+and their resident memory (RSS) is sampled in a background thread. The records are appended to a JSON lines log per run
+and per subject under {profile_path}/{subject}/, one line per stage:
+    time: start of the pass that wrote the record (ISO format)
+    stage: name of the stage
+    wall_s, cpu_s: wall and CPU time (all threads of the process, not its child processes) of the stage itself, i.e.,
+        without the stages it ran for its input
+    start_mb, peak_mb, increase_mb: RSS when the stage started, its peak and its increase while the stage ran (MB)
+    cached: whether the stage was read from the stage cache
+plus the fields of the log (e.g., the run or the variant).
+
+Every log has a single writer (a run and variant, the condition ICA, the derivatives or the trial store of a condition
+and variant, or the report of a variant), such that the records of the last pass through the pipeline are the latest
+ones of each log.
+Run as a script, it summarizes the last pass of all logs per stage and per subject.
+"""
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+import numpy as np
+import psutil
+
+
+class StageProfiler:
+    """
+    Tracks the wall time, CPU time and peak resident memory (RSS) of the process per stage
+
+    The memory is sampled in a background thread and attributed to the innermost running stage, i.e., the time and
+    memory taken by a stage that is run to provide the input of another one is counted for that stage only. The
+    increase of a stage is measured from the memory in use when it started, or when the last stage it ran for its input
+    finished.
+
+    Args:
+        interval (float, optional): sampling interval in seconds. Defaults to 0.005.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.records = []  # one dict per finished stage, in the order they finished
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self._stack = []  # running stages, innermost last
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+    def _update(self):
+        rss = self._process.memory_info().rss
+        with self._lock:
+            if self._stack:
+                entry = self._stack[-1]
+                entry["peak"] = max(entry["peak"], rss)
+                entry["increase"] = max(entry["increase"], rss - entry["base"])
+        return rss
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update()
+
+    @contextmanager
+    def stage(self, name: str, cached: bool = False):
+        """
+        Attributes the time and memory taken while the block runs to a stage
+
+        Args:
+            name (str): name of the stage
+            cached (bool, optional): whether the stage is read from the stage cache. Defaults to False.
+        """
+        rss = self._process.memory_info().rss
+        entry = {"wall": time.perf_counter(), "cpu": time.process_time(), "base": rss, "peak": rss, "increase": 0,
+                 "inner_wall": 0.0, "inner_cpu": 0.0}
+        with self._lock:
+            self._stack.append(entry)
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - entry["wall"], time.process_time() - entry["cpu"]
+            rss = self._update()
+            with self._lock:
+                self._stack.pop()
+                if self._stack:  # the stage that requested this one continues from here
+                    self._stack[-1]["base"] = rss
+                    self._stack[-1]["inner_wall"] += wall
+                    self._stack[-1]["inner_cpu"] += cpu
+            self.records.append({"stage": name, "wall_s": round(wall - entry["inner_wall"], 3),
+                                 "cpu_s": round(cpu - entry["inner_cpu"], 3),
+                                 "start_mb": round(entry["base"] / 1024 ** 2, 1),
+                                 "peak_mb": round(entry["peak"] / 1024 ** 2, 1),
+                                 "increase_mb": round(entry["increase"] / 1024 ** 2, 1), "cached": cached})
+
+    def report(self):
+        """
+        Prints the time and peak memory of every stage, in the order the stages finished
+
+        Returns:
+            list: one record per stage
+        """
+        print(f"{'stage':<14}{'wall (s)':>10}{'cpu (s)':>10}{'start (MB)':>12}{'peak (MB)':>12}{'increase (MB)':>15}")
+        for record in self.records:
+            print(f"{record['stage']:<14}{record['wall_s']:>10.2f}{record['cpu_s']:>10.2f}{record['start_mb']:>12.0f}"
+                  f"{record['peak_mb']:>12.0f}{record['increase_mb']:>15.0f}{'  (cached)' if record['cached'] else ''}")
+        return self.records
+
+    def write_log(self, fn: str, **fields):
+        """
+        Appends the records of the stages to a JSON lines log
+
+        Args:
+            fn (str): path of the log
+            **fields: fields added to every record, e.g., the run or the variant
+        """
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "a") as fid:
+            for record in self.records:
+                fid.write(json.dumps(dict(time=self.started, **record, **fields)) + "\n")
+
+
+def get_profile_path(profile_path: str, subject: str, name: str):
+    """
+    Returns the path of a log of a subject
+
+    Args:
+        profile_path (str): root of the logs, None to disable them
+        subject (str): subject name
+        name (str): name of the log, e.g., covert_run-001 for a run, covert_ica for the ICA of the condition
+
+    Returns:
+        str: path of the JSON lines log, or None if profile_path is None
+    """
+    if profile_path is None:
+        return None
+    return os.path.join(profile_path, subject, f"{name}.jsonl")
+
+
+@contextmanager
+def profile_stage(fn: str, name: str, cached: bool = False, **fields):
+    """
+    Profiles the block as one stage and appends it, and any stages run inside it with the profiler, to a log
+
+    Args:
+        fn (str): path of the log, None to run the block without profiling
+        name (str): name of the stage
+        cached (bool, optional): whether the stage is read from the stage cache. Defaults to False.
+        **fields: fields added to the records, see StageProfiler.write_log
+
+    Yields:
+        StageProfiler: the profiler, None if fn is None
+    """
+    if fn is None:
+        yield None
+        return
+    with StageProfiler() as profiler:
+        with profiler.stage(name, cached):
+            yield profiler
+    profiler.write_log(fn, **fields)
+
+
+def read_profiles(profile_path: str, latest: bool = True):
+    """
+    Reads the logs of all subjects
+
+    Args:
+        profile_path (str): root of the logs
+        latest (bool, optional): only keep the records of the last pass written to every log. Defaults to True.
+
+    Returns:
+        list: records, with the subject (directory of the log) and the log name added
+    """
+    records = []
+    for subject in sorted(os.listdir(profile_path)):
+        if not os.path.isdir(os.path.join(profile_path, subject)):
+            continue
+        for fn in sorted(os.listdir(os.path.join(profile_path, subject))):
+            if not fn.endswith(".jsonl"):
+                continue
+            with open(os.path.join(profile_path, subject, fn), "r") as fid:
+                log = [dict(json.loads(line), subject=subject, log=fn[:-len(".jsonl")]) for line in fid if line.strip()]
+            if latest and log:
+                last = max(record["time"] for record in log)
+                log = [record for record in log if record["time"] == last]
+            records += log
+    return records
+
+
+def summarize_profiles(profile_path: str, latest: bool = True, include_cached: bool = False):
+    """
+    Prints the time and memory of every stage over all runs and subjects, and the total time per subject
+
+    Args:
+        profile_path (str): root of the logs
+        latest (bool, optional): only summarize the last pass of every log. Defaults to True.
+        include_cached (bool, optional): include the stages read from the stage cache. Defaults to False.
+
+    Returns:
+        dict: per stage, the number of records and the median and maximum wall time, CPU time and RSS increase, and
+            the total wall and CPU time
+    """
+    records = [record for record in read_profiles(profile_path, latest) if include_cached or not record["cached"]]
+    summary = {}
+    for stage in dict.fromkeys(record["stage"] for record in records):
+        stage_records = [record for record in records if record["stage"] == stage]
+        summary[stage] = {"n": len(stage_records)}
+        for field in ("wall_s", "cpu_s", "increase_mb"):
+            values = np.array([record[field] for record in stage_records])
+            summary[stage][f"median_{field}"] = float(np.median(values))
+            summary[stage][f"max_{field}"] = float(values.max())
+        summary[stage]["total_wall_s"] = sum(record["wall_s"] for record in stage_records)
+        summary[stage]["total_cpu_s"] = sum(record["cpu_s"] for record in stage_records)
+
+    print(f"{'stage':<14}{'n':>5}{'median wall (s)':>17}{'max wall (s)':>14}{'total wall (s)':>16}{'total cpu (s)':>15}"
+          f"{'median increase (MB)':>22}{'max increase (MB)':>19}")
+    for stage, entry in sorted(summary.items(), key=lambda item: -item[1]["total_wall_s"]):
+        print(f"{stage:<14}{entry['n']:>5}{entry['median_wall_s']:>17.2f}{entry['max_wall_s']:>14.2f}"
+              f"{entry['total_wall_s']:>16.1f}{entry['total_cpu_s']:>15.1f}{entry['median_increase_mb']:>22.0f}"
+              f"{entry['max_increase_mb']:>19.0f}")
+
+    print(f"\n{'subject':<14}{'wall (s)':>10}{'cpu (s)':>10}")
+    for subject in dict.fromkeys(record["subject"] for record in records):
+        subject_records = [record for record in records if record["subject"] == subject]
+        print(f"{subject:<14}{sum(record['wall_s'] for record in subject_records):>10.1f}"
+              f"{sum(record['cpu_s'] for record in subject_records):>10.1f}")
+    return summary
+
+
+if __name__ == "__main__":
+    from read_and_preprocess_data import profile_path
+
+    summarize_profiles(profile_path)
@@ -0,0 +1,258 @@
+"""
+Dynamic stopping: simulates deciding on a trial as soon as its scores are reliable enough
+
+A trial is scored on its first samples, for segments that grow in steps of segment_time up to the full trial (see
+decoding.cross_validated_scores), and a stopping rule turns the scores of every segment into the confidence in its best
+class:
+    margin: the difference between the best and the second-best correlation
+    bayes: the posterior probability of the best class, with the correlations of the target and the non-target classes
+        modelled as normal distributions per segment length
+    beta: one minus the probability that the best correlation belongs to a non-target class, with the correlations of
+        the non-target classes modelled as a beta distribution per segment length
+The trial stops at the first segment whose confidence reaches the threshold (or at the end of the trial) and is
+classified as the best class of that segment. All thresholds are simulated at once, for all trials.
+
+The threshold (and the distributions of the bayes and beta rules) are tuned by nested cross-validation: within every
+outer fold, the rCCA is refitted in an inner cross-validation on the other folds, and the threshold with the highest ITR
+on these inner scores is applied to the scores of the fold.
+"""
+import numpy as np
+from scipy import stats as sp_stats
+from scipy.special import logsumexp
+import pyntbci
+from decoding import get_folds, get_trial_statistics, cross_validated_scores
+
+RULES = ("margin", "bayes", "beta")
+
+# default thresholds per stopping rule: margins between correlations, or confidences from 0.5 to 1 - 1e-6
+THRESHOLDS = {"margin": np.linspace(0, 0.5, 101),
+              "bayes": 1 - np.logspace(np.log10(0.5), -6, 101),
+              "beta": 1 - np.logspace(np.log10(0.5), -6, 101)}
+
+
+def get_segments(fs: int, trial_time: int, segment_time: float = 0.1):
+    """
+    Returns the segments at which a stopping decision can be made, up to and including the full trial
+
+    Args:
+        fs (int): downsampling frequency
+        trial_time (int): duration for which codes were flashing on the screen
+        segment_time (float, optional): step size in seconds. Defaults to 0.1.
+
+    Returns:
+        tuple: segment lengths in seconds (segments) and in samples (lengths)
+    """
+    lengths = np.unique(np.round(np.arange(1, round(trial_time / segment_time) + 1) * segment_time * fs).astype(int))
+    return lengths / fs, lengths
+
+
+def nested_scores(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size: float, trial_time: int,
+                  folds: np.ndarray, lengths: np.ndarray, stats: dict = None):
+    """
+    Scores the trials in a nested cross-validation, for every segment length
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        folds (np.ndarray): fold per trial, e.g., get_folds(len(y), n_folds)
+        lengths (np.ndarray): numbers of samples from the start of the trial
+        stats (dict, optional): statistics of the trials, see decoding.get_trial_statistics. Defaults to None (computed
+            here).
+
+    Returns:
+        tuple: scores of the outer cross-validation (trials x classes x lengths) and, per outer fold, the scores of the
+            inner cross-validation on the other folds (folds x trials x classes x lengths, NaN for the trials of the
+            outer fold)
+    """
+    if stats is None:
+        stats = get_trial_statistics(X, codes, fs, transient_size, trial_time)
+    outer = cross_validated_scores(X, y, codes, fs, transient_size, trial_time, folds, lengths, stats)
+    inner = np.stack([cross_validated_scores(X, y, codes, fs, transient_size, trial_time,
+                                             np.where(folds == i_fold, -1, folds), lengths, stats)
+                      for i_fold in range(folds.max() + 1)])
+    return outer, inner
+
+
+def fit_stopping(scores: np.ndarray, y: np.ndarray, rule: str):
+    """
+    Fits the distributions of the correlations that a stopping rule relies on, per segment length
+
+    Args:
+        scores (np.ndarray): correlations of training trials (trials x classes x lengths), scored by an rCCA that was
+            not fitted on them
+        y (np.ndarray): labels of the trials
+        rule (str): stopping rule, 'margin', 'bayes' or 'beta'
+
+    Returns:
+        dict: parameters of the rule (empty for 'margin')
+    """
+    if rule not in RULES:
+        raise ValueError(f"unknown stopping rule {rule}, expected one of {RULES}")
+    target = np.zeros(scores.shape[:2], dtype=bool)
+    target[np.arange(len(y)), y.astype(int)] = True
+    non_target = np.moveaxis(scores, 2, 0)[:, ~target]  # lengths x trials * non-target classes
+    if rule == "bayes":
+        return {"mu_target": scores[target].mean(axis=0), "sigma_target": scores[target].std(axis=0),
+                "mu_non_target": non_target.mean(axis=1), "sigma_non_target": non_target.std(axis=1)}
+    if rule == "beta":
+        # method of moments on the correlations mapped to [0, 1]
+        mean, var = ((non_target + 1) / 2).mean(axis=1), ((non_target + 1) / 2).var(axis=1)
+        common = mean * (1 - mean) / var - 1
+        return {"a": mean * common, "b": (1 - mean) * common}
+    return {}
+
+
+def get_confidence(scores: np.ndarray, rule: str, params: dict):
+    """
+    Returns the confidence in the best class of every trial and segment length
+
+    Args:
+        scores (np.ndarray): correlations (trials x classes x lengths)
+        rule (str): stopping rule, 'margin', 'bayes' or 'beta'
+        params (dict): parameters of the rule, see fit_stopping
+
+    Returns:
+        np.ndarray: confidence (trials x lengths), higher is more confident
+    """
+    if rule == "margin":
+        ordered = np.sort(scores, axis=1)
+        return ordered[:, -1] - ordered[:, -2]
+    if rule == "bayes":
+        # log-likelihood ratio of being the target per class, a uniform prior over the classes
+        ratio = (sp_stats.norm.logpdf(scores, params["mu_target"], params["sigma_target"]) -
+                 sp_stats.norm.logpdf(scores, params["mu_non_target"], params["sigma_non_target"]))
+        return np.exp(ratio.max(axis=1) - logsumexp(ratio, axis=1))
+    if rule == "beta":
+        # probability that all non-target correlations are below the best one
+        cdf = sp_stats.beta.cdf((scores.max(axis=1) + 1) / 2, params["a"], params["b"])
+        return cdf ** (scores.shape[1] - 1)
+    raise ValueError(f"unknown stopping rule {rule}, expected one of {RULES}")
+
+
+def get_itr(n_classes: int, accuracy: np.ndarray, duration: np.ndarray):
+    """
+    Computes the ITR, zero for accuracies at or below chance
+
+    Args:
+        n_classes (int): number of classes
+        accuracy (np.ndarray): classification accuracy
+        duration (np.ndarray): time per selection in seconds, including the inter-trial time
+
+    Returns:
+        np.ndarray: ITR in bits per minute
+    """
+    accuracy = np.array(accuracy, dtype="float64", ndmin=1)
+    itr = pyntbci.utilities.itr(n_classes, accuracy.copy(), duration)
+    return np.where(accuracy > 1 / n_classes, itr, 0)
+
+
+def simulate_stopping(scores: np.ndarray, y: np.ndarray, confidence: np.ndarray, thresholds: np.ndarray,
+                      segments: np.ndarray, intertrialtime: float = 0):
+    """
+    Stops every trial at the first segment whose confidence reaches the threshold, for all thresholds at once
+
+    Args:
+        scores (np.ndarray): correlations (trials x classes x segments)
+        y (np.ndarray): labels of the trials
+        confidence (np.ndarray): confidence in the best class (trials x segments), see get_confidence
+        thresholds (np.ndarray): thresholds on the confidence
+        segments (np.ndarray): segment lengths in seconds, the last one is the full trial
+        intertrialtime (float, optional): time between trials in seconds, for the ITR. Defaults to 0.
+
+    Returns:
+        dict: accuracy, average decision time in seconds (duration) and ITR in bits per minute, per threshold
+    """
+    reached = confidence[np.newaxis] >= np.asarray(thresholds)[:, np.newaxis, np.newaxis]
+    reached[:, :, -1] = True
+    i_stop = np.argmax(reached, axis=2)  # thresholds x trials
+    correct = np.argmax(scores, axis=1) == y[:, np.newaxis]  # trials x segments
+    accuracy = correct[np.arange(len(y)), i_stop].mean(axis=1)
+    duration = segments[i_stop].mean(axis=1)
+    return {"accuracy": accuracy, "duration": duration,
+            "itr": get_itr(scores.shape[1], accuracy, duration + intertrialtime)}
+
+
+def evaluate_stopping(outer: np.ndarray, inner: np.ndarray, y: np.ndarray, folds: np.ndarray, segments: np.ndarray,
+                      rule: str = "margin", thresholds: np.ndarray = None, intertrialtime: float = 0):
+    """
+    Tunes a stopping rule on the inner scores of every outer fold and applies it to the outer scores of the fold
+
+    Args:
+        outer (np.ndarray): scores of the outer cross-validation (trials x classes x segments), see nested_scores
+        inner (np.ndarray): scores of the inner cross-validations (folds x trials x classes x segments)
+        y (np.ndarray): labels of trials
+        folds (np.ndarray): fold per trial of the outer cross-validation
+        segments (np.ndarray): segment lengths in seconds, the last one is the full trial
+        rule (str, optional): stopping rule, 'margin', 'bayes' or 'beta'. Defaults to 'margin'.
+        thresholds (np.ndarray, optional): thresholds to select from. Defaults to None (THRESHOLDS[rule]).
+        intertrialtime (float, optional): time between trials in seconds, for the ITR. Defaults to 0.
+
+    Returns:
+        dict: selected threshold, accuracy, average decision time in seconds (duration) and ITR in bits per minute per
+            fold, and the accuracy, duration and ITR over all trials (accuracy_all, duration_all, itr_all)
+    """
+    thresholds = THRESHOLDS[rule] if thresholds is None else np.asarray(thresholds)
+    n_folds = folds.max() + 1
+    result = {name: np.zeros(n_folds) for name in ("threshold", "accuracy", "duration", "itr")}
+    for i_fold in range(n_folds):
+        trn, tst = np.flatnonzero((folds != i_fold) & (folds >= 0)), np.flatnonzero(folds == i_fold)
+
+        # the threshold with the highest ITR on the inner scores
+        params = fit_stopping(inner[i_fold, trn], y[trn], rule)
+        tuning = simulate_stopping(inner[i_fold, trn], y[trn], get_confidence(inner[i_fold, trn], rule, params),
+                                   thresholds, segments, intertrialtime)
+        threshold = thresholds[np.argmax(tuning["itr"])]
+
+        test = simulate_stopping(outer[tst], y[tst], get_confidence(outer[tst], rule, params), [threshold], segments,
+                                 intertrialtime)
+        result["threshold"][i_fold] = threshold
+        for name in ("accuracy", "duration", "itr"):
+            result[name][i_fold] = test[name][0]
+
+    # over all trials, weighting the folds by their number of trials
+    n_trials = np.bincount(folds[folds >= 0], minlength=n_folds)
+    result["accuracy_all"] = np.average(result["accuracy"], weights=n_trials)
+    result["duration_all"] = np.average(result["duration"], weights=n_trials)
+    result["itr_all"] = get_itr(outer.shape[1], result["accuracy_all"], result["duration_all"] + intertrialtime)[0]
+    return result
+
+
+def dynamic_stopping(X: np.ndarray, y: np.ndarray, codes: np.ndarray, fs: int, transient_size: float, trial_time: int,
+                     intertrialtime: float = 0, rules: tuple = RULES, segment_time: float = 0.1, n_folds: int = 4,
+                     stats: dict = None):
+    """
+    Simulates dynamic stopping for one subject and condition, with every stopping rule tuned by nested cross-validation
+
+    Args:
+        X (np.ndarray): EEG data (trials x channels x samples), e.g., a memory map
+        y (np.ndarray): labels of trials
+        codes (np.ndarray): codes used in the experiment
+        fs (int): downsampling frequency
+        transient_size (float): duration of the transient response in seconds
+        trial_time (int): duration for which codes were flashing on the screen
+        intertrialtime (float, optional): time between trials in seconds, for the ITR. Defaults to 0.
+        rules (tuple, optional): stopping rules to simulate. Defaults to RULES.
+        segment_time (float, optional): step size of the decisions in seconds. Defaults to 0.1.
+        n_folds (int, optional): number of folds of the outer cross-validation. Defaults to 4.
+        stats (dict, optional): statistics of the trials, see decoding.get_trial_statistics. Defaults to None
+            (computed here).
+
+    Returns:
+        dict: result per rule (see evaluate_stopping), and 'fixed': the accuracy and ITR per fold of deciding at the
+            end of the trial
+    """
+    segments, lengths = get_segments(fs, trial_time, segment_time)
+    folds = get_folds(X.shape[0], n_folds)
+    outer, inner = nested_scores(X, y, codes, fs, transient_size, trial_time, folds, lengths, stats)
+
+    results = {rule: evaluate_stopping(outer, inner, y, folds, segments, rule, intertrialtime=intertrialtime)
+               for rule in rules}
+    correct = np.argmax(outer[:len(folds), :, -1], axis=1) == y[:len(folds)]
+    accuracy = np.array([correct[folds == i_fold].mean() for i_fold in range(n_folds)])
+    results["fixed"] = {"accuracy": accuracy, "duration": np.full(n_folds, segments[-1]),
+                        "itr": get_itr(codes.shape[0], accuracy, segments[-1] + intertrialtime)}
+    return results
@@ -0,0 +1,258 @@
+"""
+Joint store of the trial-locked eeg, gaze and stimulus data of a subject and condition
+
+Next to every derivative (see dataset.py), the store holds all modalities of its trials on the time base of the eeg
+data (fs, from the trial onset to the trial time), in the folder derivatives/{subject}/{subject}_cvep_{condition}_{code}
+_trials:
+    eeg.npy: the preprocessed eeg data of the derivative (trials x channels x samples, float32)
+    gaze.npy: the EyeLink gaze and pupil channels (trials x 6 x samples, float32, NaN for runs without EyeLink).
+        They are interpolated at the time stamps of the eeg samples (see xdf_reader.interpolate_gaze), and sliced at
+        the same trial onsets and resampled with the same polyphase filter as the eeg data (see preprocessing.epoch_run
+        and preprocessing.resample_epochs), such that both are aligned sample by sample (in low-memory mode, where the
+        eeg onsets are rounded to the decimated samples, within half a sample at fs)
+    code.npy: the code bit shown per side (trials x sides x samples, uint8), see combine_runs
+    shape.npy: the shape shown per side (trials x sides x samples, int8), an index in SHAPES, -1 when none is shown.
+        The shapes are placed at the LSL time stamps of their markers (left_shape_stim and right_shape_stim) relative to
+        the trial onset in the marker channel
+    target.npy: whether the shape shown per side is a target (trials x sides x samples, uint8)
+    y.npy: the trial labels of the derivative
+    meta.json: fs, the names of the gaze channels, the sides and the shapes, and per trial its run (xdf file name), its
+        index in the run and its onset (LSL time). It is written last, as it marks the store as complete.
+
+Every array is stored trial by trial (trials first, C order), such that a trial is one contiguous chunk of each file,
+and is opened as a read-only memory map: selecting a set of trials reads only those trials of every modality.
+
+Run as a script, it builds the stores of all subjects, conditions and variants from their derivatives.
+"""
+import os
+import json
+import numpy as np
+import mne
+from xdf_reader import get_channel_info, interpolate_gaze
+from xdf_index import load_index, load_stream, load_window
+from preprocessing import find_trial_events, resample_epochs, GAZE_PROXIES
+from dataset import load_derivative
+
+# sides of the stimuli, in the order of the codes (rows of V)
+SIDES = ["left", "right"]
+
+# shapes shown inside the stimuli, as named in the markers
+SHAPES = ["rectangle", "circle", "inverted_triangle", "triangle", "hour_glass"]
+
+# arrays of the store, trials first
+MODALITIES = ["eeg", "gaze", "code", "shape", "target", "y"]
+
+# EyeLink data (s) decoded around the window of a trial, such that track loss at its edges is interpolated as well
+GAZE_MARGIN = 1
+
+
+def get_store_path(fn: str):
+    """
+    Returns the folder of the store belonging to a derivative
+
+    Args:
+        fn (str): path of the npz file of the derivative
+
+    Returns:
+        str: path of the folder (..._mgold_61_6521.npz -> ..._mgold_61_6521_trials)
+    """
+    return os.path.splitext(fn)[0] + "_trials"
+
+
+def get_shape_markers(marker_stream: dict):
+    """
+    Collects the shapes shown during every trial from the marker stream
+
+    Args:
+        marker_stream (dict): pyxdf stream dict of the KeyboardMarkerStream
+
+    Returns:
+        list: per trial (in the order of start_stimulus), a list of (LSL time, side, shape, target) per shape marker
+    """
+    trials = []
+    for timestamp, marker in zip(marker_stream["time_stamps"], marker_stream["time_series"]):
+        if marker[2] == "start_stimulus":
+            trials.append([])
+        elif marker[2] in ("left_shape_stim", "right_shape_stim") and trials:
+            fields = dict(field.split("=") for field in marker[3].strip('""').split(";"))
+            trials[-1].append((float(timestamp), SIDES.index(marker[2].split("_")[0]), SHAPES.index(fields["shape"]),
+                               int(fields["target"])))
+    return trials
+
+
+def epoch_gaze(fn: str, trials: list, fs: int, trial_time: float):
+    """
+    Slices the gaze and pupil channels and the shapes of the trials of a run on the time base of the eeg data
+
+    The trial onsets are found in the marker channel as in the preprocessing (see preprocessing.find_trial_events).
+    Only the marker channel of the eeg and the EyeLink samples of the trials (with GAZE_MARGIN around them) are decoded,
+    from the chunk index of the run (see xdf_index.load_stream and xdf_index.load_window).
+
+    Args:
+        fn (str): path of the xdf file
+        trials (list): indices of the trials of the run in the derivative (see bad_data.clean_epochs)
+        fs (int): sampling frequency of the eeg data in the derivative
+        trial_time (float): trial duration in seconds
+
+    Returns:
+        tuple: gaze (trials x channels x samples), shape and target (trials x sides x samples) and the onsets (LSL
+            time) of the trials
+    """
+    index = load_index(fn)
+    entry = index["BioSemi"]
+    sfreq = entry["effective_srate"]
+    n_samples = int(trial_time * fs)
+
+    # trial onsets from the marker channel
+    stream = load_stream(fn, "BioSemi", [get_channel_info(entry)[0].index("Trig1")], index=index)
+    raw = mne.io.RawArray(np.asarray(stream["time_series"], dtype="float64").T,
+                          mne.create_info(["Trig1"], sfreq, "misc"), verbose=False)
+    events = find_trial_events(raw)[trials]
+    onsets = stream["time_stamps"][events[:, 0]]
+
+    # the same windows and resampling as the eeg data (see preprocessing.epoch_run and resample_epochs), with the gaze
+    # channels interpolated at the time stamps of the eeg samples
+    gaze = np.full((len(trials), len(GAZE_PROXIES), n_samples), np.nan, dtype="float32")
+    if "EyeLink" in index:
+        labels = get_channel_info(index["EyeLink"])[0]
+        start = int(round(-0.5 * sfreq))
+        n_times = int(round(trial_time * sfreq)) - start + 1
+        windows = np.empty((len(trials), len(labels), n_times))
+        for i_trial, sample in enumerate(events[:, 0]):
+            times = stream["time_stamps"][sample + start:sample + start + n_times]
+            series, time_stamps = load_window(fn, "EyeLink", times[0] - GAZE_MARGIN, times[-1] + GAZE_MARGIN, index)
+            windows[i_trial] = interpolate_gaze(series, time_stamps, times)
+        epo = mne.EpochsArray(windows, mne.create_info(labels, sfreq, "misc"), tmin=start / sfreq, verbose=False)
+        picks = [GAZE_PROXIES.index(label) for label in labels]
+        gaze[:, picks] = resample_epochs(epo, fs, trial_time)[:, :, :n_samples]
+
+    # the shapes from their markers, until the next one (or the end of the trial)
+    shape = np.full((len(trials), len(SIDES), n_samples), -1, dtype="int8")
+    target = np.zeros((len(trials), len(SIDES), n_samples), dtype="uint8")
+    markers = get_shape_markers(index["KeyboardMarkerStream"])
+    for i_trial, (trial, onset) in enumerate(zip(trials, onsets)):
+        for timestamp, i_side, i_shape, is_target in markers[trial]:
+            start = min(max(0, int(round((timestamp - onset) * fs))), n_samples)
+            shape[i_trial, i_side, start:] = i_shape
+            target[i_trial, i_side, start:] = is_target
+    return gaze, shape, target, onsets
+
+
+def build_trial_store(fn: str, fns: list):
+    """
+    Writes the store of a derivative, from the derivative and the raw runs it was preprocessed from
+
+    Args:
+        fn (str): path of the npz file of the derivative
+        fns (list): paths of the xdf files of its runs, in the order they were combined
+
+    Returns:
+        str: path of the folder of the store
+    """
+    derivative = load_derivative(fn)
+    settings = derivative["settings"]
+    if settings is None or any("trials" not in bads for bads in settings["bads"]):
+        raise ValueError(f"{os.path.basename(fn)} does not list the trials it holds per run, preprocess it again")
+    X, V, fs = derivative["X"], derivative["V"], derivative["fs"]
+    n_trials, _, n_samples = X.shape
+
+    path = get_store_path(fn)
+    if os.path.isfile(os.path.join(path, "meta.json")):
+        os.remove(os.path.join(path, "meta.json"))  # incomplete until it is written again
+    os.makedirs(path, exist_ok=True)
+
+    # one memory map per modality, filled run by run
+    arrays = {
+        "eeg": np.lib.format.open_memmap(os.path.join(path, "eeg.npy"), "w+", "float32", X.shape),
+        "gaze": np.lib.format.open_memmap(os.path.join(path, "gaze.npy"), "w+", "float32",
+                                          (n_trials, len(GAZE_PROXIES), n_samples)),
+        "shape": np.lib.format.open_memmap(os.path.join(path, "shape.npy"), "w+", "int8",
+                                           (n_trials, len(SIDES), n_samples)),
+        "target": np.lib.format.open_memmap(os.path.join(path, "target.npy"), "w+", "uint8",
+                                            (n_trials, len(SIDES), n_samples)),
+    }
+    meta_trials = []
+    i_trial = 0
+    for fn_run, bads in zip(fns, settings["bads"]):
+        trials = bads["trials"]
+        gaze, shape, target, onsets = epoch_gaze(fn_run, trials, fs, settings["trial_time"])
+        run = slice(i_trial, i_trial + len(trials))
+        arrays["eeg"][run] = X[run]
+        arrays["gaze"][run] = gaze
+        arrays["shape"][run] = shape
+        arrays["target"][run] = target
+        meta_trials += [[os.path.basename(fn_run), trial, float(onset)] for trial, onset in zip(trials, onsets)]
+        i_trial += len(trials)
+    if i_trial != n_trials:
+        raise ValueError(f"{os.path.basename(fn)} holds {n_trials} trials, its runs {i_trial}")
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    # the codes are the same in every trial, from the onset
+    code = np.broadcast_to(V[:len(SIDES), np.arange(n_samples) % V.shape[1]], (n_trials, len(SIDES), n_samples))
+    np.save(os.path.join(path, "code.npy"), np.ascontiguousarray(code, dtype="uint8"))
+    np.save(os.path.join(path, "y.npy"), derivative["y"])
+
+    meta = {"fs": fs, "gaze_channels": GAZE_PROXIES, "sides": SIDES, "shapes": SHAPES,
+            "trials": [dict(zip(["run", "trial", "onset"], trial)) for trial in meta_trials]}
+    with open(os.path.join(path, "meta.json"), "w") as fid:
+        json.dump(meta, fid, indent=4)
+    print(f"trial store saved to {os.path.basename(path)}")
+    return path
+
+
+def load_trial_store(path: str, mmap: bool = True):
+    """
+    Opens the store of a derivative
+
+    Args:
+        path (str): folder of the store (see get_store_path)
+        mmap (bool, optional): open the arrays as read-only memory maps. Defaults to True.
+
+    Returns:
+        dict: the arrays of the store (see MODALITIES) and its meta data (meta)
+    """
+    with open(os.path.join(path, "meta.json"), "r") as fid:
+        store = {"meta": json.load(fid)}
+    for name in MODALITIES:
+        store[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+    return store
+
+
+def select_trials(store: dict, trials):
+    """
+    Reads a set of trials of all modalities of a store
+
+    Args:
+        store (dict): the store, see load_trial_store
+        trials (list | np.ndarray | slice): indices or boolean mask of the trials
+
+    Returns:
+        dict: the arrays of the selected trials (see MODALITIES), in memory, and their entries of meta['trials']
+    """
+    if isinstance(trials, slice):
+        trials = np.arange(store["y"].shape[0])[trials]
+    trials = np.asarray(trials)
+    if trials.dtype == bool:
+        trials = np.flatnonzero(trials)
+    selection = {name: np.asarray(store[name][trials]) for name in MODALITIES}
+    selection["trials"] = [store["meta"]["trials"][i_trial] for i_trial in trials]
+    return selection
+
+
+if __name__ == "__main__":
+    from preprocessing import get_run_path, get_variant_label
+    from dataset import get_derivative_path
+    from read_and_preprocess_data import data_path, subjects, ses, conditions, code, variants
+
+    for subject in subjects:
+        for condition in conditions:
+            for variant in variants:
+                fn = get_derivative_path(data_path, subject, get_variant_label(condition, variant), code)
+                if not os.path.isfile(fn):
+                    print(f"no derivative {os.path.basename(fn)}, skipped")
+                    continue
+                n_runs = len(load_derivative(fn)["settings"]["bads"])
+                build_trial_store(fn, [get_run_path(data_path, subject, ses, condition, i_run)
+                                       for i_run in range(n_runs)])
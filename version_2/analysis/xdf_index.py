@@ -0,0 +1,602 @@
+"""
+Random-access chunk index for the recorded .xdf runs
+
+build_index scans the chunk structure of an .xdf file once and stores, per stream, where each Samples chunk starts in
+the file, how many samples it holds and how sample indices map to (clock-corrected, dejittered) LSL time. The index is
+saved next to the file (sub-..._eeg.xdf -> sub-..._eeg_index.npz). load_stream and load_window use it to seek to and
+decode only the chunks that overlap a requested sample or time range, such that memory use and load time scale with the
+trial data rather than with the length of the recording.
+"""
+import os
+import json
+import struct
+import xml.etree.ElementTree as ETree
+import numpy as np
+
+# numpy dtypes of the numeric channel formats of xdf
+CHANNEL_FORMATS = {"int8": "<i1", "int16": "<i2", "int32": "<i4", "int64": "<i8", "float32": "<f4", "double64": "<f8"}
+
+# xdf chunk tags
+TAG_FILE_HEADER = 1
+TAG_STREAM_HEADER = 2
+TAG_SAMPLES = 3
+TAG_CLOCK_OFFSET = 4
+
+# break thresholds for dejittering (same defaults as pyxdf.load_xdf)
+JITTER_BREAK_THRESHOLD_SECONDS = 1
+JITTER_BREAK_THRESHOLD_SAMPLES = 500
+
+# mean number of samples between time stamps below which a chunk is stepped through sample by sample
+SHORT_RUN = 32
+
+# version of the saved index, indices of another version are rebuilt
+INDEX_VERSION = 2
+
+# layouts of the samples in a chunk: all without time stamp, all with time stamp, or mixed
+LAYOUT_NO_STAMPS = 0
+LAYOUT_STAMPS = 8
+LAYOUT_MIXED = -1
+
+
+def get_index_path(fn: str):
+    """
+    Returns the path of the chunk index of an .xdf file
+
+    Args:
+        fn (str): path to the .xdf file
+
+    Returns:
+        str: path to the index file (sub-..._eeg.xdf -> sub-..._eeg_index.npz)
+    """
+    return os.path.splitext(fn)[0] + "_index.npz"
+
+
+def _read_varlen_int(fid):
+    """
+    Reads a variable-length integer (1 byte with the number of bytes, followed by the integer)
+
+    Args:
+        fid (file): opened .xdf file
+
+    Returns:
+        int: the integer
+    """
+    nbytes = fid.read(1)
+    if nbytes == b"":
+        raise EOFError
+    if nbytes == b"\x01":
+        return fid.read(1)[0]
+    elif nbytes == b"\x04":
+        return struct.unpack("<I", fid.read(4))[0]
+    elif nbytes == b"\x08":
+        return struct.unpack("<Q", fid.read(8))[0]
+    raise RuntimeError("invalid variable-length integer in xdf file")
+
+
+def _xml_to_dict(element: ETree.Element):
+    """
+    Converts an xml element to nested dicts and lists, as pyxdf does for the stream info
+
+    Args:
+        element (ETree.Element): the element
+
+    Returns:
+        dict: tag -> list of the converted children per tag, or the text of an element without children
+    """
+    children = {}
+    for child in element:
+        for tag, value in _xml_to_dict(child).items():
+            children.setdefault(tag, []).append(value)
+    return {element.tag: children or element.text}
+
+
+def _parse_stream_header(xml: bytes):
+    """
+    Parses the StreamHeader xml of a stream
+
+    Args:
+        xml (bytes): content of the StreamHeader chunk
+
+    Returns:
+        dict: name, type, channel count, nominal sampling rate and channel format of the stream, and its info in the
+            format of pyxdf (e.g., for xdf_reader.get_channel_info)
+    """
+    root = ETree.fromstring(xml.decode("utf-8", errors="replace"))
+    return {"name": root.findtext("name"),
+            "type": root.findtext("type"),
+            "channel_count": int(root.findtext("channel_count")),
+            "nominal_srate": float(root.findtext("nominal_srate")),
+            "channel_format": root.findtext("channel_format"),
+            "info": _xml_to_dict(root)["info"]}
+
+
+def _get_sample_offsets(buf: np.ndarray, n_samples: int, sample_size: int):
+    """
+    Finds where the samples of a numeric Samples chunk start, walking the chunk per time stamp rather than per sample
+
+    Every sample is a flag byte (8 if a time stamp follows, else 0), the optional time stamp and sample_size bytes of
+    values. Consecutive samples without a time stamp are equally spaced, such that a run of them is found with strided
+    reads of their flags (over a window that doubles until the run ends). A chunk in which every sample has a time
+    stamp, or none has, is located in one step. If the runs are short (a time stamp every few samples), the chunk is
+    stepped through from flag to flag instead, which reads one byte per sample.
+
+    Args:
+        buf (np.ndarray): the samples of the chunk (bytes as uint8)
+        n_samples (int): number of samples in the chunk
+        sample_size (int): number of bytes of the values of a sample
+
+    Returns:
+        np.ndarray: offset of every sample in buf
+    """
+    stride = 1 + sample_size
+    if buf.size == n_samples * (stride + 8) and np.all(buf[::stride + 8] == 8):
+        return np.arange(n_samples, dtype="int64") * (stride + 8)
+
+    # the number of time stamps follows from the size of the chunk, the first window is about one run long
+    n_stamps = (buf.size - n_samples * stride) // 8
+    first_window = max(8, 2 * n_samples // max(n_stamps, 1))
+    if n_samples < SHORT_RUN * (n_stamps + 1):
+        flags, offsets, pos = buf.data, [], 0
+        for _ in range(n_samples):
+            offsets.append(pos)
+            pos += stride + flags[pos]
+        return np.array(offsets, dtype="int64")
+
+    offsets = np.zeros(n_samples, dtype="int64")
+    i_sample, pos = 0, 0
+    while i_sample < n_samples:
+        if buf[pos] == 8:
+            offsets[i_sample] = pos
+            i_sample, pos = i_sample + 1, pos + stride + 8
+            continue
+
+        # the run without time stamps ends at the first flag that is not 0 (or at the end of the chunk)
+        n_left, n_run, window = n_samples - i_sample, 0, first_window
+        while n_run < n_left:
+            flags = buf[pos + n_run * stride:pos + min(n_run + window, n_left) * stride:stride]
+            stop = np.flatnonzero(flags)
+            if stop.size:
+                n_run += int(stop[0])
+                break
+            n_run, window = n_run + flags.size, 2 * window
+        offsets[i_sample:i_sample + n_run] = pos + stride * np.arange(n_run)
+        i_sample, pos = i_sample + n_run, pos + n_run * stride
+    return offsets
+
+
+def _scan_samples(buf: bytes, n_samples: int, header: dict, last_stamp: float):
+    """
+    Collects the time stamps of the samples of a Samples chunk (and their values, for string streams)
+
+    Args:
+        buf (bytes): the samples of the chunk
+        n_samples (int): number of samples in the chunk
+        header (dict): parsed StreamHeader of the stream
+        last_stamp (float): time stamp of the last sample of the previous chunk of the stream
+
+    Returns:
+        tuple: time stamps (n_samples,), layout of the chunk, and the decoded values for string streams (else None)
+    """
+    n_channels = header["channel_count"]
+    step = 1.0 / header["nominal_srate"] if header["nominal_srate"] > 0 else 0.0
+
+    values = None
+    if header["channel_format"] == "string":
+        # marker streams are small, their samples (of variable length) are walked one by one
+        values, offsets, pos = [], np.zeros(n_samples, dtype="int64"), 0
+        for i_sample in range(n_samples):
+            offsets[i_sample] = pos
+            pos += 1 + (8 if buf[pos] == 8 else 0)
+            sample = []
+            for _ in range(n_channels):
+                nbytes = buf[pos]
+                length = int.from_bytes(buf[pos + 1:pos + 1 + nbytes], "little")
+                pos += 1 + nbytes
+                sample.append(buf[pos:pos + length].decode("utf-8", errors="replace"))
+                pos += length
+            values.append(sample)
+        buf = np.frombuffer(buf, dtype=np.uint8)
+    else:
+        buf = np.frombuffer(buf, dtype=np.uint8)
+        sample_size = n_channels * np.dtype(CHANNEL_FORMATS[header["channel_format"]]).itemsize
+        offsets = _get_sample_offsets(buf, n_samples, sample_size)
+
+    flags = buf[offsets]
+    stamped = np.flatnonzero(flags == 8)
+    stamp_values = buf[offsets[stamped, np.newaxis] + 1 + np.arange(8)].view("<f8").ravel()
+
+    # samples without a time stamp follow the last stamped sample at the nominal rate (as in pyxdf)
+    last = np.full(n_samples, -1)
+    last[stamped] = stamped
+    last = np.maximum.accumulate(last)
+    base = np.where(last >= 0, np.append(stamp_values, 0)[np.searchsorted(stamped, last)], last_stamp)
+    stamps = base + (np.arange(n_samples) - last) * step
+
+    if np.all(flags == 8):
+        layout = LAYOUT_STAMPS
+    elif np.all(flags == 0):
+        layout = LAYOUT_NO_STAMPS
+    else:
+        layout = LAYOUT_MIXED
+    return stamps, layout, values
+
+
+def _clock_correct(stamps: np.ndarray, offsets: list):
+    """
+    Maps time stamps to the clock of the recording computer using the ClockOffset measurements of the stream
+
+    N.B. A single least-squares line is fitted through the offsets, pyxdf uses a robust fit per clock segment. On our
+    recordings (no clock resets) the difference is far below one sample.
+
+    Args:
+        stamps (np.ndarray): time stamps of the stream
+        offsets (list): (collection time, offset) pairs of the stream
+
+    Returns:
+        np.ndarray: corrected time stamps
+    """
+    if len(offsets) == 0:
+        return stamps
+    offsets = np.array(offsets)
+    if offsets.shape[0] == 1:
+        return stamps + offsets[0, 1]
+    A = np.column_stack((np.ones(offsets.shape[0]), offsets[:, 0]))
+    coef = np.linalg.lstsq(A, offsets[:, 1], rcond=None)[0]
+    return stamps + coef[0] + coef[1] * stamps
+
+
+def _dejitter_segments(stamps: np.ndarray, srate: float):
+    """
+    Fits a line through the time stamps of each contiguous segment of a regularly sampled stream (as in pyxdf)
+
+    Args:
+        stamps (np.ndarray): clock-corrected time stamps of the stream
+        srate (float): nominal sampling rate of the stream
+
+    Returns:
+        np.ndarray: segments of shape (n_segments, 4) holding first sample, last sample, intercept and slope
+    """
+    if stamps.size == 0:
+        return np.zeros((0, 4))
+    diffs = np.diff(stamps)
+    # a segment breaks at a gap that exceeds both thresholds, as in pyxdf
+    breaks = np.where(diffs > max(JITTER_BREAK_THRESHOLD_SECONDS, JITTER_BREAK_THRESHOLD_SAMPLES / srate))[0]
+    starts = np.concatenate(([0], breaks + 1))
+    stops = np.concatenate((breaks, [stamps.size - 1]))
+
+    segments = np.zeros((starts.size, 4))
+    for i_segment, (start, stop) in enumerate(zip(starts, stops)):
+        if stop == start:
+            intercept, slope = stamps[start] - start / srate, 1.0 / srate
+        else:
+            idx = np.arange(start, stop + 1)
+            A = np.column_stack((np.ones(idx.size), idx))
+            intercept, slope = np.linalg.lstsq(A, stamps[start:stop + 1], rcond=None)[0]
+        segments[i_segment] = [start, stop, intercept, slope]
+    return segments
+
+
+def build_index(fn: str, save: bool = True):
+    """
+    Scans the chunks of an .xdf file once and builds its random-access index
+
+    Args:
+        fn (str): path to the .xdf file
+        save (bool, optional): persist the index next to the file. Defaults to True.
+
+    Returns:
+        dict: the index (stream name -> stream entry)
+    """
+    headers, chunks, stamps, offsets, strings = {}, {}, {}, {}, {}
+    n_seen, last_stamps = {}, {}
+
+    with open(fn, "rb") as fid:
+        if fid.read(4) != b"XDF:":
+            raise IOError(f"not a valid xdf file: {fn}")
+
+        while True:
+            try:
+                chunk_size = _read_varlen_int(fid)
+            except EOFError:
+                break
+            chunk_start = fid.tell()
+            tag = struct.unpack("<H", fid.read(2))[0]
+
+            if tag == TAG_STREAM_HEADER:
+                stream_id = struct.unpack("<I", fid.read(4))[0]
+                headers[stream_id] = _parse_stream_header(fid.read(chunk_size - 6))
+                chunks[stream_id], stamps[stream_id], offsets[stream_id] = [], [], []
+                n_seen[stream_id], last_stamps[stream_id] = 0, 0.0
+                if headers[stream_id]["channel_format"] == "string":
+                    strings[stream_id] = []
+
+            elif tag == TAG_SAMPLES:
+                stream_id = struct.unpack("<I", fid.read(4))[0]
+                n_samples = _read_varlen_int(fid)
+                payload_start = fid.tell()
+                payload = fid.read(chunk_size - (payload_start - chunk_start))
+                chunk_stamps, layout, values = _scan_samples(payload, n_samples, headers[stream_id],
+                                                             last_stamps[stream_id])
+                chunks[stream_id].append((payload_start, len(payload), n_samples, n_seen[stream_id], layout))
+                stamps[stream_id].append(chunk_stamps)
+                n_seen[stream_id] += n_samples
+                if n_samples > 0:
+                    last_stamps[stream_id] = chunk_stamps[-1]
+                if values is not None:
+                    strings[stream_id].extend(values)
+
+            elif tag == TAG_CLOCK_OFFSET:
+                stream_id = struct.unpack("<I", fid.read(4))[0]
+                offsets[stream_id].append(struct.unpack("<dd", fid.read(16)))
+
+            # all other chunks (file header, boundary, stream footer) are skipped
+            fid.seek(chunk_start + chunk_size)
+
+    index = {}
+    for stream_id, header in headers.items():
+        stream_stamps = np.concatenate(stamps[stream_id]) if stamps[stream_id] else np.zeros(0)
+        stream_stamps = _clock_correct(stream_stamps, offsets[stream_id])
+        entry = dict(header)
+        entry["stream_id"] = stream_id
+        entry["n_samples"] = int(stream_stamps.size)
+        entry["chunks"] = np.array(chunks[stream_id], dtype="int64").reshape((-1, 5))
+
+        if header["nominal_srate"] > 0:
+            # regular streams only keep the linear time mapping of each segment
+            entry["segments"] = _dejitter_segments(stream_stamps, header["nominal_srate"])
+            durations = entry["segments"][:, 1] - entry["segments"][:, 0]
+            entry["effective_srate"] = float(durations.sum() / np.sum(durations * entry["segments"][:, 3])) \
+                if np.any(durations > 0) else header["nominal_srate"]
+        else:
+            # irregular (marker) streams are small and keep all of their time stamps
+            entry["time_stamps"] = stream_stamps
+        if stream_id in strings:
+            entry["time_series"] = strings[stream_id]
+        index[header["name"]] = entry
+
+    if save:
+        save_index(fn, index)
+    return index
+
+
+def save_index(fn: str, index: dict):
+    """
+    Saves the index of an .xdf file next to it
+
+    Args:
+        fn (str): path to the .xdf file
+        index (dict): the index as returned by build_index
+    """
+    stat = os.stat(fn)
+    meta = {"version": INDEX_VERSION, "source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, "streams": {}}
+    arrays = {}
+    for name, entry in index.items():
+        meta["streams"][name] = {key: value for key, value in entry.items() if not isinstance(value, np.ndarray)}
+        for key, value in entry.items():
+            if isinstance(value, np.ndarray):
+                arrays[f"{entry['stream_id']}_{key}"] = value
+    np.savez(get_index_path(fn), meta=json.dumps(meta), **arrays)
+
+
+def load_index(fn: str, build: bool = True):
+    """
+    Loads the index of an .xdf file, (re)building it if it is missing or out of date
+
+    Args:
+        fn (str): path to the .xdf file
+        build (bool, optional): build the index if there is no up-to-date index. Defaults to True.
+
+    Returns:
+        dict: the index (stream name -> stream entry), or None if there is none and build is False
+    """
+    fn_index = get_index_path(fn)
+    if os.path.isfile(fn_index):
+        with np.load(fn_index) as tmp:
+            meta = json.loads(str(tmp["meta"]))
+            stat = os.stat(fn)
+            if meta.get("version") == INDEX_VERSION and \
+                    meta["source"] == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}:
+                index = {}
+                for name, entry in meta["streams"].items():
+                    prefix = f"{entry['stream_id']}_"
+                    for key in tmp.files:
+                        if key.startswith(prefix):
+                            entry[key[len(prefix):]] = tmp[key]
+                    index[name] = entry
+                return index
+    return build_index(fn) if build else None
+
+
+def get_marker_times(index: dict, marker: str = "start_stimulus", stream: str = "KeyboardMarkerStream"):
+    """
+    Returns the time stamps of a marker (e.g., the trial onsets) from the index
+
+    Args:
+        index (dict): the index as returned by load_index
+        marker (str, optional): the marker (third field of the marker sample). Defaults to "start_stimulus".
+        stream (str, optional): name of the marker stream. Defaults to "KeyboardMarkerStream".
+
+    Returns:
+        np.ndarray: time stamps of the marker
+    """
+    entry = index[stream]
+    return np.array([stamp for sample, stamp in zip(entry["time_series"], entry["time_stamps"])
+                     if sample[2] == marker])
+
+
+def _decode_chunk(fid, entry: dict, i_chunk: int):
+    """
+    Reads and decodes the values of one Samples chunk of a numeric stream
+
+    Args:
+        fid (file): opened .xdf file
+        entry (dict): index entry of the stream
+        i_chunk (int): index of the chunk
+
+    Returns:
+        np.ndarray: values of shape (n_samples, n_channels)
+    """
+    offset, nbytes, n_samples, _, layout = entry["chunks"][i_chunk]
+    fid.seek(offset)
+    buf = fid.read(nbytes)
+
+    value_dtype = np.dtype((CHANNEL_FORMATS[entry["channel_format"]], (entry["channel_count"],)))
+    if layout == LAYOUT_NO_STAMPS:
+        sample_dtype = np.dtype([("flag", "u1"), ("values", value_dtype)])
+        return np.frombuffer(buf, dtype=sample_dtype, count=n_samples)["values"]
+    if layout == LAYOUT_STAMPS:
+        sample_dtype = np.dtype([("flag", "u1"), ("stamp", "<f8"), ("values", value_dtype)])
+        return np.frombuffer(buf, dtype=sample_dtype, count=n_samples)["values"]
+
+    # mixed chunks: locate the values of each sample, then gather them in one go
+    raw = np.frombuffer(buf, dtype="uint8")
+    offsets = _get_sample_offsets(raw, n_samples, value_dtype.itemsize)
+    positions = offsets + 1 + (raw[offsets] == 8) * 8
+    values = raw[positions[:, np.newaxis] + np.arange(value_dtype.itemsize)]
+    return np.ascontiguousarray(values).view(value_dtype.base).reshape((n_samples, entry["channel_count"]))
+
+
+def _read_samples(fid, entry: dict, start: int, stop: int, channels: list = None):
+    """
+    Reads the samples [start, stop) of a numeric stream, decoding only the chunks that contain them
+
+    Args:
+        fid (file): opened .xdf file
+        entry (dict): index entry of the stream
+        start (int): first sample
+        stop (int): last sample (exclusive)
+        channels (list, optional): indices of the channels to keep. Defaults to None (all channels).
+
+    Returns:
+        np.ndarray: values of shape (stop - start, n_channels)
+    """
+    first_samples = entry["chunks"][:, 3]
+    i_first = np.searchsorted(first_samples, start, side="right") - 1
+    i_last = np.searchsorted(first_samples, stop - 1, side="right") - 1
+    channels = np.arange(entry["channel_count"]) if channels is None else np.asarray(channels)
+
+    out = np.empty((max(stop - start, 0), len(channels)), dtype=CHANNEL_FORMATS[entry["channel_format"]])
+    for i_chunk in range(i_first, i_last + 1):
+        values = _decode_chunk(fid, entry, i_chunk)
+        chunk_start = first_samples[i_chunk]
+        lo = max(start, chunk_start)
+        hi = min(stop, chunk_start + values.shape[0])
+        out[lo - start:hi - start] = values[lo - chunk_start:hi - chunk_start, channels]
+    return out
+
+
+def _time_to_sample(entry: dict, time: float, rounding=np.ceil):
+    """
+    Maps an LSL time to a sample of a regular stream
+
+    Args:
+        entry (dict): index entry of the stream
+        time (float): the time in seconds
+        rounding (function, optional): rounding of the fractional sample, np.ceil gives the first sample at or after
+            the time, np.round the nearest sample. Defaults to np.ceil.
+
+    Returns:
+        int: the sample index, between 0 and the number of samples of the stream
+    """
+    segments = entry["segments"]
+    segment_starts = segments[:, 2] + segments[:, 3] * segments[:, 0]
+    i_segment = max(np.searchsorted(segment_starts, time, side="right") - 1, 0)
+    start, stop, intercept, slope = segments[i_segment]
+    return int(np.clip(rounding((time - intercept) / slope), start, stop + 1))
+
+
+def _sample_to_time(entry: dict, samples: np.ndarray):
+    """
+    Maps sample indices of a regular stream to their dejittered LSL time
+
+    Args:
+        entry (dict): index entry of the stream
+        samples (np.ndarray): the sample indices
+
+    Returns:
+        np.ndarray: the time stamps in seconds
+    """
+    segments = entry["segments"]
+    i_segment = np.clip(np.searchsorted(segments[:, 0], samples, side="right") - 1, 0, segments.shape[0] - 1)
+    return segments[i_segment, 2] + segments[i_segment, 3] * samples
+
+
+def get_time_range(entry: dict):
+    """
+    Returns the time stamps of the first and last sample of a stream
+
+    Args:
+        entry (dict): index entry of the stream
+
+    Returns:
+        tuple: time of the first and of the last sample (LSL time in seconds), None for a stream without samples
+    """
+    if entry["n_samples"] == 0:
+        return None
+    if "time_stamps" in entry:
+        return float(entry["time_stamps"][0]), float(entry["time_stamps"][-1])
+    first, last = _sample_to_time(entry, np.array([0, entry["n_samples"] - 1]))
+    return float(first), float(last)
+
+
+def load_window(fn: str, name: str, t_start: float, t_stop: float, index: dict = None):
+    """
+    Loads the samples of one stream within a time range
+
+    Args:
+        fn (str): path to the .xdf file
+        name (str): name of the stream (e.g., "BioSemi" or "EyeLink")
+        t_start (float): start of the range (LSL time in seconds)
+        t_stop (float): end of the range (LSL time in seconds, exclusive)
+        index (dict, optional): the index of the file. Defaults to None (loaded or built).
+
+    Returns:
+        tuple: values (n_samples x channels) as stored in the file, and their time stamps (n_samples,)
+    """
+    if index is None:
+        index = load_index(fn)
+    entry = index[name]
+    start = _time_to_sample(entry, t_start)
+    stop = _time_to_sample(entry, t_stop)
+
+    with open(fn, "rb") as fid:
+        data = _read_samples(fid, entry, start, stop)
+    return data, _sample_to_time(entry, np.arange(start, stop))
+
+
+def load_stream(fn: str, name: str, channels: list = None, start: int = 0, stop: int = None, index: dict = None):
+    """
+    Loads some channels and samples of a regular stream as a pyxdf stream dict
+
+    Only the chunks that hold the samples are decoded (one at a time), and only the requested channels are kept, such
+    that the memory used scales with the channels and samples that are loaded.
+
+    Args:
+        fn (str): path to the .xdf file
+        name (str): name of the stream (e.g., "BioSemi")
+        channels (list, optional): indices of the channels to load. Defaults to None (all channels).
+        start (int, optional): first sample. Defaults to 0.
+        stop (int, optional): last sample (exclusive). Defaults to None (the end of the stream).
+        index (dict, optional): the index of the file. Defaults to None (loaded or built).
+
+    Returns:
+        dict: the stream, with "info" (as pyxdf, with the effective sampling rate and only the loaded channels),
+            "time_series" (samples x channels, as stored in the file) and "time_stamps" (dejittered)
+    """
+    if index is None:
+        index = load_index(fn)
+    entry = index[name]
+    channels = list(range(entry["channel_count"])) if channels is None else list(channels)
+    stop = entry["n_samples"] if stop is None else min(stop, entry["n_samples"])
+
+    info = dict(entry["info"], channel_count=[str(len(channels))], effective_srate=entry["effective_srate"])
+    try:
+        desc = entry["info"]["desc"][0]
+        labels = desc["channels"][0]["channel"]
+        info["desc"] = [dict(desc, channels=[{"channel": [labels[channel] for channel in channels]}])]
+    except (TypeError, IndexError, KeyError):  # no channel labels
+        pass
+
+    with open(fn, "rb") as fid:
+        data = _read_samples(fid, entry, start, stop, channels=channels)
+    return {"info": info, "time_series": data, "time_stamps": _sample_to_time(entry, np.arange(start, stop))}
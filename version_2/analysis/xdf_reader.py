@@ -0,0 +1,377 @@
+"""
+Single-pass reader for the recorded .xdf runs
+
+Every stream of a run (BioSemi, KeyboardMarkerStream, EyeLink) is decoded with one call to pyxdf.load_xdf. The decoded
+streams are mirrored next to the .xdf file as plain .npy/.json files, such that later scripts and notebooks load them
+from the mirror without parsing the XML/chunk structure of the .xdf file again. The numeric streams can be mirrored
+compressed instead (.npc, see chunked_archive.py), in chunks of MIRROR_CHUNKS, which are read with the same indexing.
+"""
+import os
+import json
+import shutil
+import numpy as np
+from scipy import signal
+import pyxdf
+import mne
+from chunked_archive import save_chunked, ChunkedArray
+
+# streams recorded during a run
+STREAM_NAMES = ["BioSemi", "KeyboardMarkerStream", "EyeLink"]
+
+# units that are scaled from microvolts to volts when building the MNE raw object (same as mnelab)
+MICROVOLTS = ("microvolt", "microvolts", "µV", "μV", "uV")
+
+# chunk of a compressed numeric stream: 4096 samples (2 s at 2048 Hz) and 8 channels
+MIRROR_CHUNKS = (4096, 8)
+
+
+def get_mirror_path(fn: str):
+    """
+    Returns the directory in which the streams of an .xdf file are mirrored
+
+    Args:
+        fn (str): path to the .xdf file
+
+    Returns:
+        str: path to the mirror directory (sub-..._eeg.xdf -> sub-..._eeg_mirror)
+    """
+    return os.path.splitext(fn)[0] + "_mirror"
+
+
+def _source_signature(fn: str):
+    """
+    Returns the size and modification time of the .xdf file, used to detect stale mirrors
+
+    Args:
+        fn (str): path to the .xdf file
+
+    Returns:
+        dict: size (bytes) and modification time (ns) of the file
+    """
+    stat = os.stat(fn)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_mirror(fn: str, streams: dict, compress: bool = False):
+    """
+    Writes decoded streams to the mirror directory of an .xdf file
+
+    The mirror is written to a temporary directory, which replaces an existing mirror once it is complete.
+
+    Args:
+        fn (str): path to the .xdf file the streams were decoded from
+        streams (dict): all decoded streams of the file (name -> pyxdf stream dict)
+        compress (bool, optional): write the numeric streams compressed (.npc). Defaults to False.
+    """
+    mirror_path = get_mirror_path(fn)
+    tmp_path = mirror_path + ".tmp"
+    if os.path.isdir(tmp_path):  # left behind by an interrupted write
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # the recorded streams, such that a request for a stream that was not recorded is served from the mirror as well
+    manifest = {"source": _source_signature(fn), "recorded": sorted(streams.keys()), "streams": {}}
+    for name, stream in streams.items():
+        np.save(os.path.join(tmp_path, f"{name}_time_stamps.npy"), np.asarray(stream["time_stamps"]))
+
+        # string (marker) streams are stored as json, numeric streams as raw .npy or compressed .npc (delta over time)
+        if isinstance(stream["time_series"], list):
+            with open(os.path.join(tmp_path, f"{name}_time_series.json"), "w") as fid:
+                json.dump(stream["time_series"], fid)
+            series_format = "json"
+        elif compress:
+            save_chunked(os.path.join(tmp_path, f"{name}_time_series.npc"), stream["time_series"], MIRROR_CHUNKS,
+                         delta_axis=0)
+            series_format = "npc"
+        else:
+            np.save(os.path.join(tmp_path, f"{name}_time_series.npy"), stream["time_series"])
+            series_format = "npy"
+
+        manifest["streams"][name] = {"info": stream["info"], "format": series_format}
+
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as fid:
+        json.dump(manifest, fid)
+
+    # swap the complete mirror in: the old mirror is moved aside first (directories cannot be replaced in one rename on
+    # Windows), in between there is no mirror and readers decode the .xdf file
+    if os.path.isdir(mirror_path):
+        os.replace(mirror_path, mirror_path + ".old")
+    os.replace(tmp_path, mirror_path)
+    if os.path.isdir(mirror_path + ".old"):
+        shutil.rmtree(mirror_path + ".old")
+
+
+def compress_mirror(fn: str):
+    """
+    Compresses the numeric streams of the mirror of an .xdf file, if it is up to date
+
+    Args:
+        fn (str): path to the .xdf file
+
+    Returns:
+        bool: whether the mirror was compressed (False if there is no up-to-date mirror)
+    """
+    streams = read_mirror(fn, mmap=True)
+    if streams is None:
+        return False
+    fn_manifest = os.path.join(get_mirror_path(fn), "manifest.json")
+    with open(fn_manifest, "r") as fid:
+        manifest = json.load(fid)
+    os.remove(fn_manifest)  # incomplete until it is written again
+
+    for name, stream in streams.items():
+        if manifest["streams"][name]["format"] == "npy":
+            fn_series = os.path.join(get_mirror_path(fn), f"{name}_time_series")
+            save_chunked(fn_series + ".npc", stream["time_series"], MIRROR_CHUNKS, delta_axis=0)
+            del stream["time_series"]
+            os.remove(fn_series + ".npy")
+            manifest["streams"][name]["format"] = "npc"
+    with open(fn_manifest, "w") as fid:
+        json.dump(manifest, fid)
+    return True
+
+
+def read_mirror(fn: str, names: list = None, mmap: bool = False):
+    """
+    Reads streams from the mirror directory of an .xdf file
+
+    Args:
+        fn (str): path to the .xdf file
+        names (list, optional): names of the streams to read, streams that were not recorded are left out. Defaults to
+            None (all mirrored streams).
+        mmap (bool, optional): memory-map numeric streams instead of reading them into memory (compressed streams are
+            opened as a ChunkedArray). Defaults to False.
+
+    Returns:
+        dict: streams (name -> pyxdf stream dict), or None if there is no up-to-date mirror of the file
+    """
+    fn_manifest = os.path.join(get_mirror_path(fn), "manifest.json")
+    if not os.path.isfile(fn_manifest):
+        return None
+    with open(fn_manifest, "r") as fid:
+        manifest = json.load(fid)
+
+    # the mirror is stale if the .xdf file changed after the mirror was written
+    if os.path.isfile(fn) and manifest["source"] != _source_signature(fn):
+        return None
+
+    # mirrors written before the recorded streams were listed hold all streams of the file as well
+    recorded = manifest.get("recorded", list(manifest["streams"].keys()))
+    if any(name not in manifest["streams"] for name in recorded):
+        return None
+    names = recorded if names is None else [name for name in names if name in recorded]
+
+    mirror_path = get_mirror_path(fn)
+    streams = {}
+    for name in names:
+        entry = manifest["streams"][name]
+        if entry["format"] == "json":
+            with open(os.path.join(mirror_path, f"{name}_time_series.json"), "r") as fid:
+                time_series = json.load(fid)
+        elif entry["format"] == "npc":
+            time_series = ChunkedArray(os.path.join(mirror_path, f"{name}_time_series.npc"))
+            if not mmap:
+                time_series = np.asarray(time_series)
+        else:
+            time_series = np.load(os.path.join(mirror_path, f"{name}_time_series.npy"), mmap_mode="r" if mmap else None)
+        time_stamps = np.load(os.path.join(mirror_path, f"{name}_time_stamps.npy"))
+
+        # json turns the (start, stop) segment tuples of pyxdf into lists
+        info = entry["info"]
+        for key in ["segments", "clock_segments"]:
+            if key in info:
+                info[key] = [tuple(segment) for segment in info[key]]
+
+        streams[name] = {"info": info, "time_series": time_series, "time_stamps": time_stamps}
+
+    return streams
+
+
+def load_streams(fn: str, names: list = STREAM_NAMES, mirror: bool = True, mmap: bool = False):
+    """
+    Loads the streams of a run, decoding the .xdf file at most once
+
+    If an up-to-date mirror exists, the streams are read from it. Otherwise the .xdf file is decoded in a single pass
+    and (optionally) mirrored for the next call.
+
+    Args:
+        fn (str): path to the .xdf file
+        names (list, optional): names of the streams to return. Streams missing from the recording (e.g., EyeLink in
+            runs without eye tracking) are left out. Defaults to STREAM_NAMES.
+        mirror (bool, optional): read from and write to the mirror directory. Defaults to True.
+        mmap (bool, optional): memory-map numeric streams when reading from the mirror. Defaults to False.
+
+    Returns:
+        dict: streams (name -> pyxdf stream dict with "info", "time_series" and "time_stamps")
+    """
+    if mirror:
+        streams = read_mirror(fn, names, mmap=mmap)
+        if streams is not None:
+            return streams
+
+    # decode the whole file once, keeping all streams so the mirror serves any later request
+    streams_all = pyxdf.load_xdf(fn)[0]
+    streams = {stream["info"]["name"][0]: stream for stream in streams_all}
+
+    if mirror:
+        write_mirror(fn, streams)
+
+    return {name: streams[name] for name in names if name in streams}
+
+
+def get_channel_info(stream: dict):
+    """
+    Returns channel labels, types and units of a stream (same conventions as mnelab.io.read_raw)
+
+    Args:
+        stream (dict): pyxdf stream dict
+
+    Returns:
+        tuple: lists of channel labels, MNE channel types and units
+    """
+    n_chans = int(stream["info"]["channel_count"][0])
+    channel_types = mne.io.get_channel_type_constants(True)
+    labels, types, units = [], [], []
+    try:
+        for ch in stream["info"]["desc"][0]["channels"][0]["channel"]:
+            labels.append(str(ch["label"][0]))
+            if ch["type"] and ch["type"][0].lower() in channel_types:
+                types.append(ch["type"][0].lower())
+            else:
+                types.append("misc")
+            units.append(ch["unit"][0] if ch.get("unit") else "NA")
+    except (TypeError, IndexError, KeyError):  # no channel labels found
+        pass
+    if not labels:
+        labels = [f"{stream['info']['name'][0]}_{n}" for n in range(n_chans)]
+    if not units:
+        units = ["NA" for _ in range(n_chans)]
+    if not types:
+        types = ["misc" for _ in range(n_chans)]
+    return labels, types, units
+
+
+def raw_from_stream(stream: dict):
+    """
+    Builds an MNE raw object from a decoded stream, replacing mnelab.io.read_raw(fn, stream_ids=[...])
+
+    Args:
+        stream (dict): pyxdf stream dict of a regular stream (e.g., BioSemi)
+
+    Returns:
+        mne.io.RawArray: the raw data, scaled to volts for channels recorded in microvolts
+    """
+    labels, types, units = get_channel_info(stream)
+    fs = float(np.array(stream["info"]["effective_srate"]).item())
+
+    info = mne.create_info(ch_names=labels, sfreq=fs, ch_types=types)
+    scale = np.array([1e-6 if unit in MICROVOLTS else 1 for unit in units])
+    data = (np.asarray(stream["time_series"]) * scale).T
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def raw_from_stream_low_memory(stream: dict, decim: int = 1, block_channels: int = 8):
+    """
+    Builds an MNE raw object with only the eeg channels and Trig1 of a stream, decimated while it is read
+
+    The time series (as loaded by xdf_index.load_stream, or memory-mapped from the mirror) is read a few channels at a
+    time as float32 and decimated with a zero-phase polyphase anti-alias filter (scipy.signal.resample_poly), such that
+    no full-rate float64 copy of the data is made. Sample k of the result lines up with sample k * decim of the stream.
+    Trig1 is decimated by taking its maximum over the decim samples around each kept sample, such that no pulse is lost.
+
+    Args:
+        stream (dict): pyxdf stream dict of the BioSemi stream
+        decim (int, optional): decimation factor. Defaults to 1.
+        block_channels (int, optional): number of channels read and filtered at once. Defaults to 8.
+
+    Returns:
+        mne.io.RawArray: the raw data (Trig1 first, then the eeg channels), scaled to volts
+    """
+    labels, types, units = get_channel_info(stream)
+    picks = [i for i, (label, ch_type) in enumerate(zip(labels, types)) if label == "Trig1" or ch_type == "eeg"]
+    scale = np.array([1e-6 if unit in MICROVOLTS else 1 for unit in units], dtype="float32")
+    series = stream["time_series"]
+    n_samples = series.shape[0]
+    n_times = -(-n_samples // decim)
+
+    # float64, as mne.io.RawArray copies data of any other dtype to float64
+    data = np.empty((len(picks), n_times))
+    for start in range(0, len(picks), block_channels):
+        rows = np.arange(start, min(start + block_channels, len(picks)))
+        cols = [picks[row] for row in rows]
+        block = np.asarray(series[:, cols], dtype="float32").T * scale[cols, None]
+        if decim == 1:
+            data[rows] = block
+            continue
+        is_trig = np.array([labels[col] == "Trig1" for col in cols])
+        data[rows[~is_trig]] = signal.resample_poly(block[~is_trig], 1, decim, axis=1)
+        for row, x in zip(rows[is_trig], block[is_trig]):
+            # maximum over the decim samples closest to each kept sample
+            padded = np.full(n_times * decim, x[-1])
+            padded[:decim // 2] = x[0]
+            padded[decim // 2:decim // 2 + n_samples] = x[:n_times * decim - decim // 2]
+            data[row] = padded.reshape(n_times, decim).max(axis=1)
+
+    fs = float(np.array(stream["info"]["effective_srate"]).item()) / decim
+    info = mne.create_info(ch_names=[labels[pick] for pick in picks], sfreq=fs,
+                           ch_types=[types[pick] for pick in picks])
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def add_gaze_channels(raw: mne.io.BaseRaw, eeg_stream: dict, gaze_stream: dict):
+    """
+    Adds the channels of the EyeLink stream to the raw eeg data, synchronized to the eeg samples
+
+    The gaze and pupil samples are linearly interpolated at the (LSL synchronized) time stamps of the eeg samples. They
+    are added as misc channels, so they are left out of the filtering, the ICA fit and the epochs.
+
+    Args:
+        raw (mne.io.BaseRaw): raw data built from eeg_stream, modified in place
+        eeg_stream (dict): pyxdf stream dict of the eeg (BioSemi)
+        gaze_stream (dict): pyxdf stream dict of the eye tracker (EyeLink)
+
+    Returns:
+        list: names of the added channels
+    """
+    labels = get_channel_info(gaze_stream)[0]
+    data = interpolate_gaze(gaze_stream["time_series"], gaze_stream["time_stamps"], eeg_stream["time_stamps"])
+    info = mne.create_info(ch_names=labels, sfreq=raw.info["sfreq"], ch_types="misc")
+    raw.add_channels([mne.io.RawArray(data, info, verbose=False)], force_update_info=True)
+    return labels
+
+
+def interpolate_gaze(series: np.ndarray, time_stamps: np.ndarray, times: np.ndarray):
+    """
+    Linearly interpolates the gaze and pupil samples at other time stamps, e.g., those of the eeg samples
+
+    Args:
+        series (np.ndarray): gaze and pupil samples (samples x channels), NaN during track loss
+        time_stamps (np.ndarray): time stamps of the samples (LSL time in seconds)
+        times (np.ndarray): time stamps to interpolate at (LSL time in seconds)
+
+    Returns:
+        np.ndarray: the interpolated channels (channels x times), zero for a channel without valid samples
+    """
+    series = np.asarray(series, dtype="float64")
+    data = np.zeros((series.shape[1], len(times)))
+    for i_channel in range(series.shape[1]):
+        valid = np.isfinite(series[:, i_channel])  # track loss
+        if not np.any(valid):
+            continue
+        data[i_channel] = np.interp(times, time_stamps[valid], series[valid, i_channel])
+    return data
+
+
+def get_labels(marker_stream: dict):
+    """
+    Extracts the trial labels (cued side) from the marker stream
+
+    Args:
+        marker_stream (dict): pyxdf stream dict of the KeyboardMarkerStream
+
+    Returns:
+        list: one boolean per trial, True if the right side was cued
+    """
+    return [marker[3].lower().strip('""') == "right"
+            for marker in marker_stream["time_series"]
+            if marker[2] == "cued_side"]